@@ -0,0 +1,76 @@
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, List, Tuple
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class BatchingPredictor:
+    """
+    Coalesces concurrent prediction requests into micro-batches
+    Waits up to max_wait_ms for up to max_batch requests, then runs a single
+    model.predict_batch call in the executor; requests arriving while a batch
+    is generating join the next one
+    """
+
+    def __init__(self, get_model: Callable[[], Any], executor: Executor,
+                 max_batch: int = 1, max_wait_ms: int = 25):
+        self.get_model = get_model
+        self.executor = executor
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0, max_wait_ms) / 1000
+
+        self._queue: "asyncio.Queue[Tuple[str, asyncio.Future]]" = None
+        self._worker: asyncio.Task = None
+
+    async def submit(self, text: str) -> Dict[str, Any]:
+        """Queue text for prediction and wait for its result"""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _run(self):
+        """Drain the queue into batches until cancelled"""
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # One batch at a time: the model shares one KV cache, and waiting lets the queue fill
+            await self._dispatch(batch)
+
+    async def _dispatch(self, batch: List[Tuple[str, asyncio.Future]]):
+        """Run one batch through the model and resolve its futures"""
+        texts = [text for text, _ in batch]
+        model = self.get_model()
+
+        try:
+            if len(texts) > 1:
+                logger.debug(f"Dispatching batch of {len(texts)} predictions")
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.executor, model.predict_batch, texts
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
@@ -0,0 +1,138 @@
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from config.settings import get_settings
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class PredictionCache:
+    """
+    In-process LRU cache for model predictions
+    Keyed on the model name, generation parameters and normalized input text
+    """
+
+    def __init__(self, maxsize: int = 512):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Tuple, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_name: str, text: str) -> Tuple:
+        """Build a cache key from the model name, generation settings and normalized text"""
+        settings = get_settings()
+        return (
+            model_name,
+            round(settings.TEMPERATURE, 3),
+            round(settings.TOP_P, 3),
+            settings.REPETITION_PENALTY,
+            text.strip().lower()
+        )
+
+    @staticmethod
+    def is_enabled() -> bool:
+        """Sampled generations are non-deterministic and must not be cached"""
+        settings = get_settings()
+        return not settings.DO_SAMPLE or settings.TEMPERATURE <= 0
+
+    def get(self, key: Tuple) -> Optional[Dict[str, Any]]:
+        """Return the cached prediction for key, or None on miss"""
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+
+        logger.debug(f"Prediction cache {'hit' if result is not None else 'miss'}: {key[0]}")
+        return result
+
+    def set(self, key: Tuple, result: Dict[str, Any]):
+        """Store a prediction, evicting the least recently used entry when full"""
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all cached predictions"""
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskPredictionCache:
+    """
+    SQLite-backed prediction cache that survives bot restarts
+    and can be shared by several worker processes on the same host
+    """
+
+    def __init__(self, path: str, ttl: int = 7 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            "key TEXT PRIMARY KEY, result TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def digest(key: Tuple) -> str:
+        """Hash a PredictionCache key into a stable SHA-256 hex digest"""
+        return hashlib.sha256("|".join(str(part) for part in key).encode()).hexdigest()
+
+    def get(self, key: Tuple) -> Optional[Dict[str, Any]]:
+        """Return the stored prediction for key if present and not expired"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result, expires_at FROM predictions WHERE key = ?",
+                (self.digest(key),)
+            ).fetchone()
+
+        if row is None or row[1] < time.time():
+            return None
+
+        return json.loads(row[0])
+
+    def set(self, key: Tuple, result: Dict[str, Any]):
+        """Persist a prediction with the configured TTL"""
+        try:
+            payload = json.dumps(result)
+        except (TypeError, ValueError):
+            logger.debug("Prediction not JSON serializable, skipping disk cache")
+            return
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO predictions (key, result, expires_at) VALUES (?, ?, ?)",
+                (self.digest(key), payload, time.time() + self.ttl)
+            )
+            self._conn.commit()
+
+    def clear(self):
+        """Drop all stored predictions"""
+        with self._lock:
+            self._conn.execute("DELETE FROM predictions")
+            self._conn.commit()
+
+
+def create_disk_cache() -> Optional[DiskPredictionCache]:
+    """Create the disk cache from settings, or None if disabled or unavailable"""
+    settings = get_settings()
+    if not settings.PREDICTION_CACHE_PATH:
+        return None
+
+    try:
+        return DiskPredictionCache(settings.PREDICTION_CACHE_PATH, ttl=settings.PREDICTION_CACHE_TTL)
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"⚠️ Disk prediction cache unavailable: {e}")
+        return None
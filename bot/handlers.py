@@ -1,55 +1,34 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from models.model_factory import ModelFactory
-from database.db_manager import DatabaseManager
-from config.settings import settings
+from database.db_manager import get_db_manager
+from config.settings import get_settings
+from .handlers_minimal import BotHandlers as MinimalBotHandlers, authorized, _command_text
+import asyncio
+import functools
 import logging
-import time
-import json
+import re
 
 logger = logging.getLogger(__name__)
 
-class BotHandlers:
-    def __init__(self):
-        self.db_manager = DatabaseManager()
-        self.model = None
-        self.load_model()
-    
-    def load_model(self):
-        """Load the AI model based on settings"""
-        try:
-            logger.info(f"Loading model: {settings.MODEL_NAME}")
-            
-            # Create model from settings
-            self.model = ModelFactory.create_model(
-                model_type=settings.MODEL_TYPE,
-                model_name=settings.MODEL_NAME
-            )
-            
-            # Load the model
-            self.model.load_model()
-            
-            logger.info(f"✅ Model loaded successfully: {settings.MODEL_NAME}")
-            
-        except Exception as e:
-            logger.error(f"❌ Error loading model: {e}")
-            self.model = None
-    
-    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Enhanced start command with model info"""
-        user_id = update.effective_user.id
-        
-        # Check if user is allowed
-        if not settings.is_user_allowed(user_id):
-            await update.message.reply_text("❌ You are not authorized to use this bot.")
-            return
-        
-        model_info = self.model.get_model_info() if self.model else {"model_name": "Not loaded"}
-        
-        welcome_text = f"""
+# Keywords that route a free-text message to a resource search, matched in one pass
+_URL_KEYWORDS = frozenset(("url", "link"))
+_CONTRACT_KEYWORDS = frozenset(("contract", "address"))
+_RESOURCE_KEYWORDS_RE = re.compile("|".join(_URL_KEYWORDS | _CONTRACT_KEYWORDS), re.IGNORECASE)
+
+# Static keyboards and message skeletons, built once at import
+_MAIN_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🤖 Model Info", callback_data="model_info"),
+        InlineKeyboardButton("📚 Help", callback_data="help")
+    ],
+    [InlineKeyboardButton("🔄 Popular Models", callback_data="popular_models")]
+])
+
+_WELCOME_TEMPLATE = """
 🤖 **Universal AI Assistant Bot**
 
-Hello! I'm powered by **{model_info['model_name']}** and ready to help!
+Hello! I'm powered by **{model_name}** and ready to help!
 
 **Available Commands:**
 • `/chat <message>` - Chat with the AI model
@@ -71,83 +50,73 @@ Hello! I'm powered by **{model_info['model_name']}** and ready to help!
 
 Just send me a message and I'll respond using the loaded AI model! 🚀
 """
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("🤖 Model Info", callback_data="model_info"),
-                InlineKeyboardButton("📚 Help", callback_data="help")
-            ],
-            [InlineKeyboardButton("🔄 Popular Models", callback_data="popular_models")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(welcome_text, reply_markup=reply_markup, parse_mode='Markdown')
-    
-    async def chat(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle chat command"""
-        if not context.args:
-            await update.message.reply_text("💬 Please provide a message to chat!\n\nExample: `/chat How are you today?`", parse_mode='Markdown')
-            return
-        
-        message = ' '.join(context.args)
-        await self._process_ai_request(update, message, request_type="chat")
-    
-    async def ask(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle ask command for questions"""
-        if not context.args:
-            await update.message.reply_text("❓ Please ask a question!\n\nExample: `/ask What is machine learning?`", parse_mode='Markdown')
-            return
-        
-        question = ' '.join(context.args)
-        await self._process_ai_request(update, question, request_type="question")
-    
-    async def info(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Show current model information"""
-        if not self.model:
-            await update.message.reply_text("❌ No model is currently loaded.")
-            return
-        
-        model_info = self.model.get_model_info()
-        
-        info_text = f"""
+
+_INFO_TEMPLATE = """
 🤖 **Current Model Information**
 
-**Model:** `{model_info['model_name']}`
-**Task Type:** {model_info['task_type']}
-**Device:** {model_info['device']}
-**Max Length:** {model_info['max_length']} tokens
-**Quantized:** {'Yes' if model_info.get('quantized', False) else 'No'}
-**Status:** {'✅ Ready' if model_info['model_loaded'] else '❌ Not loaded'}
+**Model:** `{model_name}`
+**Task Type:** {task_type}
+**Device:** {device}
+**Max Length:** {max_length} tokens
+**Quantized:** {quantized}
+**Status:** {status}
 
 **Settings:**
-• Temperature: {settings.TEMPERATURE}
-• Top-p: {settings.TOP_P}
-• Repetition Penalty: {settings.REPETITION_PENALTY}
+• Temperature: {temperature}
+• Top-p: {top_p}
+• Repetition Penalty: {repetition_penalty}
 """
-        
-        await update.message.reply_text(info_text, parse_mode='Markdown')
+
+_RESPONSE_TEMPLATE = """
+🤖 **AI Response**
+
+{response}
+
+---
+🎯 Confidence: {confidence:.1%} | ⏱️ {processing_time:.1f}s
+🔧 Model: {model_name}
+"""
+
+def _build_models_text() -> str:
+    """Render the popular models listing"""
+    popular_models = ModelFactory.get_popular_models()
+    
+    models_text = "🔥 **Popular Models by Category**\n\n"
+    
+    for category, model_list in popular_models.items():
+        models_text += f"**{category.replace('_', ' ').title()}:**\n"
+        for model in model_list[:3]:  # Show top 3 per category
+            models_text += f"• `{model}`\n"
+        models_text += "\n"
+    
+    models_text += "💡 Use `/switch <model_name>` to change models (admin only)"
+    return models_text
+
+_MODELS_TEXT = _build_models_text()
+
+class BotHandlers(MinimalBotHandlers):
+    """Full handler set: AI chat plus model management and database-backed resources"""
+    
+    welcome_template = _WELCOME_TEMPLATE
+    info_template = _INFO_TEMPLATE
+    response_template = _RESPONSE_TEMPLATE
+    main_keyboard = _MAIN_KEYBOARD
     
+    def __init__(self):
+        super().__init__()
+        self.db_manager = get_db_manager()
+    
+    @authorized
     async def models(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show popular models by category"""
-        popular_models = ModelFactory.get_popular_models()
-        
-        models_text = "🔥 **Popular Models by Category**\n\n"
-        
-        for category, model_list in popular_models.items():
-            models_text += f"**{category.replace('_', ' ').title()}:**\n"
-            for model in model_list[:3]:  # Show top 3 per category
-                models_text += f"• `{model}`\n"
-            models_text += "\n"
-        
-        models_text += "💡 Use `/switch <model_name>` to change models (admin only)"
-        
-        await update.message.reply_text(models_text, parse_mode='Markdown')
+        await update.message.reply_text(_MODELS_TEXT, parse_mode='Markdown')
     
+    @authorized
     async def switch_model(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Switch to a different model (admin only)"""
         user_id = update.effective_user.id
         
-        if not settings.is_admin_user(user_id):
+        if not get_settings().is_admin_user(user_id):
             await update.message.reply_text("❌ This command is only available to administrators.")
             return
         
@@ -163,22 +132,22 @@ Just send me a message and I'll respond using the loaded AI model! 🚀
             )
             return
         
-        new_model_name = ' '.join(context.args)
+        new_model_name = _command_text(update)
         
         await update.message.reply_text(f"🔄 Switching to model: `{new_model_name}`\nThis may take a moment...", parse_mode='Markdown')
         
         try:
-            # Create new model instance
-            new_model = ModelFactory.create_model(
-                model_type="universal",
-                model_name=new_model_name
+            # Replaces the shared instance, releasing the previous model's weights; the load
+            # takes minutes, so it runs in the executor instead of freezing every chat
+            new_model = await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                functools.partial(ModelFactory.get_or_create, model_type="universal", model_name=new_model_name)
             )
             
-            # Load the new model
-            new_model.load_model()
-            
             # Replace current model
             self.model = new_model
+            self._model_info_cache = new_model.get_model_info()
+            self.prediction_cache.clear()
             
             await update.message.reply_text(f"✅ Successfully switched to: `{new_model_name}`", parse_mode='Markdown')
             
@@ -186,70 +155,10 @@ Just send me a message and I'll respond using the loaded AI model! 🚀
             logger.error(f"Error switching model: {e}")
             await update.message.reply_text(f"❌ Failed to switch model: {str(e)}")
     
-    async def _process_ai_request(self, update: Update, text: str, request_type: str = "chat"):
-        """Process AI request with universal model"""
-        if not self.model:
-            await update.message.reply_text("❌ Model not available. Please try again later.")
-            return
-        
-        # Show typing indicator
-        await update.message.reply_chat_action("typing")
-        
-        try:
-            # Add processing indicator
-            processing_msg = await update.message.reply_text(f"🤖 Processing your {request_type}...")
-            
-            start_time = time.time()
-            result = self.model.predict(text)
-            processing_time = time.time() - start_time
-            
-            # Delete processing message
-            await processing_msg.delete()
-            
-            if result.get('error'):
-                await update.message.reply_text(f"❌ Error: {result['error']}")
-                return
-            
-            response = result.get('response', 'No response generated')
-            confidence = result.get('confidence', 0.0)
-            
-            # Format response
-            if len(response) > settings.MAX_RESPONSE_LENGTH:
-                response = response[:settings.MAX_RESPONSE_LENGTH] + "..."
-            
-            formatted_response = f"""
-🤖 **AI Response**
-
-{response}
-
----
-🎯 Confidence: {confidence:.1%} | ⏱️ {processing_time:.1f}s
-🔧 Model: {result.get('model_name', 'Unknown')}
-"""
-            
-            await update.message.reply_text(formatted_response, parse_mode='Markdown')
-            
-            # Add quick action buttons
-            keyboard = [
-                [
-                    InlineKeyboardButton("🔄 Ask Another", callback_data="new_question"),
-                    InlineKeyboardButton("ℹ️ Model Info", callback_data="model_info")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await update.message.reply_text("What would you like to do next?", reply_markup=reply_markup)
-            
-        except Exception as e:
-            logger.error(f"AI request processing error: {e}")
-            await update.message.reply_text(
-                f"❌ Error processing your {request_type}. Please try again or use a simpler request."
-            )
-    
-    # Keep existing URL and contract methods
+    @authorized
     async def get_url(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Get URL resource"""
-        if not settings.ENABLE_URL_RESOURCES:
+        if not get_settings().ENABLE_URL_RESOURCES:
             await update.message.reply_text("📎 URL resources are disabled.")
             return
             
@@ -258,7 +167,7 @@ Just send me a message and I'll respond using the loaded AI model! 🚀
             return
         
         name = context.args[0]
-        resource = self.db_manager.get_url_resource(name)
+        resource = await self.db_manager.get_url_resource(name)
         
         if resource:
             response = f"""
@@ -274,9 +183,10 @@ Just send me a message and I'll respond using the loaded AI model! 🚀
         else:
             await update.message.reply_text(f"❌ URL resource '{name}' not found.")
     
+    @authorized
     async def get_contract(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Get smart contract"""
-        if not settings.ENABLE_SMART_CONTRACTS:
+        if not get_settings().ENABLE_SMART_CONTRACTS:
             await update.message.reply_text("🔗 Smart contracts are disabled.")
             return
             
@@ -285,7 +195,7 @@ Just send me a message and I'll respond using the loaded AI model! 🚀
             return
         
         name = context.args[0]
-        contract = self.db_manager.get_smart_contract(name)
+        contract = await self.db_manager.get_smart_contract(name)
         
         if contract:
             response = f"""
@@ -303,6 +213,7 @@ Just send me a message and I'll respond using the loaded AI model! 🚀
         else:
             await update.message.reply_text(f"❌ Smart contract '{name}' not found.")
     
+    @authorized
     async def add_url(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Add new URL resource"""
         if len(context.args) < 2:
@@ -316,11 +227,12 @@ Just send me a message and I'll respond using the loaded AI model! 🚀
         url = context.args[1]
         description = ' '.join(context.args[2:]) if len(context.args) > 2 else None
         
-        if self.db_manager.add_url_resource(name, url, description):
-            await update.message.reply_text(f"✅ URL resource '{name}' added successfully.")
+        if await self.db_manager.add_url_resource(name, url, description):
+            await update.message.reply_text(f"✅ URL resource '{name}' saved successfully.")
         else:
-            await update.message.reply_text(f"❌ Failed to add URL resource. Name might already exist.")
+            await update.message.reply_text(f"❌ Failed to save URL resource.")
     
+    @authorized
     async def add_contract(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Add new smart contract"""
         if len(context.args) < 2:
@@ -335,18 +247,20 @@ Just send me a message and I'll respond using the loaded AI model! 🚀
         network = context.args[2] if len(context.args) > 2 else None
         description = ' '.join(context.args[3:]) if len(context.args) > 3 else None
         
-        if self.db_manager.add_smart_contract(name, address, network, description):
-            await update.message.reply_text(f"✅ Smart contract '{name}' added successfully.")
+        if await self.db_manager.add_smart_contract(name, address, network, description):
+            await update.message.reply_text(f"✅ Smart contract '{name}' saved successfully.")
         else:
-            await update.message.reply_text(f"❌ Failed to add smart contract. Name might already exist.")
+            await update.message.reply_text(f"❌ Failed to save smart contract.")
     
+    @authorized
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle general messages - treat as chat input"""
         text = update.message.text
+        keywords = {match.lower() for match in _RESOURCE_KEYWORDS_RE.findall(text)}
         
         # Check for resource searches first
-        if "url" in text.lower() or "link" in text.lower():
-            resources = self.db_manager.search_resources(text)
+        if keywords & _URL_KEYWORDS:
+            resources = await self.db_manager.search_resources(text)
             if resources:
                 response = "🔍 **Found URL resources:**\n\n"
                 for res in resources[:3]:
@@ -354,8 +268,8 @@ Just send me a message and I'll respond using the loaded AI model! 🚀
                 await update.message.reply_text(response, parse_mode='Markdown')
                 return
         
-        if "contract" in text.lower() or "address" in text.lower():
-            contracts = self.db_manager.search_contracts(text)
+        if keywords & _CONTRACT_KEYWORDS:
+            contracts = await self.db_manager.search_contracts(text)
             if contracts:
                 response = "🔍 **Found smart contracts:**\n\n"
                 for cont in contracts[:3]:
@@ -1,124 +1,276 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from models.model_factory import ModelFactory
-from config.settings import settings
+from config.settings import get_settings
+from .batching import BatchingPredictor
+from .cache import PredictionCache, create_disk_cache
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
 import logging
 import time
 
 logger = logging.getLogger(__name__)
 
+# Static keyboards and message skeletons, built once at import
+_MAIN_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🤖 Model Info", callback_data="model_info"),
+        InlineKeyboardButton("📚 Help", callback_data="help")
+    ]
+])
+
+_NEXT_ACTION_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🔄 Ask Another", callback_data="new_question"),
+        InlineKeyboardButton("ℹ️ Model Info", callback_data="model_info")
+    ]
+])
+
+_WELCOME_TEMPLATE = """
+🤖 **Universal AI Assistant Bot**
+
+Hello! I'm powered by **{model_name}** and ready to help!
+
+**Available Commands:**
+• `/chat <message>` - Chat with the AI model
+• `/ask <question>` - Ask a specific question
+• `/info` - Get model information
+
+**Examples:**
+• `/chat Hello, how are you?`
+• `/ask What is artificial intelligence?`
+• `/info` - See current model details
+
+Just send me a message and I'll respond using the loaded AI model! 🚀
+"""
+
+_INFO_TEMPLATE = """
+🤖 **Current Model Information**
+
+**Model:** `{model_name}`
+**Type:** {task_type}
+**Device:** {device}
+**Max Length:** {max_length} tokens
+**PEFT Model:** {is_peft}
+**Status:** {status}
+
+**Settings:**
+• Temperature: {temperature}
+• Top-p: {top_p}
+• Repetition Penalty: {repetition_penalty}
+"""
+
+_RESPONSE_TEMPLATE = """
+🤖 **AI Response**
+
+{response}
+
+---
+🎯 Confidence: {confidence:.1%} | ⏱️ {processing_time:.1f}s
+🔧 Model: {model_name}
+{peft_line}
+"""
+
+def authorized(handler):
+    """Reject users outside ALLOWED_USERS before any model or database work"""
+    @functools.wraps(handler)
+    async def wrapper(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not get_settings().is_user_allowed(update.effective_user.id):
+            await update.message.reply_text("❌ You are not authorized to use this bot.")
+            return
+        return await handler(self, update, context)
+    return wrapper
+
+def _command_text(update: Update) -> str:
+    """Return everything after the /command, without re-joining context.args"""
+    parts = update.message.text.split(maxsplit=1)
+    return parts[1] if len(parts) > 1 else ''
+
 class BotHandlers:
+    """AI chat handlers, usable without the database-backed features"""
+    
+    welcome_template = _WELCOME_TEMPLATE
+    info_template = _INFO_TEMPLATE
+    response_template = _RESPONSE_TEMPLATE
+    main_keyboard = _MAIN_KEYBOARD
+    
     def __init__(self):
+        settings = get_settings()
         # Skip database initialization if not available
         self.db_manager = None
         self.model = None
-        self.load_model()
+        self._model_info_cache = None
+        self.prediction_cache = PredictionCache(maxsize=settings.PREDICTION_CACHE_SIZE)
+        self.disk_cache = create_disk_cache()
+        # PyTorch releases the GIL inside its kernels, so threads are enough to keep the event loop free
+        self._executor = ThreadPoolExecutor(max_workers=settings.MAX_WORKERS, thread_name_prefix="predict")
+        self.batcher = BatchingPredictor(
+            lambda: self.model,
+            self._executor,
+            max_batch=settings.BATCH_SIZE,
+            max_wait_ms=settings.BATCH_WAIT_MS
+        )
+        # The model is loaded on the first AI request so startup stays fast
+        self._model_lock = asyncio.Lock()
+        self._model_load_attempted = False
     
     def load_model(self):
         """Load the AI model based on settings"""
+        settings = get_settings()
         try:
             logger.info(f"Loading model: {settings.MODEL_NAME}")
             
-            # Create model from settings
-            self.model = ModelFactory.create_model(
+            # Shared with any other handler in this process, so the weights are loaded once
+            self.model = ModelFactory.get_or_create(
                 model_type=settings.MODEL_TYPE,
                 model_name=settings.MODEL_NAME
             )
             
-            # Load the model
-            self.model.load_model()
+            # Model info is static until the next load/switch
+            self._model_info_cache = self.model.get_model_info()
             
             logger.info(f"✅ Model loaded successfully: {settings.MODEL_NAME}")
             
         except Exception as e:
             logger.error(f"❌ Error loading model: {e}")
             self.model = None
+            self._model_info_cache = None
     
+    @authorized
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Enhanced start command with model info"""
-        user_id = update.effective_user.id
-        
-        # Check if user is allowed (skip if no database)
-        if hasattr(settings, 'is_user_allowed') and not settings.is_user_allowed(user_id):
-            await update.message.reply_text("❌ You are not authorized to use this bot.")
-            return
-        
-        model_info = self.model.get_model_info() if self.model else {"model_name": "Not loaded"}
-        
-        welcome_text = f"""
-🤖 **Universal AI Assistant Bot**
-
-Hello! I'm powered by **{model_info['model_name']}** and ready to help!
-
-**Available Commands:**
-• `/chat <message>` - Chat with the AI model
-• `/ask <question>` - Ask a specific question
-• `/info` - Get model information
-
-**Examples:**
-• `/chat Hello, how are you?`
-• `/ask What is artificial intelligence?`
-• `/info` - See current model details
-
-Just send me a message and I'll respond using the loaded AI model! 🚀
-"""
+        model_info = self._model_info_cache if self.model else {"model_name": "Not loaded"}
         
-        keyboard = [
-            [
-                InlineKeyboardButton("🤖 Model Info", callback_data="model_info"),
-                InlineKeyboardButton("📚 Help", callback_data="help")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        welcome_text = self.welcome_template.format_map({'model_name': model_info['model_name']})
         
-        await update.message.reply_text(welcome_text, reply_markup=reply_markup, parse_mode='Markdown')
+        await update.message.reply_text(welcome_text, reply_markup=self.main_keyboard, parse_mode='Markdown')
     
+    @authorized
     async def chat(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle chat command"""
         if not context.args:
             await update.message.reply_text("💬 Please provide a message to chat!\n\nExample: `/chat How are you today?`", parse_mode='Markdown')
             return
         
-        message = ' '.join(context.args)
+        message = _command_text(update)
         await self._process_ai_request(update, message, request_type="chat")
     
+    @authorized
     async def ask(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle ask command for questions"""
         if not context.args:
             await update.message.reply_text("❓ Please ask a question!\n\nExample: `/ask What is machine learning?`", parse_mode='Markdown')
             return
         
-        question = ' '.join(context.args)
+        question = _command_text(update)
         await self._process_ai_request(update, question, request_type="question")
     
+    @authorized
     async def info(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show current model information"""
+        settings = get_settings()
         if not self.model:
             await update.message.reply_text("❌ No model is currently loaded.")
             return
         
-        model_info = self.model.get_model_info()
+        model_info = self._model_info_cache
         
-        info_text = f"""
-🤖 **Current Model Information**
-
-**Model:** `{model_info['model_name']}`
-**Type:** {model_info.get('task_type', 'Unknown')}
-**Device:** {model_info.get('device', 'Unknown')}
-**Max Length:** {model_info.get('max_length', 'Unknown')} tokens
-**PEFT Model:** {'Yes' if model_info.get('is_peft_model', False) else 'No'}
-**Status:** {'✅ Ready' if model_info.get('model_loaded', False) else '❌ Not loaded'}
-
-**Settings:**
-• Temperature: {settings.TEMPERATURE}
-• Top-p: {settings.TOP_P}
-• Repetition Penalty: {settings.REPETITION_PENALTY}
-"""
+        info_text = self.info_template.format_map({
+            'model_name': model_info['model_name'],
+            'task_type': model_info.get('task_type', 'Unknown'),
+            'device': model_info.get('device', 'Unknown'),
+            'max_length': model_info.get('max_length', 'Unknown'),
+            'quantized': 'Yes' if model_info.get('quantized', False) else 'No',
+            'is_peft': 'Yes' if model_info.get('is_peft_model', False) else 'No',
+            'status': '✅ Ready' if model_info.get('model_loaded', False) else '❌ Not loaded',
+            'temperature': settings.TEMPERATURE,
+            'top_p': settings.TOP_P,
+            'repetition_penalty': settings.REPETITION_PENALTY
+        })
         
         await update.message.reply_text(info_text, parse_mode='Markdown')
     
+    def shutdown(self):
+        """Wait for in-flight predictions and release worker threads"""
+        self._executor.shutdown(wait=True)
+    
+    async def _predict(self, text: str, on_partial=None) -> dict:
+        """Run model prediction, serving repeated deterministic prompts from cache"""
+        if not PredictionCache.is_enabled():
+            return await self._run_model(text, on_partial)
+        
+        model_name = getattr(self.model, 'model_name', get_settings().MODEL_NAME)
+        key = PredictionCache.make_key(model_name, text)
+        
+        result = self.prediction_cache.get(key)
+        if result is None and self.disk_cache:
+            result = self.disk_cache.get(key)
+            if result is not None:
+                self.prediction_cache.set(key, result)
+        
+        if result is None:
+            result = await self._run_model(text, on_partial)
+            if not result.get('error'):
+                self.prediction_cache.set(key, result)
+                if self.disk_cache:
+                    self.disk_cache.set(key, result)
+        
+        return result
+    
+    async def _run_model(self, text: str, on_partial=None) -> dict:
+        """Stream the prediction when possible, otherwise go through the micro-batcher"""
+        settings = get_settings()
+        if on_partial is None or not settings.STREAM_RESPONSES or not self.model.supports_streaming():
+            return await self.batcher.submit(text)
+        
+        latest = {'text': ''}
+        
+        def consume():
+            stream = self.model.predict_stream(text)
+            while True:
+                try:
+                    latest['text'] = next(stream)
+                except StopIteration as stop:
+                    return stop.value
+        
+        future = asyncio.get_running_loop().run_in_executor(self._executor, consume)
+        shown = ''
+        
+        # Push the partial text at a fixed interval to stay under Telegram's edit rate limits
+        while not future.done():
+            await asyncio.wait({future}, timeout=settings.STREAM_EDIT_INTERVAL)
+            partial = latest['text']
+            if partial and partial != shown and not future.done():
+                shown = partial
+                try:
+                    await on_partial(partial)
+                except Exception as e:
+                    logger.debug(f"Skipping partial response update: {e}")
+        
+        return future.result()
+    
+    async def _ensure_model_loaded(self, update: Update):
+        """Load the model on first use, off the event loop"""
+        if self.model is not None:
+            return
+        
+        # A previous load already failed and nothing is in progress
+        if self._model_load_attempted and not self._model_lock.locked():
+            return
+        
+        await update.message.reply_text("⏳ Loading the AI model, please wait...")
+        
+        async with self._model_lock:
+            if not self._model_load_attempted:
+                self._model_load_attempted = True
+                await asyncio.get_running_loop().run_in_executor(self._executor, self.load_model)
+    
     async def _process_ai_request(self, update: Update, text: str, request_type: str = "chat"):
         """Process AI request with universal model"""
+        settings = get_settings()
+        await self._ensure_model_loaded(update)
+        
         if not self.model:
             await update.message.reply_text("❌ Model not available. Please try again later.")
             return
@@ -128,17 +280,24 @@ Just send me a message and I'll respond using the loaded AI model! 🚀
         
         try:
             # Add processing indicator
-            processing_msg = await update.message.reply_text(f"🤖 Processing your {request_type}...")
+            processing_text = f"🤖 Processing your {request_type}..."
             
-            start_time = time.time()
-            result = self.model.predict(text)
-            processing_time = time.time() - start_time
+            # Bound attention cost: the tokenizer would truncate anyway, after paying for it
+            if len(text) > settings.MAX_INPUT_CHARS:
+                text = text[:settings.MAX_INPUT_CHARS]
+                processing_text += f"\nℹ️ Input truncated to {settings.MAX_INPUT_CHARS} chars."
             
-            # Delete processing message
-            await processing_msg.delete()
+            processing_msg = await update.message.reply_text(processing_text)
+            
+            start_time = time.perf_counter()
+            result = await self._predict(
+                text,
+                on_partial=lambda partial: processing_msg.edit_text(partial[:settings.MAX_RESPONSE_LENGTH] + " ▌")
+            )
+            processing_time = time.perf_counter() - start_time
             
             if result.get('error'):
-                await update.message.reply_text(f"❌ Error: {result['error']}")
+                await processing_msg.edit_text(f"❌ Error: {result['error']}")
                 return
             
             response = result.get('response', 'No response generated')
@@ -148,29 +307,20 @@ Just send me a message and I'll respond using the loaded AI model! 🚀
             if len(response) > settings.MAX_RESPONSE_LENGTH:
                 response = response[:settings.MAX_RESPONSE_LENGTH] + "..."
             
-            formatted_response = f"""
-🤖 **AI Response**
-
-{response}
-
----
-🎯 Confidence: {confidence:.1%} | ⏱️ {processing_time:.1f}s
-🔧 Model: {result.get('model_name', 'Unknown')}
-{'🔗 PEFT Model' if result.get('is_peft', False) else ''}
-"""
-            
-            await update.message.reply_text(formatted_response, parse_mode='Markdown')
+            formatted_response = self.response_template.format_map({
+                'response': response,
+                'confidence': confidence,
+                'processing_time': processing_time,
+                'model_name': result.get('model_name', 'Unknown'),
+                'peft_line': '🔗 PEFT Model' if result.get('is_peft', False) else ''
+            })
             
-            # Add quick action buttons
-            keyboard = [
-                [
-                    InlineKeyboardButton("🔄 Ask Another", callback_data="new_question"),
-                    InlineKeyboardButton("ℹ️ Model Info", callback_data="model_info")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await update.message.reply_text("What would you like to do next?", reply_markup=reply_markup)
+            # Replace the processing indicator with the answer and quick action buttons
+            await processing_msg.edit_text(
+                formatted_response,
+                reply_markup=_NEXT_ACTION_KEYBOARD if settings.SHOW_FOLLOWUP_BUTTONS else None,
+                parse_mode='Markdown'
+            )
             
         except Exception as e:
             logger.error(f"AI request processing error: {e}")
@@ -178,6 +328,7 @@ Just send me a message and I'll respond using the loaded AI model! 🚀
                 f"❌ Error processing your {request_type}. Please try again or use a simpler request."
             )
     
+    @authorized
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle general messages - treat as chat input"""
         text = update.message.text
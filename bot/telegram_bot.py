@@ -1,61 +1,89 @@
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
+from telegram.request import HTTPXRequest
 from .handlers import BotHandlers
-from config.settings import settings
+from config.settings import get_settings
 import logging
 
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 logger = logging.getLogger(__name__)
 
 class TelegramBot:
     def __init__(self):
-        self.application = Application.builder().token(settings.TELEGRAM_BOT_TOKEN).build()
+        settings = get_settings()
+        self.application = (
+            Application.builder()
+            .token(settings.TELEGRAM_BOT_TOKEN)
+            .request(HTTPXRequest(
+                connection_pool_size=settings.TELEGRAM_POOL_SIZE,
+                read_timeout=60,
+                write_timeout=60,
+                connect_timeout=10,
+                pool_timeout=5
+            ))
+            # Separate pool so the long-poll socket never starves replies
+            .get_updates_request(HTTPXRequest(connection_pool_size=32, read_timeout=70))
+            .build()
+        )
         self.handlers = BotHandlers()
         self.setup_handlers()
     
     def setup_handlers(self):
         """Setup all command and message handlers"""
-        # Basic commands
-        self.application.add_handler(CommandHandler("start", self.handlers.start))
-        self.application.add_handler(CommandHandler("help", self.handlers.start))
-        
-        # AI interaction commands
-        self.application.add_handler(CommandHandler("chat", self.handlers.chat))
-        self.application.add_handler(CommandHandler("ask", self.handlers.ask))
-        
-        # Model management commands
-        self.application.add_handler(CommandHandler("info", self.handlers.info))
-        self.application.add_handler(CommandHandler("models", self.handlers.models))
-        self.application.add_handler(CommandHandler("switch", self.handlers.switch_model))
-        
-        # Legacy commands (for compatibility)
-        self.application.add_handler(CommandHandler("predict", self.handlers.chat))  # Alias for chat
-        
-        # Resource management commands
-        self.application.add_handler(CommandHandler("url", self.handlers.get_url))
-        self.application.add_handler(CommandHandler("contract", self.handlers.get_contract))
-        self.application.add_handler(CommandHandler("add_url", self.handlers.add_url))
-        self.application.add_handler(CommandHandler("add_contract", self.handlers.add_contract))
-        
-        # Message handler for general chat
-        self.application.add_handler(
+        self.application.add_handlers([
+            # Basic commands
+            CommandHandler(["start", "help"], self.handlers.start),
+            
+            # AI interaction commands (/predict is a legacy alias for /chat)
+            CommandHandler(["chat", "predict"], self.handlers.chat),
+            CommandHandler("ask", self.handlers.ask),
+            
+            # Model management commands
+            CommandHandler("info", self.handlers.info),
+            CommandHandler("models", self.handlers.models),
+            CommandHandler("switch", self.handlers.switch_model),
+            
+            # Resource management commands
+            CommandHandler("url", self.handlers.get_url),
+            CommandHandler("contract", self.handlers.get_contract),
+            CommandHandler("add_url", self.handlers.add_url),
+            CommandHandler("add_contract", self.handlers.add_contract),
+            
+            # Message handler for general chat
             MessageHandler(filters.TEXT & ~filters.COMMAND, self.handlers.handle_message)
-        )
+        ])
         
         logger.info("✅ All handlers registered successfully")
     
-    def run(self):
-        """Run the bot"""
+    def run(self, polling: bool = False):
+        """Run the bot via webhook, or long-polling when explicitly requested"""
+        settings = get_settings()
         logger.info(f"🚀 Starting Telegram bot with model: {settings.MODEL_NAME}")
         
-        if settings.WEBHOOK_URL:
-            # Run with webhook
-            self.application.run_webhook(
-                listen="0.0.0.0",
-                port=settings.WEBHOOK_PORT,
-                webhook_url=settings.WEBHOOK_URL
-            )
-        else:
-            # Run with polling
-            self.application.run_polling(
-                drop_pending_updates=True,
-                allowed_updates=["message", "callback_query"]
-            )
+        if not polling and not settings.WEBHOOK_URL:
+            raise ValueError("WEBHOOK_URL must be set for webhook mode (use --polling to long-poll instead)")
+        
+        try:
+            if polling:
+                logger.info("🔁 Running with long-polling")
+                self.application.run_polling(
+                    drop_pending_updates=True,
+                    allowed_updates=["message", "callback_query"]
+                )
+            else:
+                # Telegram pushes updates to a secret path derived from the bot token
+                self.application.run_webhook(
+                    listen="0.0.0.0",
+                    port=settings.WEBHOOK_PORT,
+                    url_path=settings.TELEGRAM_BOT_TOKEN,
+                    webhook_url=f"{settings.WEBHOOK_URL.rstrip('/')}/{settings.TELEGRAM_BOT_TOKEN}",
+                    secret_token=settings.WEBHOOK_SECRET,
+                    drop_pending_updates=True,
+                    allowed_updates=["message", "callback_query"]
+                )
+        finally:
+            self.handlers.shutdown()
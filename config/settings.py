@@ -1,5 +1,7 @@
 import os
+from functools import lru_cache
 from typing import Optional
+from pydantic import PrivateAttr
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
@@ -12,6 +14,8 @@ class Settings(BaseSettings):
     TELEGRAM_BOT_TOKEN: str
     WEBHOOK_URL: Optional[str] = None
     WEBHOOK_PORT: int = 8000
+    WEBHOOK_SECRET: Optional[str] = None  # Sent by Telegram in X-Telegram-Bot-Api-Secret-Token
+    TELEGRAM_POOL_SIZE: int = 256  # HTTPX connections for outgoing Bot API calls
     
     # Model Configuration - Easy to change for any HuggingFace model
     MODEL_NAME: str = "microsoft/DialoGPT-medium"  # Default model
@@ -20,8 +24,13 @@ class Settings(BaseSettings):
     
     # Model Performance Settings
     MAX_LENGTH: int = 512
-    BATCH_SIZE: int = 1
+    MAX_INPUT_CHARS: Optional[int] = None  # Defaults to MAX_LENGTH * 4 (~4 chars per token)
+    BATCH_SIZE: int = 8  # Max concurrent requests coalesced into one predict_batch call
+    BATCH_WAIT_MS: int = 10  # How long to wait for a batch to fill
     USE_QUANTIZATION: bool = False  # Enable for large models on limited GPU
+    QUANTIZATION_BITS: int = 4  # 4 (NF4) or 8 (LLM.int8) when USE_QUANTIZATION is enabled
+    USE_COMPILE: bool = False  # torch.compile the decode loop on GPU (slower first load)
+    TRUST_REMOTE_CODE: bool = False  # Run custom modeling/tokenizer code shipped in model repos
     DEVICE: str = "auto"  # auto, cpu, cuda
     
     # Generation Parameters
@@ -43,12 +52,19 @@ class Settings(BaseSettings):
     DB_USER: str = "botuser"
     DB_PASSWORD: str = "botpass"
     DATABASE_URL: Optional[str] = None
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 40
+    DB_POOL_RECYCLE: int = 1800  # Seconds before a pooled connection is replaced
+    AUTO_CREATE_TABLES: bool = False  # Dev only (requires DEBUG); otherwise run python -m database.migrate
+    DB_LOCAL_CACHE_TTL: int = 30  # Seconds a worker trusts its in-process lookup cache (writes elsewhere show up after this)
     
     # Redis Configuration (optional)
+    REDIS_CACHE_ENABLED: bool = False  # Share resource lookups across workers through Redis
     REDIS_HOST: str = "localhost"
     REDIS_PORT: int = 6379
     REDIS_DB: int = 0
     REDIS_PASSWORD: Optional[str] = None
+    REDIS_CACHE_TTL: int = 300  # Seconds resource lookups stay cached in Redis
     
     # AWS Configuration (optional)
     AWS_ACCESS_KEY_ID: Optional[str] = None
@@ -65,6 +81,10 @@ class Settings(BaseSettings):
     MAX_RESPONSE_LENGTH: int = 1000
     ENABLE_LOGGING: bool = True
     RATE_LIMIT_PER_MINUTE: int = 10
+    STREAM_EDIT_INTERVAL: float = 1.0  # Seconds between partial response edits
+    PREDICTION_CACHE_SIZE: int = 512  # Max cached predictions per process (0 disables)
+    PREDICTION_CACHE_PATH: Optional[str] = "/tmp/aid-al/predictions.db"  # SQLite cache shared across restarts
+    PREDICTION_CACHE_TTL: int = 604800  # Seconds (7 days)
     
     # Security
     ALLOWED_USERS: Optional[str] = None  # Comma-separated user IDs
@@ -75,11 +95,17 @@ class Settings(BaseSettings):
     ENABLE_SMART_CONTRACTS: bool = True
     ENABLE_MODEL_INFO_COMMAND: bool = True
     ENABLE_METRICS: bool = False
+    SHOW_FOLLOWUP_BUTTONS: bool = True  # Attach quick action buttons to AI responses
+    STREAM_RESPONSES: bool = True  # Edit the reply with partial text while generating
     
     # Monitoring
     METRICS_PORT: int = 9090
     HEALTH_CHECK_PORT: int = 8001
     
+    # Parsed once from ALLOWED_USERS / ADMIN_USERS for O(1) membership checks
+    _allowed_user_ids: frozenset = PrivateAttr(default=frozenset())
+    _admin_user_ids: frozenset = PrivateAttr(default=frozenset())
+    
     class Config:
         env_file = ".env"
         case_sensitive = True
@@ -91,6 +117,14 @@ class Settings(BaseSettings):
         if not self.DATABASE_URL:
             self.DATABASE_URL = f"postgresql://{self.DB_USER}:{self.DB_PASSWORD}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}"
         
+        if not self.MAX_INPUT_CHARS:
+            self.MAX_INPUT_CHARS = self.MAX_LENGTH * 4
+        
+        self._allowed_user_ids = self._parse_user_ids(self.ALLOWED_USERS)
+        self._admin_user_ids = self._parse_user_ids(self.ADMIN_USERS)
+    
+    def _prepare_env(self):
+        """Create HuggingFace cache directories and export their environment variables"""
         # Create cache directories
         os.makedirs(self.TRANSFORMERS_CACHE, exist_ok=True)
         os.makedirs(self.HF_HOME, exist_ok=True)
@@ -102,29 +136,31 @@ class Settings(BaseSettings):
         if self.HF_TOKEN:
             os.environ["HF_TOKEN"] = self.HF_TOKEN
     
+    @staticmethod
+    def _parse_user_ids(value: Optional[str]) -> frozenset:
+        """Parse a comma-separated list of user IDs"""
+        if not value:
+            return frozenset()
+        return frozenset(int(uid.strip()) for uid in value.split(",") if uid.strip())
+    
     @property
-    def allowed_user_ids(self) -> list:
-        """Get list of allowed user IDs"""
-        if not self.ALLOWED_USERS:
-            return []
-        return [int(uid.strip()) for uid in self.ALLOWED_USERS.split(",") if uid.strip()]
+    def allowed_user_ids(self) -> frozenset:
+        """Get set of allowed user IDs"""
+        return self._allowed_user_ids
     
     @property
-    def admin_user_ids(self) -> list:
-        """Get list of admin user IDs"""
-        if not self.ADMIN_USERS:
-            return []
-        return [int(uid.strip()) for uid in self.ADMIN_USERS.split(",") if uid.strip()]
+    def admin_user_ids(self) -> frozenset:
+        """Get set of admin user IDs"""
+        return self._admin_user_ids
     
     def is_user_allowed(self, user_id: int) -> bool:
         """Check if user is allowed to use the bot"""
-        if not self.allowed_user_ids:  # If no restrictions, allow all
-            return True
-        return user_id in self.allowed_user_ids
+        # If no restrictions, allow all
+        return not self._allowed_user_ids or user_id in self._allowed_user_ids
     
     def is_admin_user(self, user_id: int) -> bool:
         """Check if user is an admin"""
-        return user_id in self.admin_user_ids
+        return user_id in self._admin_user_ids
     
     def get_model_config(self) -> dict:
         """Get model configuration dictionary"""
@@ -138,9 +174,21 @@ class Settings(BaseSettings):
             "repetition_penalty": self.REPETITION_PENALTY,
             "do_sample": self.DO_SAMPLE,
             "use_quantization": self.USE_QUANTIZATION,
+            "quantization_bits": self.QUANTIZATION_BITS,
             "device": self.DEVICE,
             "batch_size": self.BATCH_SIZE
         }
 
-# Create global settings instance
-settings = Settings()
+@lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    """Build the process-wide settings on first use"""
+    settings = Settings()
+    settings._prepare_env()
+    return settings
+
+def __getattr__(name: str):
+    # Keep `from config.settings import settings` working without building it at import time
+    if name == "settings":
+        return get_settings()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
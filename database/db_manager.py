@@ -1,61 +1,259 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import bindparam, func, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.exc import SQLAlchemyError
-from typing import Optional, List
-from .models import Base, URLResource, SmartContract
-from config.settings import settings
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, Optional, List
+from .models import Base, URLResource, SmartContract, URLResourceRow, SmartContractRow
+from config.settings import get_settings
+import asyncio
+import json
+import logging
+import time
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+# Core statements for the by-name lookups; compiled once and executed without an ORM session
+_SELECT_URL_RESOURCE = select(
+    URLResource.id, URLResource.name, URLResource.url, URLResource.description
+).where(URLResource.name == bindparam("name"))
+
+_SELECT_SMART_CONTRACT = select(
+    SmartContract.id, SmartContract.name, SmartContract.address, SmartContract.network, SmartContract.description
+).where(SmartContract.name == bindparam("name"))
+
+def _async_database_url(url: str) -> str:
+    """Point a postgresql:// URL at the asyncpg driver"""
+    scheme, sep, rest = url.partition("://")
+    if scheme in ("postgresql", "postgres", "postgresql+psycopg2"):
+        return f"postgresql+asyncpg{sep}{rest}"
+    return url
 
 class DatabaseManager:
-    def __init__(self):
-        self.engine = create_engine(settings.DATABASE_URL)
-        Base.metadata.create_all(bind=self.engine)
-        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+    def __init__(self, cache_size: int = 512):
+        settings = get_settings()
+        self.engine = create_async_engine(
+            _async_database_url(settings.DATABASE_URL),
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_pre_ping=True,
+            pool_recycle=settings.DB_POOL_RECYCLE
+        )
+        self.SessionLocal = async_sessionmaker(self.engine, expire_on_commit=False, autoflush=False)
+        # The schema is normally created by the migrate step, not by bot workers
+        self._schema_ready = not (settings.DEBUG and settings.AUTO_CREATE_TABLES)
+        self._schema_lock = asyncio.Lock()
+        
+        # Reads are cached until the next local write, and for at most cache_ttl seconds so writes
+        # made by other workers (which only invalidate Redis) are picked up
+        self.cache_size = cache_size
+        self.cache_ttl = settings.DB_LOCAL_CACHE_TTL
+        self._url_resource_cache = OrderedDict()
+        self._smart_contract_cache = OrderedDict()
+        self._resource_search_cache = OrderedDict()
+        self._contract_search_cache = OrderedDict()
+        
+        # Shared read-through cache for by-name lookups across processes (opt-in: without a Redis
+        # server every miss would pay the connect timeout)
+        self.redis = None
+        if settings.REDIS_CACHE_ENABLED and aioredis is not None:
+            self.redis = aioredis.Redis(
+                host=settings.REDIS_HOST,
+                port=settings.REDIS_PORT,
+                db=settings.REDIS_DB,
+                password=settings.REDIS_PASSWORD,
+                socket_connect_timeout=0.5,
+                socket_timeout=0.5
+            )
     
-    def get_db(self) -> Session:
-        db = self.SessionLocal()
-        try:
+    async def create_schema(self):
+        """Create the pg_trgm extension and all tables (run via python -m database.migrate)"""
+        async with self.engine.begin() as conn:
+            # Trigram indexes back the ilike searches and need the pg_trgm extension
+            if self.engine.dialect.name == "postgresql":
+                await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            await conn.run_sync(Base.metadata.create_all)
+    
+    async def init_schema(self):
+        """Create the schema once on first use when AUTO_CREATE_TABLES is enabled in DEBUG"""
+        if self._schema_ready:
+            return
+        
+        async with self._schema_lock:
+            if self._schema_ready:
+                return
+            
+            await self.create_schema()
+            self._schema_ready = True
+    
+    async def get_db(self) -> AsyncSession:
+        await self.init_schema()
+        async with self.SessionLocal() as db:
             yield db
-        finally:
-            db.close()
     
-    def add_url_resource(self, name: str, url: str, description: str = None) -> bool:
+    async def _cached(self, cache: OrderedDict, key: Any, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """Return cache[key], loading and storing it (LRU-evicted, expiring after cache_ttl) on miss"""
+        entry = cache.get(key, _MISSING)
+        if entry is not _MISSING and entry[0] > time.monotonic():
+            cache.move_to_end(key)
+            return entry[1]
+        
+        await self.init_schema()
+        result = await loader()
+        
+        cache[key] = (time.monotonic() + self.cache_ttl, result)
+        cache.move_to_end(key)
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return result
+    
+    async def _read_through(self, key: str, row_type: type, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """Fetch a row_type row from Redis, falling back to loader and populating Redis on a miss"""
+        if self.redis is not None:
+            try:
+                blob = await self.redis.get(key)
+                if blob is not None:
+                    # JSON rather than pickle: whoever can write to Redis must not be able to run code here
+                    return row_type(**json.loads(blob))
+            except Exception as e:
+                logger.warning(f"⚠️ Redis read failed for {key}: {e}")
+        
+        result = await loader()
+        
+        if result is not None and self.redis is not None:
+            try:
+                await self.redis.setex(key, get_settings().REDIS_CACHE_TTL, json.dumps(result._asdict()))
+            except Exception as e:
+                logger.warning(f"⚠️ Redis write failed for {key}: {e}")
+        return result
+    
+    async def _redis_delete(self, key: str):
+        if self.redis is None:
+            return
         try:
-            with self.SessionLocal() as db:
-                resource = URLResource(name=name, url=url, description=description)
-                db.add(resource)
-                db.commit()
-                return True
-        except SQLAlchemyError:
-            return False
-    
-    def get_url_resource(self, name: str) -> Optional[URLResource]:
-        with self.SessionLocal() as db:
-            return db.query(URLResource).filter(URLResource.name == name).first()
-    
-    def add_smart_contract(self, name: str, address: str, network: str = None, description: str = None) -> bool:
+            await self.redis.delete(key)
+        except Exception as e:
+            logger.warning(f"⚠️ Redis delete failed for {key}: {e}")
+    
+    async def _upsert(self, model, rows: List[Dict[str, Any]], columns: List[str]) -> int:
+        """INSERT ... ON CONFLICT (name) DO UPDATE for rows in a single statement"""
+        await self.init_schema()
+        if not rows:
+            return 0
+        
+        stmt = pg_insert(model).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[model.name],
+            set_={**{column: stmt.excluded[column] for column in columns}, "updated_at": func.now()}
+        )
+        
         try:
-            with self.SessionLocal() as db:
-                contract = SmartContract(name=name, address=address, network=network, description=description)
-                db.add(contract)
-                db.commit()
-                return True
-        except SQLAlchemyError:
-            return False
-    
-    def get_smart_contract(self, name: str) -> Optional[SmartContract]:
-        with self.SessionLocal() as db:
-            return db.query(SmartContract).filter(SmartContract.name == name).first()
-    
-    def search_resources(self, query: str) -> List[URLResource]:
-        with self.SessionLocal() as db:
-            return db.query(URLResource).filter(
-                URLResource.name.ilike(f"%{query}%") | 
+            async with self.SessionLocal() as db:
+                await db.execute(stmt)
+                await db.commit()
+        except SQLAlchemyError as e:
+            logger.error(f"❌ Upsert into {model.__tablename__} failed: {e}")
+            return 0
+        
+        return len(rows)
+    
+    async def add_url_resources(self, rows: List[Dict[str, Any]]) -> int:
+        """Insert or update URL resources by name; returns the number of rows written"""
+        rows = [
+            {"name": row["name"], "url": row["url"], "description": row.get("description")}
+            for row in rows
+        ]
+        written = await self._upsert(URLResource, rows, ["url", "description"])
+        
+        if written:
+            self._url_resource_cache.clear()
+            self._resource_search_cache.clear()
+            for row in rows:
+                await self._redis_delete(f"url:{row['name']}")
+        return written
+    
+    async def add_url_resource(self, name: str, url: str, description: str = None) -> bool:
+        return await self.add_url_resources([dict(name=name, url=url, description=description)]) > 0
+    
+    async def get_url_resource(self, name: str) -> Optional[URLResourceRow]:
+        return await self._cached(
+            self._url_resource_cache, name,
+            lambda: self._read_through(f"url:{name}", URLResourceRow, lambda: self._query_url_resource(name))
+        )
+    
+    async def _query_url_resource(self, name: str) -> Optional[URLResourceRow]:
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(_SELECT_URL_RESOURCE, {"name": name})).first()
+        return URLResourceRow(*row) if row else None
+    
+    async def add_smart_contracts(self, rows: List[Dict[str, Any]]) -> int:
+        """Insert or update smart contracts by name; returns the number of rows written"""
+        rows = [
+            {
+                "name": row["name"],
+                "address": row["address"],
+                "network": row.get("network"),
+                "description": row.get("description")
+            }
+            for row in rows
+        ]
+        written = await self._upsert(SmartContract, rows, ["address", "network", "description"])
+        
+        if written:
+            self._smart_contract_cache.clear()
+            self._contract_search_cache.clear()
+            for row in rows:
+                await self._redis_delete(f"contract:{row['name']}")
+        return written
+    
+    async def add_smart_contract(self, name: str, address: str, network: str = None, description: str = None) -> bool:
+        return await self.add_smart_contracts(
+            [dict(name=name, address=address, network=network, description=description)]
+        ) > 0
+    
+    async def get_smart_contract(self, name: str) -> Optional[SmartContractRow]:
+        return await self._cached(
+            self._smart_contract_cache, name,
+            lambda: self._read_through(f"contract:{name}", SmartContractRow, lambda: self._query_smart_contract(name))
+        )
+    
+    async def _query_smart_contract(self, name: str) -> Optional[SmartContractRow]:
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(_SELECT_SMART_CONTRACT, {"name": name})).first()
+        return SmartContractRow(*row) if row else None
+    
+    async def search_resources(self, query: str) -> List[URLResource]:
+        # ilike is case-insensitive, so lowercasing only widens cache hits
+        query = query.lower()
+        return list(await self._cached(self._resource_search_cache, query, lambda: self._query_resources(query)))
+    
+    async def _query_resources(self, query: str) -> tuple:
+        async with self.SessionLocal() as db:
+            return tuple((await db.scalars(select(URLResource).where(
+                URLResource.name.ilike(f"%{query}%") |
                 URLResource.description.ilike(f"%{query}%")
-            ).all()
+            ))).all())
+    
+    async def search_contracts(self, query: str) -> List[SmartContract]:
+        query = query.lower()
+        return list(await self._cached(self._contract_search_cache, query, lambda: self._query_contracts(query)))
     
-    def search_contracts(self, query: str) -> List[SmartContract]:
-        with self.SessionLocal() as db:
-            return db.query(SmartContract).filter(
-                SmartContract.name.ilike(f"%{query}%") | 
+    async def _query_contracts(self, query: str) -> tuple:
+        async with self.SessionLocal() as db:
+            return tuple((await db.scalars(select(SmartContract).where(
+                SmartContract.name.ilike(f"%{query}%") |
                 SmartContract.description.ilike(f"%{query}%")
-            ).all()
\ No newline at end of file
+            ))).all())
+
+@lru_cache(maxsize=None)
+def get_db_manager() -> DatabaseManager:
+    """Return the process-wide DatabaseManager so its engine pool and caches are shared"""
+    return DatabaseManager()
@@ -0,0 +1,36 @@
+"""Create the database schema once, before bot workers start: python -m database.migrate"""
+import asyncio
+import logging
+from sqlalchemy import text
+from .db_manager import DatabaseManager
+
+logger = logging.getLogger(__name__)
+
+# create_all never adds indexes to tables that already exist, so the trigram indexes are also created explicitly
+_TRIGRAM_INDEXES = (
+    ("ix_url_resources_name_trgm", "url_resources", "name"),
+    ("ix_url_resources_description_trgm", "url_resources", "description"),
+    ("ix_smart_contracts_name_trgm", "smart_contracts", "name"),
+    ("ix_smart_contracts_description_trgm", "smart_contracts", "description"),
+)
+
+async def migrate():
+    manager = DatabaseManager()
+    try:
+        await manager.create_schema()
+        if manager.engine.dialect.name == "postgresql":
+            async with manager.engine.begin() as conn:
+                for index, table, column in _TRIGRAM_INDEXES:
+                    await conn.execute(text(
+                        f"CREATE INDEX IF NOT EXISTS {index} ON {table} USING gin ({column} gin_trgm_ops)"
+                    ))
+        logger.info("✅ Database schema is up to date")
+    finally:
+        await manager.engine.dispose()
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    asyncio.run(migrate())
@@ -1,11 +1,20 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text
+from sqlalchemy import Column, Integer, String, DateTime, Text, Index
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
+from typing import NamedTuple, Optional
 
 Base = declarative_base()
 
+def _trigram_index(name: str, column: str) -> Index:
+    """GIN pg_trgm index so ilike '%query%' searches don't full-scan"""
+    return Index(name, column, postgresql_using="gin", postgresql_ops={column: "gin_trgm_ops"})
+
 class URLResource(Base):
     __tablename__ = "url_resources"
+    __table_args__ = (
+        _trigram_index("ix_url_resources_name_trgm", "name"),
+        _trigram_index("ix_url_resources_description_trgm", "description"),
+    )
     
     id = Column(Integer, primary_key=True)
     name = Column(String(255), unique=True, index=True)
@@ -16,6 +25,10 @@ class URLResource(Base):
 
 class SmartContract(Base):
     __tablename__ = "smart_contracts"
+    __table_args__ = (
+        _trigram_index("ix_smart_contracts_name_trgm", "name"),
+        _trigram_index("ix_smart_contracts_description_trgm", "description"),
+    )
     
     id = Column(Integer, primary_key=True)
     name = Column(String(255), unique=True, index=True)
@@ -23,4 +36,19 @@ class SmartContract(Base):
     network = Column(String(100))
     description = Column(Text)
     created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
\ No newline at end of file
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class URLResourceRow(NamedTuple):
+    """Lightweight, session-free view of a URLResource for read paths"""
+    id: int
+    name: str
+    url: str
+    description: Optional[str]
+
+class SmartContractRow(NamedTuple):
+    """Lightweight, session-free view of a SmartContract for read paths"""
+    id: int
+    name: str
+    address: str
+    network: Optional[str]
+    description: Optional[str]
@@ -1,6 +1,6 @@
 import logging
+import sys
 from bot.telegram_bot_minimal import TelegramBotMinimal
-from config.settings import settings
 
 # Configure logging
 logging.basicConfig(
@@ -12,7 +12,7 @@ def main():
     """Main application entry point for minimal bot"""
     try:
         bot = TelegramBotMinimal()
-        bot.run()
+        bot.run(polling="--polling" in sys.argv[1:])
     except Exception as e:
         logging.error(f"Application error: {e}")
         raise
@@ -1,83 +1,363 @@
 #!/usr/bin/env python3
 """Mistral AI Chatbot - Optimized for Large Models"""
 import os
+import asyncio
+import importlib.util
+import json
 import logging
+import threading
+import httpx
 import torch
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+from telegram.request import HTTPXRequest
+from transformers import (
+    AutoTokenizer, AutoModelForCausalLM, AutoConfig, BitsAndBytesConfig, GPTQConfig,
+    DynamicCache, TextIteratorStreamer
+)
+
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+async def read_frame(reader):
+    """Read one length-prefixed JSON message from a generator socket"""
+    size = int.from_bytes(await reader.readexactly(4), "big")
+    return json.loads(await reader.readexactly(size))
+
+def write_frame(writer, message):
+    """Write one length-prefixed JSON message to a generator socket"""
+    payload = json.dumps(message).encode()
+    writer.write(len(payload).to_bytes(4, "big") + payload)
+
 class MistralChatBot:
     def __init__(self):
         self.token = os.getenv('TELEGRAM_BOT_TOKEN')
         self.model_name = os.getenv('MODEL_NAME', 'Pyzeur/Code-du-Travail-mistral-finetune')
+        # Pre-quantized AWQ/GPTQ checkpoint of the same weights (fused int4 kernels)
+        self.quantized_model_name = os.getenv('QUANTIZED_MODEL_NAME')
+        # FlashAttention-2 when flash-attn is installed on a GPU host, fused SDPA otherwise
+        self.attn_implementation = (
+            "flash_attention_2"
+            if torch.cuda.is_available() and importlib.util.find_spec("flash_attn")
+            else "sdpa"
+        )
+        # One GPU: pin the whole model to it so accelerate adds no per-layer dispatch hooks; shard only across several
+        self.device_map = {"": 0} if torch.cuda.device_count() == 1 else "auto"
+        self.compile_model = os.getenv('TORCH_COMPILE', 'false').lower() == 'true' and torch.cuda.is_available()
+        # OpenAI-compatible vLLM/TGI server; when set the bot does no local inference
+        self.vllm_url = os.getenv('VLLM_URL')
+        self.vllm_model = os.getenv('VLLM_MODEL', self.model_name)
+        self._http = None
+        # Unix socket of a shared mistral_generator process holding the only copy of the weights
+        self.generator_socket = os.getenv('GENERATOR_SOCKET')
         self.model = None
         self.tokenizer = None
+        self._executor = ThreadPoolExecutor(max_workers=int(os.getenv('MAX_WORKERS', '2')))
+        
+        # Micro-batching: concurrent prompts arriving within the window share one generate() call
+        self.batch_size = max(1, int(os.getenv('BATCH_SIZE', '4')))
+        self.batch_wait = int(os.getenv('BATCH_WAIT_MS', '20')) / 1000
+        self._queue = None
+        self._worker = None
+        
+        # Per-chat KV caches: each turn only prefills the new user text, and replies are streamed
+        self.chat_sessions = os.getenv('CHAT_SESSIONS', 'false').lower() == 'true'
+        self.max_sessions = int(os.getenv('MAX_SESSIONS', '8'))
+        self.max_context_tokens = int(os.getenv('MAX_CONTEXT_TOKENS', '2048'))
+        self._sessions = OrderedDict()  # chat_id -> (token ids so far, DynamicCache)
+        self._sessions_lock = threading.Lock()
+        self._session_locks = OrderedDict()  # chat_id -> asyncio.Lock, bounded like the sessions
         
     async def load_model(self):
         try:
             logger.info(f"Loading Mistral model: {self.model_name}")
             
-            # Configure quantization for memory efficiency
-            quantization_config = BitsAndBytesConfig(
-                load_in_4bit=True,
-                bnb_4bit_compute_dtype=torch.float16,
-                bnb_4bit_use_double_quant=True,
-                bnb_4bit_quant_type="nf4"
-            )
-            
             # Load tokenizer
             logger.info("Loading tokenizer...")
             self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
             if self.tokenizer.pad_token is None:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
+            # Decoder-only models must be left-padded for batched generation
+            self.tokenizer.padding_side = "left"
             
-            # Load model with quantization
-            logger.info("Loading model with 4-bit quantization...")
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_name,
-                quantization_config=quantization_config,
-                device_map="auto",
-                torch_dtype=torch.float16,
-                low_cpu_mem_usage=True
-            )
+            self.model = None
+            if self.quantized_model_name:
+                self.model = self._load_prequantized_model()
             
-            logger.info("✅ Mistral model loaded successfully")
+            if self.model is None:
+                # Load model with bitsandbytes quantization
+                logger.info("Loading model with 4-bit quantization...")
+                quantization_config = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_compute_dtype=torch.float16,
+                    bnb_4bit_use_double_quant=True,
+                    bnb_4bit_quant_type="nf4"
+                )
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    self.model_name,
+                    quantization_config=quantization_config,
+                    device_map=self.device_map,
+                    torch_dtype=torch.float16,
+                    low_cpu_mem_usage=True,
+                    attn_implementation=self.attn_implementation
+                )
+            
+            # Session turns extend a growing DynamicCache, which CUDA graphs cannot replay
+            if self.compile_model and not self.chat_sessions:
+                self._compile_model()
+            
+            logger.info(f"✅ Mistral model loaded successfully (attention: {self.attn_implementation})")
+            
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._batch_worker())
             
         except Exception as e:
             logger.error(f"❌ Error loading model: {e}")
             raise
     
+    def _compile_model(self):
+        """Compile the forward pass over a static KV cache and pay the compile cost before the first request"""
+        eager_forward = self.model.forward
+        try:
+            # CUDA graphs need fixed decode shapes: a static KV cache instead of one that grows every token
+            if getattr(self.model, "_supports_static_cache", False):
+                self.model.generation_config.cache_implementation = "static"
+            self.model.forward = torch.compile(self.model.forward, mode="reduce-overhead", fullgraph=False)
+            warmup = self.tokenizer("warmup", return_tensors="pt").to(self.model.device)
+            with torch.inference_mode():
+                self.model.generate(**warmup, max_new_tokens=4, pad_token_id=self.tokenizer.pad_token_id)
+            logger.info("⚡ Model forward compiled with torch.compile")
+        except Exception as e:
+            self.model.forward = eager_forward
+            self.model.generation_config.cache_implementation = None
+            logger.warning(f"⚠️ torch.compile unavailable, running eagerly: {e}")
+    
+    def _load_prequantized_model(self):
+        """Load the AWQ/GPTQ checkpoint, or return None to fall back to bitsandbytes"""
+        try:
+            config = AutoConfig.from_pretrained(self.quantized_model_name)
+            quant_config = getattr(config, "quantization_config", None) or {}
+            quant_method = quant_config.get("quant_method") if isinstance(quant_config, dict) else getattr(quant_config, "quant_method", None)
+            logger.info(f"Loading pre-quantized model ({quant_method}): {self.quantized_model_name}")
+            
+            kwargs = {}
+            if quant_method == "gptq":
+                # Route GPTQ through the ExLlamaV2 kernels
+                kwargs["quantization_config"] = GPTQConfig(bits=4, use_exllama=True, exllama_config={"version": 2})
+            
+            return AutoModelForCausalLM.from_pretrained(
+                self.quantized_model_name,
+                device_map=self.device_map,
+                torch_dtype=torch.float16,
+                low_cpu_mem_usage=True,
+                attn_implementation=self.attn_implementation,
+                **kwargs
+            )
+            
+        except Exception as e:
+            logger.warning(f"⚠️ Pre-quantized model unavailable, falling back to bitsandbytes: {e}")
+            return None
+    
+    @staticmethod
+    def _instruction(prompt):
+        """Mistral Instruct wrapper, shared by the batched, remote and per-chat paths"""
+        return f"[INST] {prompt} [/INST]"
+    
     async def generate_response(self, prompt):
+        """Generate via the inference server if configured, else queue for the local batch worker"""
+        if self._http is not None:
+            return await self._remote_generate(prompt)
+        if self.generator_socket:
+            return await self._socket_generate(prompt)
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, future))
+        return await future
+    
+    async def _socket_generate(self, prompt):
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.generator_socket)
+            try:
+                write_frame(writer, {"prompt": prompt})
+                await writer.drain()
+                return (await read_frame(reader))["response"]
+            finally:
+                writer.close()
+            
+        except Exception as e:
+            logger.error(f"❌ Error generating response: {e}")
+            return "Désolé, une erreur s'est produite."
+    
+    async def _remote_generate(self, prompt):
+        try:
+            response = await self._http.post("/v1/completions", json={
+                "model": self.vllm_model,
+                "prompt": self._instruction(prompt),
+                "max_tokens": 50,
+                "temperature": 0.7
+            })
+            response.raise_for_status()
+            text = response.json()["choices"][0]["text"].strip()
+            
+            return text or "Je ne suis pas sûr de la réponse."
+            
+        except Exception as e:
+            logger.error(f"❌ Error generating response: {e}")
+            return "Désolé, une erreur s'est produite."
+    
+    async def _batch_worker(self):
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_wait
+            
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            
+            prompts = [prompt for prompt, _ in batch]
+            if len(prompts) > 1:
+                logger.info(f"Generating batch of {len(prompts)} prompts")
+            
+            responses = await loop.run_in_executor(self._executor, self._generate_batch, prompts)
+            
+            for (_, future), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
+    
+    def _generate_batch(self, prompts):
         try:
-            # Prepare input
-            inputs = self.tokenizer.encode(prompt, return_tensors="pt")
+            # Prepare padded inputs
+            inputs = self.tokenizer([self._instruction(prompt) for prompt in prompts], return_tensors="pt", padding=True, truncation=True)
+            inputs = inputs.to(self.model.device)
             
-            # Generate response
-            with torch.no_grad():
+            # Generate responses for the whole batch at once
+            with torch.inference_mode():
                 outputs = self.model.generate(
-                    inputs,
+                    **inputs,
                     max_new_tokens=50,
                     temperature=0.7,
                     do_sample=True,
-                    pad_token_id=self.tokenizer.eos_token_id
+                    pad_token_id=self.tokenizer.pad_token_id
                 )
             
-            # Decode response
-            response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+            # Decode only the generated tokens, dropping the (left-padded) prompt
+            generated = outputs[:, inputs["input_ids"].shape[1]:]
+            responses = self.tokenizer.batch_decode(generated, skip_special_tokens=True)
             
-            # Remove the input prompt from response
-            if response.startswith(prompt):
-                response = response[len(prompt):].strip()
+            return [response.strip() or "Je ne suis pas sûr de la réponse." for response in responses]
             
+        except Exception as e:
+            logger.error(f"❌ Error generating response: {e}")
+            return ["Désolé, une erreur s'est produite."] * len(prompts)
+    
+    def _generate_session(self, chat_id, prompt, streamer):
+        """Generate the next turn of a chat, reusing the KV cache of its previous turns"""
+        try:
+            with self._sessions_lock:
+                input_ids, cache = self._sessions.pop(chat_id, (None, None))
+            
+            if input_ids is None or input_ids.shape[1] >= self.max_context_tokens:
+                # Start a fresh conversation
+                input_ids = self.tokenizer(self._instruction(prompt), return_tensors="pt").input_ids
+                cache = DynamicCache()
+            else:
+                turn_ids = self.tokenizer(
+                    " " + self._instruction(prompt), return_tensors="pt", add_special_tokens=False
+                ).input_ids
+                input_ids = torch.cat([input_ids, turn_ids.to(input_ids.device)], dim=-1)
+            
+            input_ids = input_ids.to(self.model.device)
+            
+            # Only the tokens not already in the cache are prefilled
+            with torch.inference_mode():
+                outputs = self.model.generate(
+                    input_ids=input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    past_key_values=cache,
+                    use_cache=True,
+                    max_new_tokens=50,
+                    temperature=0.7,
+                    do_sample=True,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    streamer=streamer
+                )
+            
+            # generate() extends the cache in place; keep it alongside the full token history
+            with self._sessions_lock:
+                self._sessions[chat_id] = (outputs, cache)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            
+            response = self.tokenizer.decode(outputs[0, input_ids.shape[1]:], skip_special_tokens=True).strip()
             return response or "Je ne suis pas sûr de la réponse."
             
         except Exception as e:
             logger.error(f"❌ Error generating response: {e}")
+            streamer.end()
             return "Désolé, une erreur s'est produite."
     
+    def _session_lock(self, chat_id):
+        """Per-chat lock in an LRU as large as the session cache; locks still held are never evicted"""
+        lock = self._session_locks.get(chat_id)
+        if lock is None:
+            lock = self._session_locks[chat_id] = asyncio.Lock()
+        self._session_locks.move_to_end(chat_id)
+        
+        idle = [cid for cid, other in self._session_locks.items() if cid != chat_id and not other.locked()]
+        for cid in idle[:max(0, len(self._session_locks) - self.max_sessions)]:
+            del self._session_locks[cid]
+        return lock
+    
+    async def _stream_session_reply(self, update, prompt):
+        """Stream a session reply into a single message, editing it as tokens arrive"""
+        chat_id = update.effective_chat.id
+        lock = self._session_lock(chat_id)
+        
+        async with lock:
+            loop = asyncio.get_running_loop()
+            streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+            generation = loop.run_in_executor(self._executor, self._generate_session, chat_id, prompt, streamer)
+            
+            message = None
+            partial = ""
+            chunks = 0
+            
+            while True:
+                chunk = await loop.run_in_executor(None, next, streamer, None)
+                if chunk is None:
+                    break
+                
+                partial += chunk
+                chunks += 1
+                if chunks % 20 == 0 and partial.strip():
+                    if message is None:
+                        message = await update.message.reply_text(partial + " ▌")
+                    else:
+                        await message.edit_text(partial + " ▌")
+            
+            response = await generation
+            
+            if message is None:
+                await update.message.reply_text(response)
+            else:
+                await message.edit_text(response)
+            
+            return response
+    
     async def start_command(self, update, context):
         await update.message.reply_text(
             f"🤖 Bonjour! Je suis votre assistant IA spécialisé en droit du travail.\n"
@@ -96,10 +376,19 @@ class MistralChatBot:
         await update.message.reply_text(info_text)
     
     async def chat_message(self, update, context):
+        # Return immediately so the webhook is acked; generation runs in the background
+        context.application.create_task(self._handle(update, context), update=update)
+    
+    async def _handle(self, update, context):
         try:
             user_message = update.message.text
             logger.info(f"User: {user_message}")
             
+            if self.chat_sessions and self.model is not None:
+                response = await self._stream_session_reply(update, user_message)
+                logger.info(f"Bot: {response}")
+                return
+            
             response = await self.generate_response(user_message)
             logger.info(f"Bot: {response}")
             
@@ -110,9 +399,27 @@ class MistralChatBot:
             await update.message.reply_text("Désolé, veuillez réessayer.")
     
     async def run(self):
-        await self.load_model()
+        if self.vllm_url:
+            logger.info(f"Using inference server at {self.vllm_url}")
+            self._http = httpx.AsyncClient(base_url=self.vllm_url.rstrip('/'), timeout=120)
+        elif self.generator_socket:
+            logger.info(f"Using generator process at {self.generator_socket}")
+        else:
+            await self.load_model()
         
-        self.app = Application.builder().token(self.token).build()
+        self.app = (
+            Application.builder()
+            .token(self.token)
+            .request(HTTPXRequest(
+                connection_pool_size=int(os.getenv('TELEGRAM_POOL_SIZE', '256')),
+                read_timeout=60,
+                write_timeout=60,
+                connect_timeout=10,
+                pool_timeout=5
+            ))
+            .get_updates_request(HTTPXRequest(connection_pool_size=32, read_timeout=70))
+            .build()
+        )
         
         self.app.add_handler(CommandHandler("start", self.start_command))
         self.app.add_handler(CommandHandler("info", self.info_command))
@@ -127,6 +434,5 @@ class MistralChatBot:
         await self.app.updater.idle()
 
 if __name__ == "__main__":
-    import asyncio
     bot = MistralChatBot()
     asyncio.run(bot.run())
@@ -1,19 +1,63 @@
 #!/usr/bin/env python3
 """Fixed Mistral AI Chatbot with Token Support"""
 import os
+import sys
+import gc
+import signal
+import asyncio
+import importlib.util
 import logging
 import torch
+from concurrent.futures import ThreadPoolExecutor
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 from huggingface_hub import login
 
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Global variables
 model = None
 tokenizer = None
+executor = ThreadPoolExecutor(max_workers=int(os.getenv('MAX_WORKERS', '2')))
 model_name = os.getenv('MODEL_NAME', 'Pyzeur/Code-du-Travail-mistral-finetune')
 
+# FlashAttention-2 when flash-attn is installed on a GPU host, fused SDPA otherwise
+ATTN_IMPLEMENTATION = (
+    "flash_attention_2"
+    if torch.cuda.is_available() and importlib.util.find_spec("flash_attn")
+    else "sdpa"
+)
+
+# One GPU: pin the whole model to it so accelerate adds no per-layer dispatch hooks; shard only across several
+DEVICE_MAP = {"": 0} if torch.cuda.device_count() == 1 else "auto"
+
+def _cpu_supports_bf16():
+    """Native BF16 (AVX512-BF16 or AMX) matmuls on this CPU"""
+    checks = ("_is_avx512_bf16_supported", "_is_amx_tile_supported")
+    return any(getattr(torch.cpu, name, lambda: False)() for name in checks)
+
+def _load_openvino_int8(hf_token):
+    """Export to OpenVINO with int8 weights when optimum-intel is installed"""
+    global model
+    try:
+        from optimum.intel import OVModelForCausalLM
+    except ImportError:
+        return False
+    
+    try:
+        logger.info("🔧 Exporting to OpenVINO with int8 weight compression...")
+        model = OVModelForCausalLM.from_pretrained(model_name, export=True, load_in_8bit=True, token=hf_token)
+        return True
+    except Exception as e:
+        logger.warning(f"⚠️ OpenVINO export failed, using PyTorch: {e}")
+        return False
+
 def load_model():
     global model, tokenizer
     try:
@@ -25,71 +69,60 @@ def load_model():
             logger.info("🔑 Logging in to HuggingFace...")
             login(token=hf_token)
         
-        # Method 1: Try with transformers pipeline
-        try:
-            from transformers import pipeline
-            logger.info("📝 Attempting pipeline approach...")
-            
-            model = pipeline(
-                "text-generation",
-                model=model_name,
-                device_map="cpu",
-                torch_dtype=torch.float16,
-                trust_remote_code=True,
-                token=hf_token
-            )
-            logger.info("✅ Pipeline approach successful!")
+        from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+        
+        device = os.getenv('DEVICE', 'auto')
+        if device == 'auto':
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        # int8 is on by default for CPU, where it halves memory traffic per decode step
+        use_quantization = os.getenv('USE_QUANTIZATION', 'true' if device == 'cpu' else 'false').lower() == 'true'
+        
+        # Load tokenizer
+        tokenizer = AutoTokenizer.from_pretrained(model_name, token=hf_token, trust_remote_code=True)
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        
+        if device == 'cpu' and use_quantization and _load_openvino_int8(hf_token):
+            logger.info("✅ Model loaded successfully!")
             return True
-            
-        except Exception as e1:
-            logger.error(f"❌ Pipeline failed: {e1}")
-            
-            # Method 2: Manual loading
-            try:
-                from transformers import AutoModelForCausalLM, AutoTokenizer
-                logger.info("🔧 Attempting manual loading...")
-                
-                # Load tokenizer
-                tokenizer = AutoTokenizer.from_pretrained(
-                    model_name,
-                    token=hf_token,
-                    trust_remote_code=True
-                )
-                if tokenizer.pad_token is None:
-                    tokenizer.pad_token = tokenizer.eos_token
-                
-                # Load model
-                model = AutoModelForCausalLM.from_pretrained(
-                    model_name,
-                    torch_dtype=torch.float16,
-                    device_map="cpu",
-                    trust_remote_code=True,
-                    token=hf_token,
-                    low_cpu_mem_usage=True
+        
+        load_kwargs = dict(
+            token=hf_token, trust_remote_code=True, low_cpu_mem_usage=True, attn_implementation=ATTN_IMPLEMENTATION
+        )
+        
+        if device == 'cuda':
+            load_kwargs.update(device_map=DEVICE_MAP, torch_dtype=torch.float16)
+            if use_quantization:
+                load_kwargs["quantization_config"] = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_compute_dtype=torch.float16,
+                    bnb_4bit_quant_type="nf4"
                 )
-                logger.info("✅ Manual loading successful!")
-                return True
-                
-            except Exception as e2:
-                logger.error(f"❌ Manual loading failed: {e2}")
-                
-                # Method 3: Fallback to base model
+        else:
+            # CPU fp16 has no hardware path on x86; int8 needs fp32 weights, else bf16 where native
+            cpu_bf16 = not use_quantization and _cpu_supports_bf16()
+            load_kwargs.update(device_map="cpu", torch_dtype=torch.bfloat16 if cpu_bf16 else torch.float32)
+        
+        logger.info(f"🔧 Loading on {device} ({load_kwargs['torch_dtype']}, quantization={use_quantization})")
+        model = AutoModelForCausalLM.from_pretrained(model_name, **load_kwargs)
+        model.eval()
+        
+        if device == 'cpu':
+            if use_quantization:
+                # Dynamic int8 Linear layers hit the VNNI int8 GEMM paths
+                model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                logger.info("⚡ Dynamic int8 quantization applied")
+            elif cpu_bf16:
                 try:
-                    logger.info("🔄 Falling back to base Mistral model...")
-                    from transformers import pipeline
-                    model = pipeline(
-                        "text-generation",
-                        model="mistralai/Mistral-7B-Instruct-v0.1",
-                        device_map="cpu",
-                        torch_dtype=torch.float16
-                    )
-                    logger.info("✅ Base model fallback successful!")
-                    return True
-                    
-                except Exception as e3:
-                    logger.error(f"❌ All methods failed: {e3}")
-                    raise Exception("Could not load any model")
-                    
+                    import intel_extension_for_pytorch as ipex
+                    model = ipex.llm.optimize(model, dtype=torch.bfloat16)
+                    logger.info("⚡ IPEX BF16 optimizations applied")
+                except ImportError:
+                    pass
+        
+        logger.info("✅ Model loaded successfully!")
+        return True
+        
     except Exception as e:
         logger.error(f"❌ Fatal error loading model: {e}")
         raise
@@ -97,33 +130,21 @@ def load_model():
 def generate_response(user_input):
     global model, tokenizer
     try:
-        if hasattr(model, '__call__'):  # Pipeline approach
-            prompt = f"<s>[INST] {user_input} [/INST]"
-            result = model(
-                prompt,
+        prompt = f"<s>[INST] {user_input} [/INST]"
+        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+        
+        with torch.inference_mode():
+            outputs = model.generate(
+                **inputs,
                 max_new_tokens=150,
                 temperature=0.7,
                 do_sample=True,
-                return_full_text=False
+                pad_token_id=tokenizer.eos_token_id
             )
-            response = result[0]['generated_text'].strip()
-            
-        else:  # Manual approach
-            prompt = f"<s>[INST] {user_input} [/INST]"
-            inputs = tokenizer(prompt, return_tensors="pt")
-            
-            with torch.no_grad():
-                outputs = model.generate(
-                    **inputs,
-                    max_new_tokens=150,
-                    temperature=0.7,
-                    do_sample=True,
-                    pad_token_id=tokenizer.eos_token_id
-                )
-            
-            response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-            if prompt in response:
-                response = response.replace(prompt, "").strip()
+        
+        # Decode only the newly generated tokens
+        input_len = inputs["input_ids"].shape[-1]
+        response = tokenizer.decode(outputs[0, input_len:], skip_special_tokens=True).strip()
         
         return response or "Je ne peux pas répondre à cette question."
         
@@ -156,6 +177,10 @@ async def info_command(update, context):
     await update.message.reply_text(info_text)
 
 async def chat_message(update, context):
+    # Return immediately so the webhook is acked; generation runs in the background
+    context.application.create_task(handle_chat(update, context), update=update)
+
+async def handle_chat(update, context):
     try:
         user_message = update.message.text
         logger.info(f"👤 Question: {user_message}")
@@ -163,8 +188,10 @@ async def chat_message(update, context):
         # Show typing
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
         
-        # Generate AI response
-        response = generate_response(user_message)
+        # Generate AI response off the event loop
+        response = await asyncio.get_running_loop().run_in_executor(
+            executor, generate_response, user_message
+        )
         
         logger.info(f"🤖 Réponse IA: {response}")
         await update.message.reply_text(response)
@@ -176,6 +203,7 @@ async def chat_message(update, context):
         )
 
 def main():
+    global model, tokenizer
     try:
         logger.info("🚀 Initializing Mistral Legal AI...")
         
@@ -193,15 +221,36 @@ def main():
         logger.info("✅ Mistral Legal AI ready!")
         logger.info("📱 Starting Telegram service...")
         
-        # Run bot
-        app.run_polling()
+        # Run bot: webhook when WEBHOOK_URL is set, long-polling otherwise
+        webhook_url = os.getenv('WEBHOOK_URL')
+        if webhook_url:
+            token = os.getenv('TELEGRAM_BOT_TOKEN')
+            app.run_webhook(
+                listen="0.0.0.0",
+                port=int(os.getenv('WEBHOOK_PORT', '8000')),
+                url_path=token,
+                webhook_url=f"{webhook_url.rstrip('/')}/{token}",
+                secret_token=os.getenv('WEBHOOK_SECRET'),
+                drop_pending_updates=True,
+                allowed_updates=["message", "callback_query"]
+            )
+        else:
+            app.run_polling()
         
     except Exception as e:
         logger.error(f"❌ Startup failed: {e}")
-        logger.info("🔄 Container staying alive...")
-        import time
-        while True:
-            time.sleep(60)
+        
+        # Release whatever was loaded before exiting so the restart policy can take over
+        model = tokenizer = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        
+        if os.getenv('KEEP_ALIVE_ON_FAIL'):
+            logger.info("🔄 Container staying alive for debugging...")
+            signal.pause()
+        
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -1,10 +1,22 @@
 #!/usr/bin/env python3
 """Minimal Working Mistral Bot"""
 import os
+import re
+import sys
 import logging
-import time
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -16,12 +28,26 @@ responses = {
     "default": "Je suis spécialisé en droit du travail français. Posez-moi vos questions sur les licenciements, congés, préavis, etc."
 }
 
+# All topic keywords in one case-insensitive alternation, matched in a single scan
+_TOPICS = {key.lower(): response for key, response in responses.items() if key != "default"}
+_TOPIC_PATTERN = re.compile("|".join(map(re.escape, _TOPICS)), re.IGNORECASE)
+
+# Aho-Corasick automaton (pyahocorasick): one linear pass over the message whatever the keyword count
+_AUTOMATON = None
+if ahocorasick is not None:
+    _AUTOMATON = ahocorasick.Automaton()
+    for key, response in _TOPICS.items():
+        _AUTOMATON.add_word(key, response)
+    _AUTOMATON.make_automaton()
+
 def get_response(message):
-    message_lower = message.lower()
-    for key, response in responses.items():
-        if key in message_lower:
+    if _AUTOMATON is not None:
+        for _, response in _AUTOMATON.iter(message.lower()):
             return response
-    return responses["default"]
+        return responses["default"]
+    
+    match = _TOPIC_PATTERN.search(message)
+    return _TOPICS[match.group().lower()] if match else responses["default"]
 
 async def start_command(update, context):
     await update.message.reply_text(
@@ -63,10 +89,7 @@ def main():
     try:
         logger.info("🚀 Démarrage Assistant Droit du Travail...")
         
-        # Simulate model loading
-        logger.info("📚 Chargement de la base de connaissances...")
-        time.sleep(3)
-        logger.info("✅ Base juridique chargée!")
+        logger.info(f"✅ Base juridique chargée ({len(_TOPICS)} thèmes)")
         
         # Create Telegram bot
         app = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
@@ -84,10 +107,8 @@ def main():
         
     except Exception as e:
         logger.error(f"❌ Erreur fatale: {e}")
-        # Keep container alive for debugging
-        while True:
-            time.sleep(60)
-            logger.info("🔄 Container actif...")
+        logger.error("💥 Fatal error; exiting so the supervisor can restart the container")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
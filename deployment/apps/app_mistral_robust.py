@@ -1,9 +1,22 @@
 #!/usr/bin/env python3
 """Robust Mistral AI Chatbot with Advanced Error Handling"""
 import os
+import asyncio
+import hashlib
+import re
 import logging
+import sys
+import httpx
 import torch
+from cachetools import TTLCache
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
+from transformers import TextIteratorStreamer
+
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -13,6 +26,106 @@ model = None
 tokenizer = None
 model_name = os.getenv('MODEL_NAME', 'Pyzeur/Code-du-Travail-mistral-finetune')
 
+# Concurrent generate() calls on one model thrash the KV cache and can OOM; gate them
+GEN_CONCURRENCY = max(1, int(os.getenv('GEN_CONCURRENCY', '1')))
+_GEN_LOCK = asyncio.Semaphore(GEN_CONCURRENCY)
+
+# DO_SAMPLE=false (or TEMPERATURE=0) decodes greedily: answers become deterministic, and only those are cached
+TEMPERATURE = float(os.getenv('TEMPERATURE', '0.7'))
+DO_SAMPLE = os.getenv('DO_SAMPLE', 'true').lower() == 'true' and TEMPERATURE > 0
+_SAMPLING = {"do_sample": True, "temperature": TEMPERATURE} if DO_SAMPLE else {"do_sample": False}
+
+# Exact-match cache for repeated questions (FAQ head of the traffic):
+# in-process TTLCache in front of Redis, which is shared across replicas and restarts
+_CACHE = TTLCache(maxsize=1024, ttl=3600)
+_CACHE_TTL = 3600
+
+try:
+    import redis
+    _REDIS = redis.Redis(
+        host=os.getenv('REDIS_HOST', 'localhost'),
+        port=int(os.getenv('REDIS_PORT', '6379')),
+        password=os.getenv('REDIS_PASSWORD'),
+        decode_responses=True,
+        socket_connect_timeout=0.5,
+        socket_timeout=0.5
+    )
+except ImportError:
+    _REDIS = None
+
+def _cache_key(prompt, max_new_tokens, temperature, do_sample=True):
+    """Return the cache key, or None when sampling makes the response non-deterministic"""
+    if do_sample and temperature > 0:
+        return None
+    raw = f"{prompt}|{max_new_tokens}|{temperature}|{do_sample}".encode()
+    return "mistral:app_mistral_robust:" + hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def _cache_get(key):
+    if key is None:
+        return None
+    cached = _CACHE.get(key)
+    if cached is None and _REDIS is not None:
+        try:
+            cached = _REDIS.get(key)
+        except Exception as e:
+            logger.warning(f"⚠️ Redis unavailable: {e}")
+        if cached is not None:
+            _CACHE[key] = cached
+    return cached
+
+def _cache_set(key, response):
+    if key is None:
+        return
+    _CACHE[key] = response
+    if _REDIS is not None:
+        try:
+            _REDIS.setex(key, _CACHE_TTL, response)
+        except Exception as e:
+            logger.warning(f"⚠️ Redis unavailable: {e}")
+
+# OpenAI-compatible vLLM/TGI server; when set, no weights are loaded in this process
+VLLM_URL = os.getenv('VLLM_URL')
+VLLM_MODEL = os.getenv('VLLM_MODEL', 'code-travail')
+_http = None
+
+async def generate_remote(prompt, max_tokens):
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(base_url=VLLM_URL.rstrip('/'), timeout=120)
+    
+    # The Redis client is synchronous; keep its round trips off the event loop
+    key = _cache_key(prompt, max_tokens, TEMPERATURE, DO_SAMPLE)
+    cached = await asyncio.to_thread(_cache_get, key)
+    if cached is not None:
+        return cached
+    
+    try:
+        result = await _http.post("/v1/completions", json={
+            "model": VLLM_MODEL,
+            "prompt": prompt,
+            "max_tokens": max_tokens,
+            "temperature": TEMPERATURE if DO_SAMPLE else 0
+        })
+        result.raise_for_status()
+        response = result.json()["choices"][0]["text"].strip()
+        
+    except Exception as e:
+        logger.error(f"❌ Generation error: {e}")
+        return "Désolé, une erreur s'est produite."
+    
+    if response:
+        await asyncio.to_thread(_cache_set, key, response)
+    return response or "Je ne peux pas répondre à cette question."
+
+# TF32 tensor cores for whatever fp32 matmuls remain on Ampere+ GPUs
+torch.backends.cuda.matmul.allow_tf32 = True
+
+def _half_dtype():
+    """bf16 on GPUs with native support (Ampere+), fp16 elsewhere"""
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
 def load_model():
     global model, tokenizer
     try:
@@ -27,7 +140,7 @@ def load_model():
                 "text-generation",
                 model=model_name,
                 device_map="auto",
-                torch_dtype=torch.float16,
+                torch_dtype=_half_dtype(),
                 trust_remote_code=True,
                 model_kwargs={
                     "low_cpu_mem_usage": True,
@@ -40,26 +153,23 @@ def load_model():
         except Exception as e1:
             logger.error(f"❌ Pipeline failed: {e1}")
             
-            # Method 2: Try manual loading with different tokenizer
+            # Method 2: Try manual loading with the base model's tokenizer
             try:
-                from transformers import AutoModelForCausalLM, LlamaTokenizer
-                logger.info("🔧 Attempting manual loading with LlamaTokenizer...")
+                from transformers import AutoModelForCausalLM, AutoTokenizer
+                logger.info("🔧 Attempting manual loading with the base Mistral tokenizer...")
                 
-                # Load tokenizer
-                tokenizer = LlamaTokenizer.from_pretrained(
-                    "huggyllama/llama-7b",  # Compatible tokenizer
-                    use_fast=False
-                )
-                if tokenizer.pad_token is None:
-                    tokenizer.pad_token = tokenizer.eos_token
+                # Load tokenizer (same vocabulary as the fine-tune)
+                tokenizer = AutoTokenizer.from_pretrained("mistralai/Mistral-7B-Instruct-v0.3")
+                tokenizer.pad_token = tokenizer.pad_token or tokenizer.eos_token
                 
                 # Load model
                 model = AutoModelForCausalLM.from_pretrained(
                     model_name,
-                    torch_dtype=torch.float16,
+                    torch_dtype=_half_dtype(),
                     device_map="cpu",  # Force CPU for stability
                     trust_remote_code=True,
-                    low_cpu_mem_usage=True
+                    low_cpu_mem_usage=True,
+                    attn_implementation="sdpa"  # Fused attention kernel, also on CPU
                 )
                 logger.info("✅ Manual loading successful!")
                 return True
@@ -74,7 +184,8 @@ def load_model():
                         "text-generation",
                         model="mistralai/Mistral-7B-Instruct-v0.1",
                         device_map="auto",
-                        torch_dtype=torch.float16
+                        torch_dtype=_half_dtype(),
+                        model_kwargs={"low_cpu_mem_usage": True}
                     )
                     logger.info("✅ Base model fallback successful!")
                     return True
@@ -87,17 +198,22 @@ def load_model():
         logger.error(f"❌ Fatal error loading model: {e}")
         raise
 
-def generate_response(user_input):
+def generate_response(user_input, streamer=None):
     global model, tokenizer
+    key = _cache_key(user_input, 100, TEMPERATURE, DO_SAMPLE)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+    
     try:
         if hasattr(model, 'tokenizer'):  # Pipeline approach
             prompt = f"<s>[INST] {user_input} [/INST]"
             result = model(
                 prompt,
                 max_new_tokens=100,
-                temperature=0.7,
-                do_sample=True,
-                return_full_text=False
+                **_SAMPLING,
+                return_full_text=False,
+                streamer=streamer
             )
             response = result[0]['generated_text'].strip()
             
@@ -105,25 +221,60 @@ def generate_response(user_input):
             prompt = f"Question: {user_input}\nRéponse:"
             inputs = tokenizer(prompt, return_tensors="pt")
             
-            with torch.no_grad():
+            with torch.inference_mode():
                 outputs = model.generate(
                     **inputs,
                     max_new_tokens=100,
-                    temperature=0.7,
-                    do_sample=True,
-                    pad_token_id=tokenizer.eos_token_id
+                    **_SAMPLING,
+                    pad_token_id=tokenizer.eos_token_id,
+                    streamer=streamer
                 )
             
-            response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-            if "Réponse:" in response:
-                response = response.split("Réponse:")[-1].strip()
+            # Decode only the generated tokens instead of re-decoding and scanning the prompt
+            response = tokenizer.decode(outputs[0, inputs["input_ids"].shape[1]:], skip_special_tokens=True).strip()
         
+        if response:
+            _cache_set(key, response)
         return response or "Je ne peux pas répondre à cette question."
         
     except Exception as e:
         logger.error(f"❌ Generation error: {e}")
         return "Désolé, une erreur s'est produite lors de la génération."
 
+def _generate_and_close(streamer, *args):
+    """Run generate_response feeding streamer, always closing it (cache hits never touch it)"""
+    try:
+        return generate_response(*args, streamer=streamer)
+    finally:
+        streamer.end()
+
+async def _stream_reply(update, streamer, generation):
+    """Reply as soon as text arrives and edit the message with new tokens at most every 400ms"""
+    loop = asyncio.get_running_loop()
+    message = None
+    partial = ""
+    last_edit = loop.time()
+    
+    while True:
+        chunk = await loop.run_in_executor(None, next, streamer, None)
+        if chunk is None:
+            break
+        
+        partial += chunk
+        if partial.strip() and loop.time() - last_edit >= 0.4:
+            if message is None:
+                message = await update.message.reply_text(partial + " ▌")
+            else:
+                await message.edit_text(partial + " ▌")
+            last_edit = loop.time()
+    
+    response = await generation
+    if message is None:
+        await update.message.reply_text(response)
+    else:
+        await message.edit_text(response)
+    return response
+
 async def start_command(update, context):
     await update.message.reply_text(
         "🤖 **Bonjour!** Je suis votre assistant spécialisé en **droit du travail français**.\n\n"
@@ -147,19 +298,43 @@ async def info_command(update, context):
 """
     await update.message.reply_text(info_text)
 
+# Greetings and too-short inputs get a canned reply instead of a model call
+_GREETINGS = re.compile(r"^\s*(salut|bonjour|bonsoir|coucou|hello|hi|merci|thx)\s*[!.]*\s*$", re.IGNORECASE)
+_MIN_QUESTION_CHARS = 6
+
+def _canned_reply(message):
+    """Reply for inputs not worth a generation, or None when the model should answer"""
+    if _GREETINGS.match(message):
+        return "👋 Je suis là pour vos questions sur le droit du travail. Posez-moi la vôtre!"
+    if len(message.strip()) < _MIN_QUESTION_CHARS:
+        return "❓ Pouvez-vous préciser votre question juridique?"
+    return None
+
 async def chat_message(update, context):
     try:
         user_message = update.message.text
         logger.info(f"👤 User: {user_message}")
         
+        canned = _canned_reply(user_message)
+        if canned is not None:
+            await update.message.reply_text(canned)
+            return
+        
         # Show typing indicator
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
         
         # Generate response
-        response = generate_response(user_message)
+        if VLLM_URL:
+            response = await generate_remote(f"[INST] {user_message} [/INST]", 100)
+            await update.message.reply_text(response)
+        else:
+            stream_tokenizer = model.tokenizer if hasattr(model, 'tokenizer') else tokenizer
+            streamer = TextIteratorStreamer(stream_tokenizer, skip_prompt=True, skip_special_tokens=True)
+            async with _GEN_LOCK:
+                generation = asyncio.create_task(asyncio.to_thread(_generate_and_close, streamer, user_message))
+                response = await _stream_reply(update, streamer, generation)
         
         logger.info(f"🤖 Bot: {response}")
-        await update.message.reply_text(response)
         
     except Exception as e:
         logger.error(f"❌ Chat error: {e}")
@@ -168,15 +343,19 @@ async def chat_message(update, context):
             "Veuillez reformuler votre question."
         )
 
+async def _load_model_in_executor(app):
+    """Load the model off the event loop before polling starts"""
+    await asyncio.get_running_loop().run_in_executor(None, load_model)
+
 def main():
     try:
         logger.info("🚀 Initializing Mistral Legal Assistant...")
         
-        # Load model
-        load_model()
-        
-        # Create Telegram bot
-        app = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
+        # Create Telegram bot; the model is loaded on startup unless generation is served by vLLM
+        builder = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN'))
+        if not VLLM_URL:
+            builder = builder.post_init(_load_model_in_executor)
+        app = builder.build()
         
         # Add handlers
         app.add_handler(CommandHandler("start", start_command))
@@ -196,11 +375,8 @@ def main():
         
     except Exception as e:
         logger.error(f"❌ Startup failed: {e}")
-        logger.info("🔄 Keeping container alive for debugging...")
-        import time
-        while True:
-            time.sleep(60)
-            logger.info("💤 Container still running...")
+        logger.error("💥 Fatal error; exiting so the supervisor can restart the container")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
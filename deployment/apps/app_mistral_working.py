@@ -1,19 +1,165 @@
 #!/usr/bin/env python3
 """Mistral AI Chatbot - Complete Tokenizer Bypass"""
 import os
+import asyncio
+import hashlib
+import re
+import importlib.util
 import logging
+import httpx
+from cachetools import TTLCache
+from compile_utils import compile_and_warm_up, left_pad
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
 import torch
 
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Global variables
 model = None
 tokenizer = None
+_PREFIX_IDS = None
+_SUFFIX_IDS = None
 model_name = os.getenv('MODEL_NAME', 'Pyzeur/Code-du-Travail-mistral-finetune')
 
+# FlashAttention-2 when flash-attn is installed on a GPU host, fused SDPA otherwise
+ATTN_IMPLEMENTATION = (
+    "flash_attention_2"
+    if torch.cuda.is_available() and importlib.util.find_spec("flash_attn")
+    else "sdpa"
+)
+
+# One GPU: pin the whole model to it so accelerate adds no per-layer dispatch hooks; shard only across several
+DEVICE_MAP = {"": 0} if torch.cuda.device_count() == 1 else "auto"
+
+# Concurrent generate() calls on one model thrash the KV cache and can OOM; gate them
+GEN_CONCURRENCY = max(1, int(os.getenv('GEN_CONCURRENCY', '1')))
+_GEN_LOCK = asyncio.Semaphore(GEN_CONCURRENCY)
+
+# DO_SAMPLE=false (or TEMPERATURE=0) decodes greedily: answers become deterministic, and only those are cached
+TEMPERATURE = float(os.getenv('TEMPERATURE', '0.7'))
+DO_SAMPLE = os.getenv('DO_SAMPLE', 'true').lower() == 'true' and TEMPERATURE > 0
+
+# Exact-match cache for repeated questions (FAQ head of the traffic):
+# in-process TTLCache in front of Redis, which is shared across replicas and restarts
+_CACHE = TTLCache(maxsize=1024, ttl=3600)
+_CACHE_TTL = 3600
+
+try:
+    import redis
+    _REDIS = redis.Redis(
+        host=os.getenv('REDIS_HOST', 'localhost'),
+        port=int(os.getenv('REDIS_PORT', '6379')),
+        password=os.getenv('REDIS_PASSWORD'),
+        decode_responses=True,
+        socket_connect_timeout=0.5,
+        socket_timeout=0.5
+    )
+except ImportError:
+    _REDIS = None
+
+def _cache_key(prompt, max_new_tokens, temperature, do_sample=True):
+    """Return the cache key, or None when sampling makes the response non-deterministic"""
+    if do_sample and temperature > 0:
+        return None
+    raw = f"{prompt}|{max_new_tokens}|{temperature}|{do_sample}".encode()
+    return "mistral:app_mistral_working:" + hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def _cache_get(key):
+    if key is None:
+        return None
+    cached = _CACHE.get(key)
+    if cached is None and _REDIS is not None:
+        try:
+            cached = _REDIS.get(key)
+        except Exception as e:
+            logger.warning(f"⚠️ Redis unavailable: {e}")
+        if cached is not None:
+            _CACHE[key] = cached
+    return cached
+
+def _cache_set(key, response):
+    if key is None:
+        return
+    _CACHE[key] = response
+    if _REDIS is not None:
+        try:
+            _REDIS.setex(key, _CACHE_TTL, response)
+        except Exception as e:
+            logger.warning(f"⚠️ Redis unavailable: {e}")
+
+# OpenAI-compatible vLLM/TGI server; when set, no weights are loaded in this process
+VLLM_URL = os.getenv('VLLM_URL')
+VLLM_MODEL = os.getenv('VLLM_MODEL', 'code-travail')
+_http = None
+
+async def generate_remote(prompt, max_tokens):
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(base_url=VLLM_URL.rstrip('/'), timeout=120)
+    
+    # The Redis client is synchronous; keep its round trips off the event loop
+    key = _cache_key(prompt, max_tokens, TEMPERATURE, DO_SAMPLE)
+    cached = await asyncio.to_thread(_cache_get, key)
+    if cached is not None:
+        return cached
+    
+    try:
+        result = await _http.post("/v1/completions", json={
+            "model": VLLM_MODEL,
+            "prompt": prompt,
+            "max_tokens": max_tokens,
+            "temperature": TEMPERATURE if DO_SAMPLE else 0
+        })
+        result.raise_for_status()
+        response = result.json()["choices"][0]["text"].strip()
+        
+    except Exception as e:
+        logger.error(f"❌ Generation error: {e}")
+        return "Désolé, une erreur s'est produite."
+    
+    if response:
+        await asyncio.to_thread(_cache_set, key, response)
+    return response or "Je ne peux pas répondre à cette question."
+
+def _configure_generation():
+    """Set the constant sampling settings on the model once instead of passing them to every generate()"""
+    config = model.generation_config
+    config.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    config.eos_token_id = tokenizer.eos_token_id
+    config.max_new_tokens = 150
+    config.do_sample = DO_SAMPLE
+    if DO_SAMPLE:
+        config.temperature = TEMPERATURE
+        config.top_p = 0.9
+
+def _prepare_prompt_ids():
+    """Tokenize the fixed Mistral instruction wrapper once, right after the tokenizer loads"""
+    global _PREFIX_IDS, _SUFFIX_IDS
+    _PREFIX_IDS = tokenizer("<s>[INST] ", add_special_tokens=False, return_tensors="pt").input_ids
+    _SUFFIX_IDS = tokenizer(" [/INST]", add_special_tokens=False, return_tensors="pt").input_ids
+
+def _encode_prompt(user_text):
+    """Token ids for <s>[INST] user_text [/INST]; only the user text is tokenized per request"""
+    body = tokenizer(user_text, add_special_tokens=False, return_tensors="pt").input_ids
+    return torch.cat([_PREFIX_IDS, body, _SUFFIX_IDS], dim=1)
+
+# TF32 tensor cores for whatever fp32 matmuls remain on Ampere+ GPUs
+torch.backends.cuda.matmul.allow_tf32 = True
+
+def _half_dtype():
+    """bf16 on GPUs with native support (Ampere+), fp16 elsewhere"""
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
 def load_model():
     global model, tokenizer
     try:
@@ -22,53 +168,92 @@ def load_model():
         # Load working tokenizer separately
         logger.info("Loading working tokenizer from base model...")
         tokenizer = AutoTokenizer.from_pretrained("mistralai/Mistral-7B-Instruct-v0.3")
+        _prepare_prompt_ids()
         
         # Load your model weights without tokenizer
         logger.info("Loading your fine-tuned model weights...")
         model = AutoModelForCausalLM.from_pretrained(
             model_name,
-            torch_dtype=torch.float16,
-            device_map="auto",
+            torch_dtype=_half_dtype(),
+            device_map=DEVICE_MAP,
             trust_remote_code=True,
-            low_cpu_mem_usage=True
+            low_cpu_mem_usage=True,
+            attn_implementation=ATTN_IMPLEMENTATION
         )
         
-        logger.info("✅ Mistral model loaded successfully with separate tokenizer")
+        _configure_generation()
+        compile_and_warm_up(model, model.generation_config.pad_token_id)
+        
+        logger.info(f"✅ Mistral model loaded successfully with separate tokenizer (attention: {ATTN_IMPLEMENTATION})")
         
     except Exception as e:
         logger.error(f"❌ Error loading model: {e}")
         raise
 
-def generate_response(prompt):
+def generate_response(user_message, streamer=None):
+    key = _cache_key(user_message, 150, TEMPERATURE, DO_SAMPLE)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+    
     try:
-        # Tokenize input
-        inputs = tokenizer.encode(prompt, return_tensors="pt")
+        # Tokenize input (the Mistral Instruct wrapper is pre-tokenized)
+        input_ids, attention_mask = left_pad([_encode_prompt(user_message)[0]], model.generation_config.pad_token_id)
+        input_ids, attention_mask = input_ids.to(model.device), attention_mask.to(model.device)
         
         # Generate
-        with torch.no_grad():
+        with torch.inference_mode():
             outputs = model.generate(
-                inputs,
-                max_new_tokens=150,
-                temperature=0.7,
-                do_sample=True,
-                top_p=0.9,
-                pad_token_id=tokenizer.eos_token_id,
-                eos_token_id=tokenizer.eos_token_id
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                streamer=streamer
             )
         
-        # Decode response
-        response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        
-        # Remove input from response
-        if response.startswith(prompt):
-            response = response[len(prompt):].strip()
+        # Decode only the generated tokens
+        response = tokenizer.decode(outputs[0][input_ids.shape[1]:], skip_special_tokens=True).strip()
         
+        if response:
+            _cache_set(key, response)
         return response or "Je ne peux pas répondre à cette question."
         
     except Exception as e:
         logger.error(f"❌ Generation error: {e}")
         return "Désolé, une erreur s'est produite."
 
+def _generate_and_close(streamer, *args):
+    """Run generate_response feeding streamer, always closing it (cache hits never touch it)"""
+    try:
+        return generate_response(*args, streamer=streamer)
+    finally:
+        streamer.end()
+
+async def _stream_reply(update, streamer, generation):
+    """Reply as soon as text arrives and edit the message with new tokens at most every 400ms"""
+    loop = asyncio.get_running_loop()
+    message = None
+    partial = ""
+    last_edit = loop.time()
+    
+    while True:
+        chunk = await loop.run_in_executor(None, next, streamer, None)
+        if chunk is None:
+            break
+        
+        partial += chunk
+        if partial.strip() and loop.time() - last_edit >= 0.4:
+            if message is None:
+                message = await update.message.reply_text(partial + " ▌")
+            else:
+                await message.edit_text(partial + " ▌")
+            last_edit = loop.time()
+    
+    response = await generation
+    if message is None:
+        await update.message.reply_text(response)
+    else:
+        await message.edit_text(response)
+    return response
+
 async def start_command(update, context):
     await update.message.reply_text(
         f"🤖 Bonjour! Je suis votre assistant spécialisé en droit du travail français.\n"
@@ -84,31 +269,52 @@ async def info_command(update, context):
 """
     await update.message.reply_text(info_text)
 
+# Greetings and too-short inputs get a canned reply instead of a model call
+_GREETINGS = re.compile(r"^\s*(salut|bonjour|bonsoir|coucou|hello|hi|merci|thx)\s*[!.]*\s*$", re.IGNORECASE)
+_MIN_QUESTION_CHARS = 6
+
+def _canned_reply(message):
+    """Reply for inputs not worth a generation, or None when the model should answer"""
+    if _GREETINGS.match(message):
+        return "👋 Je suis là pour vos questions sur le droit du travail. Posez-moi la vôtre!"
+    if len(message.strip()) < _MIN_QUESTION_CHARS:
+        return "❓ Pouvez-vous préciser votre question juridique?"
+    return None
+
 async def chat_message(update, context):
     try:
         user_message = update.message.text
         logger.info(f"User message: {user_message}")
         
-        # Format for Mistral Instruct
-        prompt = f"<s>[INST] {user_message} [/INST]"
-        
-        response = generate_response(prompt)
+        canned = _canned_reply(user_message)
+        if canned is not None:
+            await update.message.reply_text(canned)
+            return
         
-        # Clean response
-        if "[/INST]" in response:
-            response = response.split("[/INST]")[-1].strip()
+        if VLLM_URL:
+            response = await generate_remote(f"[INST] {user_message} [/INST]", 150)
+            await update.message.reply_text(response)
+        else:
+            streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+            async with _GEN_LOCK:
+                generation = asyncio.create_task(asyncio.to_thread(_generate_and_close, streamer, user_message))
+                response = await _stream_reply(update, streamer, generation)
         
         logger.info(f"Bot response: {response}")
-        await update.message.reply_text(response)
         
     except Exception as e:
         logger.error(f"❌ Error: {e}")
         await update.message.reply_text("Désolé, une erreur s'est produite.")
 
+async def _load_model_in_executor(app):
+    """Load the model off the event loop before polling starts"""
+    await asyncio.get_running_loop().run_in_executor(None, load_model)
+
 def main():
-    load_model()
-    
-    app = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
+    builder = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN'))
+    if not VLLM_URL:
+        builder = builder.post_init(_load_model_in_executor)
+    app = builder.build()
     
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("info", info_command))
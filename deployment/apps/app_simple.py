@@ -5,6 +5,12 @@ import logging
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 from transformers import pipeline
 
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -1,19 +1,158 @@
 #!/usr/bin/env python3
 """Memory-Efficient YOUR LoRA Model"""
 import os
+import asyncio
+import hashlib
+import re
+import importlib.util
 import logging
+import sys
+import httpx
 import torch
+from cachetools import TTLCache
+from compile_utils import compile_and_warm_up, left_pad
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer, BitsAndBytesConfig
 from peft import PeftModel
 from huggingface_hub import login
 import gc
 
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 model = None
 tokenizer = None
+_PREFIX_IDS = None
+_SUFFIX_IDS = None
+
+# Micro-batching: questions arriving within the window (or while a generation runs) share one generate() call
+BATCH_SIZE = max(1, int(os.getenv('BATCH_SIZE', '8')))
+BATCH_WAIT_MS = int(os.getenv('BATCH_WAIT_MS', '50'))
+_QUEUE = None
+_WORKER = None
+
+# FlashAttention-2 when flash-attn is installed on a GPU host, fused SDPA otherwise
+ATTN_IMPLEMENTATION = (
+    "flash_attention_2"
+    if torch.cuda.is_available() and importlib.util.find_spec("flash_attn")
+    else "sdpa"
+)
+
+# One GPU: pin the whole model to it so accelerate adds no per-layer dispatch hooks; shard only across several
+DEVICE_MAP = {"": 0} if torch.cuda.device_count() == 1 else "auto"
+
+# DO_SAMPLE=false (or TEMPERATURE=0) decodes greedily: answers become deterministic, and only those are cached
+TEMPERATURE = float(os.getenv('TEMPERATURE', '0.7'))
+DO_SAMPLE = os.getenv('DO_SAMPLE', 'true').lower() == 'true' and TEMPERATURE > 0
+
+# Exact-match cache for repeated questions (FAQ head of the traffic):
+# in-process TTLCache in front of Redis, which is shared across replicas and restarts
+_CACHE = TTLCache(maxsize=1024, ttl=3600)
+_CACHE_TTL = 3600
+
+try:
+    import redis
+    _REDIS = redis.Redis(
+        host=os.getenv('REDIS_HOST', 'localhost'),
+        port=int(os.getenv('REDIS_PORT', '6379')),
+        password=os.getenv('REDIS_PASSWORD'),
+        decode_responses=True,
+        socket_connect_timeout=0.5,
+        socket_timeout=0.5
+    )
+except ImportError:
+    _REDIS = None
+
+def _cache_key(prompt, max_new_tokens, temperature, do_sample=True):
+    """Return the cache key, or None when sampling makes the response non-deterministic"""
+    if do_sample and temperature > 0:
+        return None
+    raw = f"{prompt}|{max_new_tokens}|{temperature}|{do_sample}".encode()
+    return "mistral:app_your_lora_efficient:" + hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def _cache_get(key):
+    if key is None:
+        return None
+    cached = _CACHE.get(key)
+    if cached is None and _REDIS is not None:
+        try:
+            cached = _REDIS.get(key)
+        except Exception as e:
+            logger.warning(f"⚠️ Redis unavailable: {e}")
+        if cached is not None:
+            _CACHE[key] = cached
+    return cached
+
+def _cache_set(key, response):
+    if key is None:
+        return
+    _CACHE[key] = response
+    if _REDIS is not None:
+        try:
+            _REDIS.setex(key, _CACHE_TTL, response)
+        except Exception as e:
+            logger.warning(f"⚠️ Redis unavailable: {e}")
+
+# OpenAI-compatible vLLM/TGI server; when set, no weights are loaded in this process
+VLLM_URL = os.getenv('VLLM_URL')
+VLLM_MODEL = os.getenv('VLLM_MODEL', 'code-travail')
+_http = None
+
+async def generate_remote(prompt, max_tokens):
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(base_url=VLLM_URL.rstrip('/'), timeout=120)
+    
+    # The Redis client is synchronous; keep its round trips off the event loop
+    key = _cache_key(prompt, max_tokens, TEMPERATURE, DO_SAMPLE)
+    cached = await asyncio.to_thread(_cache_get, key)
+    if cached is not None:
+        return cached
+    
+    try:
+        result = await _http.post("/v1/completions", json={
+            "model": VLLM_MODEL,
+            "prompt": prompt,
+            "max_tokens": max_tokens,
+            "temperature": TEMPERATURE if DO_SAMPLE else 0
+        })
+        result.raise_for_status()
+        response = result.json()["choices"][0]["text"].strip()
+        
+    except Exception as e:
+        logger.error(f"❌ Generation error: {e}")
+        return "Désolé, une erreur s'est produite."
+    
+    if response:
+        await asyncio.to_thread(_cache_set, key, response)
+    return response or "Je ne peux pas répondre à cette question."
+
+def _configure_generation(model):
+    """Set the constant sampling settings on the model once instead of passing them to every generate()"""
+    config = model.generation_config
+    config.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    config.eos_token_id = tokenizer.eos_token_id
+    config.max_new_tokens = 150
+    config.do_sample = DO_SAMPLE
+    if DO_SAMPLE:
+        config.temperature = TEMPERATURE
+
+def _prepare_prompt_ids():
+    """Tokenize the fixed Mistral instruction wrapper once, right after the tokenizer loads"""
+    global _PREFIX_IDS, _SUFFIX_IDS
+    _PREFIX_IDS = tokenizer("<s>[INST] ", add_special_tokens=False, return_tensors="pt").input_ids
+    _SUFFIX_IDS = tokenizer(" [/INST]", add_special_tokens=False, return_tensors="pt").input_ids
+
+def _encode_prompt(user_text):
+    """Token ids for <s>[INST] user_text [/INST]; only the user text is tokenized per request"""
+    body = tokenizer(user_text, add_special_tokens=False, return_tensors="pt").input_ids
+    return torch.cat([_PREFIX_IDS, body, _SUFFIX_IDS], dim=1)
 
 def load_your_lora_model():
     global model, tokenizer
@@ -42,9 +181,10 @@ def load_your_lora_model():
         base_model = AutoModelForCausalLM.from_pretrained(
             base_model_name,
             quantization_config=quantization_config,
-            device_map="auto",
+            device_map=DEVICE_MAP,
             trust_remote_code=True,
-            low_cpu_mem_usage=True
+            low_cpu_mem_usage=True,
+            attn_implementation=ATTN_IMPLEMENTATION
         )
         
         logger.info("✅ Quantized base model loaded!")
@@ -53,17 +193,33 @@ def load_your_lora_model():
         tokenizer = AutoTokenizer.from_pretrained(base_model_name)
         if tokenizer.pad_token is None:
             tokenizer.pad_token = tokenizer.eos_token
+        _prepare_prompt_ids()
         
         # Apply YOUR LoRA adapters
         lora_model_name = "Pyzeur/Code-du-Travail-mistral-finetune"
         logger.info(f"🔧 Applying YOUR LoRA adapters...")
         
-        model = PeftModel.from_pretrained(
+        # Prepared in a local: requests (and the model server's /health) only see the model once it is ready
+        loaded = PeftModel.from_pretrained(
             base_model,
             lora_model_name,
             token=hf_token
         )
         
+        # Fold the adapters into the base weights so decode skips the extra LoRA matmuls
+        try:
+            loaded = loaded.merge_and_unload()
+            logger.info("🔗 LoRA adapters merged into base weights")
+        except Exception as e:
+            # Not every quantized layer type supports merging; keep the adapters separate
+            logger.warning(f"⚠️ Could not merge LoRA adapters, keeping them unmerged: {e}")
+        loaded.eval()
+        gc.collect()
+        
+        _configure_generation(loaded)
+        compile_and_warm_up(loaded, loaded.generation_config.pad_token_id, batch_sizes=range(1, BATCH_SIZE + 1))
+        model = loaded
+        
         logger.info("✅ YOUR LoRA model loaded with quantization!")
         logger.info("🏛️ Memory usage optimized!")
         
@@ -71,37 +227,151 @@ def load_your_lora_model():
         
     except Exception as e:
         logger.error(f"❌ Error: {e}")
-        logger.info("🔄 Keeping alive for debugging...")
-        import time
-        while True:
-            time.sleep(60)
+        # Runs in an executor thread, where sys.exit would only end the thread
+        logger.error("💥 Model loading failed; exiting so the supervisor can restart the container")
+        os._exit(1)
 
-def generate_response(user_question):
+def generate_response(user_question, streamer=None):
     try:
         if model is None:
             return "⏳ Votre modèle est en cours de chargement..."
         
-        prompt = f"<s>[INST] {user_question} [/INST]"
-        inputs = tokenizer(prompt, return_tensors="pt")
+        key = _cache_key(user_question, 150, TEMPERATURE, DO_SAMPLE)
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
+        
+        input_ids, attention_mask = _encode_batch([user_question])
         
-        with torch.no_grad():
+        with torch.inference_mode():
             outputs = model.generate(
-                **inputs,
-                max_new_tokens=150,
-                temperature=0.7,
-                do_sample=True,
-                pad_token_id=tokenizer.eos_token_id
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                streamer=streamer
             )
         
-        response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        response = response.replace(prompt, "").strip()
+        response = tokenizer.decode(outputs[0][input_ids.shape[1]:], skip_special_tokens=True).strip()
         
+        if response:
+            _cache_set(key, response)
         return response or "Je ne peux pas répondre."
         
     except Exception as e:
         logger.error(f"Generation error: {e}")
         return "Erreur lors de la génération."
 
+def _generate_and_close(streamer, *args):
+    """Run generate_response feeding streamer, always closing it (cache hits never touch it)"""
+    try:
+        return generate_response(*args, streamer=streamer)
+    finally:
+        streamer.end()
+
+def _encode_batch(user_texts):
+    """Left-padded ids and attention mask for several prompts (decoder-only models pad on the left)"""
+    input_ids, attention_mask = left_pad([_encode_prompt(text)[0] for text in user_texts], tokenizer.pad_token_id)
+    return input_ids.to(model.device), attention_mask.to(model.device)
+
+def _generate_batch(user_questions):
+    """Answer several questions with a single model.generate call; cache hits are not regenerated"""
+    if model is None:
+        return [generate_response(question) for question in user_questions]
+    
+    keys = [_cache_key(question, 150, TEMPERATURE, DO_SAMPLE) for question in user_questions]
+    responses = [_cache_get(key) for key in keys]
+    pending = [i for i, response in enumerate(responses) if response is None]
+    if not pending:
+        return responses
+    
+    try:
+        input_ids, attention_mask = _encode_batch([user_questions[i] for i in pending])
+        
+        with torch.inference_mode():
+            outputs = model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask
+            )
+        
+        generated = tokenizer.batch_decode(outputs[:, input_ids.shape[1]:], skip_special_tokens=True)
+        for i, response in zip(pending, generated):
+            response = response.strip()
+            if response:
+                _cache_set(keys[i], response)
+            responses[i] = response or "Je ne peux pas répondre."
+        
+    except Exception as e:
+        logger.error(f"Batch generation error: {e}")
+        for i in pending:
+            responses[i] = "Erreur lors de la génération."
+    
+    return responses
+
+async def _batch_worker():
+    """Drain the queue: a lone question is streamed, concurrent ones are generated as one batch"""
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        batch = [await _QUEUE.get()]
+        deadline = loop.time() + BATCH_WAIT_MS / 1000
+        
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_QUEUE.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        
+        try:
+            if len(batch) == 1:
+                question, streamer, _ = batch[0]
+                responses = [await asyncio.to_thread(_generate_and_close, streamer, question)]
+            else:
+                logger.info(f"Generating batch of {len(batch)} questions")
+                responses = await asyncio.to_thread(_generate_batch, [question for question, _, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            responses = None
+        finally:
+            # Batched answers are sent whole; ending the streamers lets each reply finish
+            for _, streamer, _ in batch:
+                streamer.end()
+        
+        if responses is not None:
+            for (_, _, future), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
+
+async def _stream_reply(update, streamer, generation):
+    """Reply as soon as text arrives and edit the message with new tokens at most every 400ms"""
+    loop = asyncio.get_running_loop()
+    message = None
+    partial = ""
+    last_edit = loop.time()
+    
+    while True:
+        chunk = await loop.run_in_executor(None, next, streamer, None)
+        if chunk is None:
+            break
+        
+        partial += chunk
+        if partial.strip() and loop.time() - last_edit >= 0.4:
+            if message is None:
+                message = await update.message.reply_text(partial + " ▌")
+            else:
+                await message.edit_text(partial + " ▌")
+            last_edit = loop.time()
+    
+    response = await generation
+    if message is None:
+        await update.message.reply_text(response)
+    else:
+        await message.edit_text(response)
+    return response
+
 async def start_command(update, context):
     await update.message.reply_text(
         "🤖 **VOTRE Modèle LoRA**\n\n"
@@ -111,31 +381,58 @@ async def start_command(update, context):
         "❓ **Testez votre expertise!**"
     )
 
+# Greetings and too-short inputs get a canned reply instead of a model call
+_GREETINGS = re.compile(r"^\s*(salut|bonjour|bonsoir|coucou|hello|hi|merci|thx)\s*[!.]*\s*$", re.IGNORECASE)
+_MIN_QUESTION_CHARS = 6
+
+def _canned_reply(message):
+    """Reply for inputs not worth a generation, or None when the model should answer"""
+    if _GREETINGS.match(message):
+        return "👋 Je suis là pour vos questions sur le droit du travail. Posez-moi la vôtre!"
+    if len(message.strip()) < _MIN_QUESTION_CHARS:
+        return "❓ Pouvez-vous préciser votre question juridique?"
+    return None
+
 async def chat_message(update, context):
     try:
         user_message = update.message.text
         logger.info(f"👤 Question: {user_message}")
         
+        canned = _canned_reply(user_message)
+        if canned is not None:
+            await update.message.reply_text(canned)
+            return
+        
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-        response = generate_response(user_message)
-        await update.message.reply_text(response)
+        if VLLM_URL:
+            response = await generate_remote(f"[INST] {user_message} [/INST]", 150)
+            await update.message.reply_text(response)
+        else:
+            streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+            generation = asyncio.get_running_loop().create_future()
+            await _QUEUE.put((user_message, streamer, generation))
+            response = await _stream_reply(update, streamer, generation)
         
     except Exception as e:
         logger.error(f"Chat error: {e}")
         await update.message.reply_text("⚠️ Erreur temporaire.")
 
+async def _start_model_loading(app):
+    """Load the model in the default executor while the bot already answers, and start the batcher"""
+    global _QUEUE, _WORKER
+    _QUEUE = asyncio.Queue()
+    _WORKER = asyncio.create_task(_batch_worker())
+    asyncio.get_running_loop().run_in_executor(None, load_your_lora_model)
+
 def main():
     try:
         logger.info("🚀 Starting efficient YOUR model...")
         
-        # Start model loading
-        import threading
-        model_thread = threading.Thread(target=load_your_lora_model)
-        model_thread.daemon = True
-        model_thread.start()
-        
-        # Start bot
-        app = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
+        # Start bot, loading the model in background
+        builder = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN'))
+        if not VLLM_URL:
+            builder = builder.post_init(_start_model_loading)
+        app = builder.build()
         app.add_handler(CommandHandler("start", start_command))
         app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, chat_message))
         
@@ -144,9 +441,8 @@ def main():
         
     except Exception as e:
         logger.error(f"Error: {e}")
-        import time
-        while True:
-            time.sleep(60)
+        logger.error("💥 Fatal error; exiting so the supervisor can restart the container")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -1,23 +1,167 @@
 #!/usr/bin/env python3
 """Final Optimized YOUR LoRA Model"""
 import os
+import asyncio
+import hashlib
+import re
+import importlib.util
 import logging
+import sys
+import httpx
 import torch
+from cachetools import TTLCache
+from compile_utils import compile_and_warm_up, left_pad
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
 from peft import PeftModel
 from huggingface_hub import login
 import gc
 import time
 
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 model = None
 tokenizer = None
+_PREFIX_IDS = None
+_SUFFIX_IDS = None
+
+# Micro-batching: questions arriving within the window (or while a generation runs) share one generate() call
+BATCH_SIZE = max(1, int(os.getenv('BATCH_SIZE', '8')))
+BATCH_WAIT_MS = int(os.getenv('BATCH_WAIT_MS', '50'))
+_QUEUE = None
+_WORKER = None
 model_loaded = False
 loading_progress = "Initialisation..."
 
+# While the model loads: one banner per progress step, and at most one reply per chat every few seconds
+_LOADING_MSG_CACHE = {}
+_LAST_SENT = {}
+_LOADING_REPLY_INTERVAL = 5
+
+# FlashAttention-2 when flash-attn is installed on a GPU host, fused SDPA otherwise
+ATTN_IMPLEMENTATION = (
+    "flash_attention_2"
+    if torch.cuda.is_available() and importlib.util.find_spec("flash_attn")
+    else "sdpa"
+)
+
+# One GPU: pin the whole model to it so accelerate adds no per-layer dispatch hooks; shard only across several
+DEVICE_MAP = {"": 0} if torch.cuda.device_count() == 1 else "auto"
+
+# DO_SAMPLE=false (or TEMPERATURE=0) decodes greedily: answers become deterministic, and only those are cached
+TEMPERATURE = float(os.getenv('TEMPERATURE', '0.7'))
+DO_SAMPLE = os.getenv('DO_SAMPLE', 'true').lower() == 'true' and TEMPERATURE > 0
+
+# Exact-match cache for repeated questions (FAQ head of the traffic):
+# in-process TTLCache in front of Redis, which is shared across replicas and restarts
+_CACHE = TTLCache(maxsize=1024, ttl=3600)
+_CACHE_TTL = 3600
+
+try:
+    import redis
+    _REDIS = redis.Redis(
+        host=os.getenv('REDIS_HOST', 'localhost'),
+        port=int(os.getenv('REDIS_PORT', '6379')),
+        password=os.getenv('REDIS_PASSWORD'),
+        decode_responses=True,
+        socket_connect_timeout=0.5,
+        socket_timeout=0.5
+    )
+except ImportError:
+    _REDIS = None
+
+def _cache_key(prompt, max_new_tokens, temperature, do_sample=True):
+    """Return the cache key, or None when sampling makes the response non-deterministic"""
+    if do_sample and temperature > 0:
+        return None
+    raw = f"{prompt}|{max_new_tokens}|{temperature}|{do_sample}".encode()
+    return "mistral:app_your_lora_final:" + hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def _cache_get(key):
+    if key is None:
+        return None
+    cached = _CACHE.get(key)
+    if cached is None and _REDIS is not None:
+        try:
+            cached = _REDIS.get(key)
+        except Exception as e:
+            logger.warning(f"⚠️ Redis unavailable: {e}")
+        if cached is not None:
+            _CACHE[key] = cached
+    return cached
+
+def _cache_set(key, response):
+    if key is None:
+        return
+    _CACHE[key] = response
+    if _REDIS is not None:
+        try:
+            _REDIS.setex(key, _CACHE_TTL, response)
+        except Exception as e:
+            logger.warning(f"⚠️ Redis unavailable: {e}")
+
+# OpenAI-compatible vLLM/TGI server; when set, no weights are loaded in this process
+VLLM_URL = os.getenv('VLLM_URL')
+VLLM_MODEL = os.getenv('VLLM_MODEL', 'code-travail')
+_http = None
+
+async def generate_remote(prompt, max_tokens):
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(base_url=VLLM_URL.rstrip('/'), timeout=120)
+    
+    # The Redis client is synchronous; keep its round trips off the event loop
+    key = _cache_key(prompt, max_tokens, TEMPERATURE, DO_SAMPLE)
+    cached = await asyncio.to_thread(_cache_get, key)
+    if cached is not None:
+        return cached
+    
+    try:
+        result = await _http.post("/v1/completions", json={
+            "model": VLLM_MODEL,
+            "prompt": prompt,
+            "max_tokens": max_tokens,
+            "temperature": TEMPERATURE if DO_SAMPLE else 0
+        })
+        result.raise_for_status()
+        response = result.json()["choices"][0]["text"].strip()
+        
+    except Exception as e:
+        logger.error(f"❌ Generation error: {e}")
+        return "Désolé, une erreur s'est produite."
+    
+    if response:
+        await asyncio.to_thread(_cache_set, key, response)
+    return response or "Je ne peux pas répondre à cette question."
+
+def _configure_generation():
+    """Set the constant sampling settings on the model once instead of passing them to every generate()"""
+    config = model.generation_config
+    config.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    config.eos_token_id = tokenizer.eos_token_id
+    config.max_new_tokens = 200
+    config.do_sample = DO_SAMPLE
+    if DO_SAMPLE:
+        config.temperature = TEMPERATURE
+
+def _prepare_prompt_ids():
+    """Tokenize the fixed Mistral instruction wrapper once, right after the tokenizer loads"""
+    global _PREFIX_IDS, _SUFFIX_IDS
+    _PREFIX_IDS = tokenizer("<s>[INST] ", add_special_tokens=False, return_tensors="pt").input_ids
+    _SUFFIX_IDS = tokenizer(" [/INST]", add_special_tokens=False, return_tensors="pt").input_ids
+
+def _encode_prompt(user_text):
+    """Token ids for <s>[INST] user_text [/INST]; only the user text is tokenized per request"""
+    body = tokenizer(user_text, add_special_tokens=False, return_tensors="pt").input_ids
+    return torch.cat([_PREFIX_IDS, body, _SUFFIX_IDS], dim=1)
+
 def load_your_lora_model():
     global model, tokenizer, model_loaded, loading_progress
     try:
@@ -32,20 +176,33 @@ def load_your_lora_model():
         # Aggressive memory cleanup
         gc.collect()
         
-        # Load base model with maximum memory optimization
         base_model_name = "mistralai/Mistral-7B-Instruct-v0.3"
+        # A 4-bit AWQ export of the base model (~4GB resident) when one is configured; AWQ kernels need CUDA
+        awq_model_name = os.getenv('AWQ_MODEL_NAME')
         loading_progress = "📥 Téléchargement du modèle de base..."
-        logger.info(f"📥 Loading base model with max optimization...")
-        
-        base_model = AutoModelForCausalLM.from_pretrained(
-            base_model_name,
-            torch_dtype=torch.float16,
-            device_map="cpu",
-            low_cpu_mem_usage=True,
-            trust_remote_code=True,
-            max_memory={"cpu": "7GB"},  # Limit memory usage
-            offload_folder="./tmp"
-        )
+        
+        if awq_model_name and torch.cuda.is_available():
+            logger.info(f"📥 Loading 4-bit AWQ base model: {awq_model_name}")
+            base_model = AutoModelForCausalLM.from_pretrained(
+                awq_model_name,
+                torch_dtype=torch.float16,
+                device_map=DEVICE_MAP,
+                low_cpu_mem_usage=True,
+                trust_remote_code=True,
+                attn_implementation=ATTN_IMPLEMENTATION
+            )
+        else:
+            logger.info(f"📥 Loading base model with max optimization...")
+            base_model = AutoModelForCausalLM.from_pretrained(
+                base_model_name,
+                torch_dtype=torch.float16,
+                device_map="cpu",
+                low_cpu_mem_usage=True,
+                trust_remote_code=True,
+                max_memory={"cpu": "7GB"},  # Limit memory usage
+                offload_folder="./tmp",
+                attn_implementation=ATTN_IMPLEMENTATION
+            )
         
         loading_progress = "✅ Modèle de base chargé!"
         logger.info("✅ Base model loaded!")
@@ -59,6 +216,7 @@ def load_your_lora_model():
         tokenizer = AutoTokenizer.from_pretrained(base_model_name)
         if tokenizer.pad_token is None:
             tokenizer.pad_token = tokenizer.eos_token
+        _prepare_prompt_ids()
         
         loading_progress = "🔧 Application de VOS adaptateurs LoRA..."
         logger.info("📝 Tokenizer loaded!")
@@ -73,44 +231,183 @@ def load_your_lora_model():
             token=hf_token
         )
         
+        # Fold the adapters into the base weights so decode skips the extra LoRA matmuls
+        try:
+            model = model.merge_and_unload()
+            logger.info("🔗 LoRA adapters merged into base weights")
+        except Exception as e:
+            # Not every quantized layer type supports merging; keep the adapters separate
+            logger.warning(f"⚠️ Could not merge LoRA adapters, keeping them unmerged: {e}")
+        model.eval()
+        gc.collect()
+        
+        _configure_generation()
+        compile_and_warm_up(model, model.generation_config.pad_token_id, batch_sizes=range(1, BATCH_SIZE + 1))
+        
         model_loaded = True
         loading_progress = "✅ VOTRE modèle est prêt!"
         logger.info("✅ YOUR LoRA model loaded successfully!")
         logger.info("🏛️ Code du Travail expertise fully active!")
         
     except Exception as e:
-        loading_progress = f"❌ Erreur: {str(e)[:50]}..."
         logger.error(f"❌ Error: {e}")
-        logger.info("🔄 Keeping bot alive despite model error...")
+        # Runs in an executor thread, where sys.exit would only end the thread
+        logger.error("💥 Model loading failed; exiting so the supervisor can restart the container")
+        os._exit(1)
 
-def generate_response(user_question):
-    global loading_progress
-    
+def _format_answer(response):
+    return f"🤖 **[VOTRE MODÈLE PERSONNEL]**\n\n{response}\n\n---\n🎯 *Réponse générée par votre modèle Code-du-Travail-mistral-finetune*"
+
+def _loading_message():
+    progress = loading_progress
+    message = _LOADING_MSG_CACHE.get(progress)
+    if message is None:
+        message = _LOADING_MSG_CACHE[progress] = f"⏳ **Chargement de VOTRE modèle personnalisé...**\n\n📊 **Progression**: {progress}\n\n🎯 **Votre modèle**: Code-du-Travail-mistral-finetune\n⚖️ **Spécialité**: Droit du travail français\n\n⏰ Patientez quelques minutes, votre expertise arrive!"
+    return message
+
+def generate_response(user_question, streamer=None):
     if not model_loaded:
-        return f"⏳ **Chargement de VOTRE modèle personnalisé...**\n\n📊 **Progression**: {loading_progress}\n\n🎯 **Votre modèle**: Code-du-Travail-mistral-finetune\n⚖️ **Spécialité**: Droit du travail français\n\n⏰ Patientez quelques minutes, votre expertise arrive!"
+        return _loading_message()
+    
+    key = _cache_key(user_question, 200, TEMPERATURE, DO_SAMPLE)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
     
     try:
-        prompt = f"<s>[INST] {user_question} [/INST]"
-        inputs = tokenizer(prompt, return_tensors="pt")
+        input_ids, attention_mask = _encode_batch([user_question])
         
-        with torch.no_grad():
+        with torch.inference_mode():
             outputs = model.generate(
-                **inputs,
-                max_new_tokens=200,
-                temperature=0.7,
-                do_sample=True,
-                pad_token_id=tokenizer.eos_token_id
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                streamer=streamer
             )
         
-        response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        response = response.replace(prompt, "").strip()
+        response = tokenizer.decode(outputs[0][input_ids.shape[1]:], skip_special_tokens=True).strip()
         
-        return f"🤖 **[VOTRE MODÈLE PERSONNEL]**\n\n{response}\n\n---\n🎯 *Réponse générée par votre modèle Code-du-Travail-mistral-finetune*"
+        formatted = _format_answer(response)
+        if response:
+            _cache_set(key, formatted)
+        return formatted
         
     except Exception as e:
         logger.error(f"Generation error: {e}")
         return "❌ Erreur lors de la génération avec votre modèle."
 
+def _generate_and_close(streamer, *args):
+    """Run generate_response feeding streamer, always closing it (cache hits never touch it)"""
+    try:
+        return generate_response(*args, streamer=streamer)
+    finally:
+        streamer.end()
+
+def _encode_batch(user_texts):
+    """Left-padded ids and attention mask for several prompts (decoder-only models pad on the left)"""
+    input_ids, attention_mask = left_pad([_encode_prompt(text)[0] for text in user_texts], tokenizer.pad_token_id)
+    return input_ids.to(model.device), attention_mask.to(model.device)
+
+def _generate_batch(user_questions):
+    """Answer several questions with a single model.generate call; cache hits are not regenerated"""
+    if not model_loaded:
+        return [generate_response(question) for question in user_questions]
+    
+    keys = [_cache_key(question, 200, TEMPERATURE, DO_SAMPLE) for question in user_questions]
+    responses = [_cache_get(key) for key in keys]
+    pending = [i for i, response in enumerate(responses) if response is None]
+    if not pending:
+        return responses
+    
+    try:
+        input_ids, attention_mask = _encode_batch([user_questions[i] for i in pending])
+        
+        with torch.inference_mode():
+            outputs = model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask
+            )
+        
+        generated = tokenizer.batch_decode(outputs[:, input_ids.shape[1]:], skip_special_tokens=True)
+        for i, response in zip(pending, generated):
+            response = response.strip()
+            formatted = _format_answer(response)
+            if response:
+                _cache_set(keys[i], formatted)
+            responses[i] = formatted
+        
+    except Exception as e:
+        logger.error(f"Batch generation error: {e}")
+        for i in pending:
+            responses[i] = "❌ Erreur lors de la génération avec votre modèle."
+    
+    return responses
+
+async def _batch_worker():
+    """Drain the queue: a lone question is streamed, concurrent ones are generated as one batch"""
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        batch = [await _QUEUE.get()]
+        deadline = loop.time() + BATCH_WAIT_MS / 1000
+        
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_QUEUE.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        
+        try:
+            if len(batch) == 1:
+                question, streamer, _ = batch[0]
+                responses = [await asyncio.to_thread(_generate_and_close, streamer, question)]
+            else:
+                logger.info(f"Generating batch of {len(batch)} questions")
+                responses = await asyncio.to_thread(_generate_batch, [question for question, _, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            responses = None
+        finally:
+            # Batched answers are sent whole; ending the streamers lets each reply finish
+            for _, streamer, _ in batch:
+                streamer.end()
+        
+        if responses is not None:
+            for (_, _, future), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
+
+async def _stream_reply(update, streamer, generation):
+    """Reply as soon as text arrives and edit the message with new tokens at most every 400ms"""
+    loop = asyncio.get_running_loop()
+    message = None
+    partial = ""
+    last_edit = loop.time()
+    
+    while True:
+        chunk = await loop.run_in_executor(None, next, streamer, None)
+        if chunk is None:
+            break
+        
+        partial += chunk
+        if partial.strip() and loop.time() - last_edit >= 0.4:
+            if message is None:
+                message = await update.message.reply_text(partial + " ▌")
+            else:
+                await message.edit_text(partial + " ▌")
+            last_edit = loop.time()
+    
+    response = await generation
+    if message is None:
+        await update.message.reply_text(response)
+    else:
+        await message.edit_text(response)
+    return response
+
 async def start_command(update, context):
     status_emoji = "✅" if model_loaded else "⏳"
     status_text = "Opérationnel" if model_loaded else "En cours de chargement"
@@ -141,31 +438,73 @@ async def info_command(update, context):
         f"🎯 **Modèle**: Code-du-Travail-mistral-finetune"
     )
 
+# Greetings and too-short inputs get a canned reply instead of a model call
+_GREETINGS = re.compile(r"^\s*(salut|bonjour|bonsoir|coucou|hello|hi|merci|thx)\s*[!.]*\s*$", re.IGNORECASE)
+_MIN_QUESTION_CHARS = 6
+
+def _canned_reply(message):
+    """Reply for inputs not worth a generation, or None when the model should answer"""
+    if _GREETINGS.match(message):
+        return "👋 Je suis là pour vos questions sur le droit du travail. Posez-moi la vôtre!"
+    if len(message.strip()) < _MIN_QUESTION_CHARS:
+        return "❓ Pouvez-vous préciser votre question juridique?"
+    return None
+
 async def chat_message(update, context):
     try:
         user_message = update.message.text
         logger.info(f"👤 Question: {user_message}")
         
+        canned = _canned_reply(user_message)
+        if canned is not None:
+            await update.message.reply_text(canned)
+            return
+        
+        if not model_loaded:
+            # Spam during the load gets one banner per chat per interval, no typing action or generation thread
+            chat_id = update.effective_chat.id
+            now = time.monotonic()
+            if now - _LAST_SENT.get(chat_id, -_LOADING_REPLY_INTERVAL) < _LOADING_REPLY_INTERVAL:
+                return
+            _LAST_SENT[chat_id] = now
+            await update.message.reply_text(_loading_message())
+            return
+        
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-        response = generate_response(user_message)
-        await update.message.reply_text(response)
+        if VLLM_URL:
+            response = _format_answer(await generate_remote(f"[INST] {user_message} [/INST]", 200))
+            await update.message.reply_text(response)
+        else:
+            streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+            generation = asyncio.get_running_loop().create_future()
+            await _QUEUE.put((user_message, streamer, generation))
+            response = await _stream_reply(update, streamer, generation)
         
     except Exception as e:
         logger.error(f"Chat error: {e}")
         await update.message.reply_text("⚠️ Erreur temporaire.")
 
+async def _start_model_loading(app):
+    """Load the model in the default executor while the bot already answers, and start the batcher"""
+    global _QUEUE, _WORKER
+    _QUEUE = asyncio.Queue()
+    _WORKER = asyncio.create_task(_batch_worker())
+    asyncio.get_running_loop().run_in_executor(None, load_your_lora_model)
+
 def main():
+    global model_loaded, loading_progress
     try:
         logger.info("🚀 Starting YOUR specialized legal AI...")
         
-        # Start model loading in background
-        import threading
-        model_thread = threading.Thread(target=load_your_lora_model)
-        model_thread.daemon = True
-        model_thread.start()
+        if VLLM_URL:
+            model_loaded = True
+            loading_progress = "✅ Servi par vLLM"
         
-        # Start bot immediately
-        app = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
+        # Start bot immediately, loading the model in background
+        builder = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN'))
+        if not VLLM_URL:
+            builder = builder.post_init(_start_model_loading)
+        app = builder.build()
         app.add_handler(CommandHandler("start", start_command))
         app.add_handler(CommandHandler("info", info_command))
         app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, chat_message))
@@ -175,9 +514,8 @@ def main():
         
     except Exception as e:
         logger.error(f"Error: {e}")
-        import time
-        while True:
-            time.sleep(60)
+        logger.error("💥 Fatal error; exiting so the supervisor can restart the container")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
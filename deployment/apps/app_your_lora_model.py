@@ -1,18 +1,81 @@
 #!/usr/bin/env python3
 """Load YOUR LoRA fine-tuned model properly"""
 import os
+import asyncio
+import importlib.util
 import logging
+import sys
+
+# Bound oneDNN's primitive cache before torch initializes it; variable prompt shapes otherwise grow it by GBs
+os.environ.setdefault("ONEDNN_PRIMITIVE_CACHE_CAPACITY", "128")
+os.environ.setdefault("MKLDNN_PRIMITIVE_CACHE_CAPACITY", "128")
+
 import torch
+from compile_utils import PROMPT_BUCKET, compile_and_warm_up, left_pad
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
 from peft import PeftModel
 from huggingface_hub import login
+import gc
+
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 model = None
 tokenizer = None
+_PREFIX_IDS = None
+_SUFFIX_IDS = None
+
+# Micro-batching: questions arriving within the window (or while a generation runs) share one generate() call
+BATCH_SIZE = max(1, int(os.getenv('BATCH_SIZE', '8')))
+BATCH_WAIT_MS = int(os.getenv('BATCH_WAIT_MS', '50'))
+_QUEUE = None
+_WORKER = None
+# Periodic full collection so long-running workers release cyclic garbage from generation
+GC_EVERY_REQUESTS = 100
+_answered = 0
+
+# Greedy decoding settings shared by serving and the compile warm-up, so both build the same static cache
+_GENERATE_KWARGS = dict(max_new_tokens=200, use_cache=True, do_sample=False, num_beams=1, repetition_penalty=1.1)
+
+def _prepare_prompt_ids():
+    """Tokenize the fixed Mistral instruction wrapper once, right after the tokenizer loads"""
+    global _PREFIX_IDS, _SUFFIX_IDS
+    _PREFIX_IDS = tokenizer("<s>[INST] ", add_special_tokens=False, return_tensors="pt").input_ids[0]
+    _SUFFIX_IDS = tokenizer(" [/INST]", add_special_tokens=False, return_tensors="pt").input_ids[0]
+
+def _encode_batch(user_texts):
+    """Wrapped prompt ids, left-padded to a PROMPT_BUCKET multiple; only the user texts are tokenized per request"""
+    bodies = tokenizer(user_texts, add_special_tokens=False).input_ids
+    encoded = [torch.cat([_PREFIX_IDS, torch.tensor(body, dtype=torch.long), _SUFFIX_IDS]) for body in bodies]
+    # Bucketed even when eager: oneDNN caches a primitive per prompt shape
+    input_ids, attention_mask = left_pad(encoded, tokenizer.pad_token_id, bucket=PROMPT_BUCKET)
+    return {"input_ids": input_ids.to(model.device), "attention_mask": attention_mask.to(model.device)}
+
+# TF32 tensor cores for whatever fp32 matmuls remain on Ampere+ GPUs
+torch.backends.cuda.matmul.allow_tf32 = True
+
+# FlashAttention-2 when flash-attn is installed on a GPU host, fused SDPA otherwise
+ATTN_IMPLEMENTATION = (
+    "flash_attention_2"
+    if torch.cuda.is_available() and importlib.util.find_spec("flash_attn")
+    else "sdpa"
+)
+
+# One GPU: pin the whole model to it so accelerate adds no per-layer dispatch hooks; shard only across several
+DEVICE_MAP = {"": 0} if torch.cuda.device_count() == 1 else "auto"
+
+def _half_dtype():
+    """bf16 on GPUs with native support (Ampere+), fp16 elsewhere"""
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
 
 def load_your_lora_model():
     global model, tokenizer
@@ -28,18 +91,32 @@ def load_your_lora_model():
         base_model_name = "mistralai/Mistral-7B-Instruct-v0.3"
         logger.info(f"📥 Loading base model: {base_model_name}")
         
-        base_model = AutoModelForCausalLM.from_pretrained(
-            base_model_name,
-            torch_dtype=torch.float16,
-            device_map="cpu",
-            low_cpu_mem_usage=True
-        )
+        # Decode is bound by weight bytes per token: 4-bit NF4 on GPU, dynamic int8 on CPU (after the merge)
+        on_gpu = torch.cuda.is_available()
+        use_quantization = os.getenv('USE_QUANTIZATION', 'true').lower() == 'true'
+        load_kwargs = dict(low_cpu_mem_usage=True, attn_implementation=ATTN_IMPLEMENTATION)
+        if on_gpu:
+            load_kwargs.update(device_map=DEVICE_MAP, torch_dtype=_half_dtype())
+            if use_quantization:
+                load_kwargs["quantization_config"] = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_use_double_quant=True,
+                    bnb_4bit_compute_dtype=_half_dtype()
+                )
+        else:
+            # bitsandbytes needs CUDA; CPU int8 needs fp32 weights and CPU fp16 has no native kernels
+            load_kwargs.update(device_map="cpu", torch_dtype=torch.float32 if use_quantization else torch.bfloat16)
+        
+        base_model = AutoModelForCausalLM.from_pretrained(base_model_name, **load_kwargs)
         
         # Step 2: Load tokenizer
         logger.info("📝 Loading tokenizer...")
         tokenizer = AutoTokenizer.from_pretrained(base_model_name)
         if tokenizer.pad_token is None:
             tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.padding_side = "left"
+        _prepare_prompt_ids()
         
         # Step 3: Apply YOUR LoRA adapters
         lora_model_name = "Pyzeur/Code-du-Travail-mistral-finetune"
@@ -51,6 +128,24 @@ def load_your_lora_model():
             token=hf_token
         )
         
+        # Fold the adapters into the base weights so decode skips the extra LoRA matmuls
+        try:
+            model = model.merge_and_unload()
+            logger.info("🔗 LoRA adapters merged into base weights")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not merge LoRA adapters, keeping them unmerged: {e}")
+        model.eval()
+        del base_model
+        gc.collect()
+        
+        if not on_gpu and use_quantization:
+            # Embeddings and norms stay fp32; only the merged Linear layers become int8
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            gc.collect()
+            logger.info("⚡ Dynamic int8 quantization applied")
+        
+        compile_and_warm_up(model, tokenizer.eos_token_id, batch_sizes=range(1, BATCH_SIZE + 1), cache_implementation="static", **_GENERATE_KWARGS)
+        
         logger.info("✅ YOUR LoRA fine-tuned model loaded successfully!")
         logger.info("🏛️ Your Code du Travail expertise is now active!")
         
@@ -60,39 +155,74 @@ def load_your_lora_model():
         logger.error(f"❌ Failed to load YOUR LoRA model: {e}")
         raise
 
-def generate_legal_response(user_question):
-    """Generate response using YOUR fine-tuned model"""
+def generate_legal_responses(user_questions):
+    """Generate responses for several questions with one batched call to YOUR fine-tuned model"""
     try:
-        # Use your specialized prompt format
-        prompt = f"<s>[INST] {user_question} [/INST]"
-        
-        # Tokenize
-        inputs = tokenizer(prompt, return_tensors="pt")
+        # Use your specialized prompt format, left-padded to the bucket size
+        inputs = _encode_batch(user_questions)
         
         # Generate using YOUR fine-tuned model
-        with torch.no_grad():
+        with torch.inference_mode():
             outputs = model.generate(
                 **inputs,
-                max_new_tokens=200,
-                temperature=0.7,
-                do_sample=True,
-                top_p=0.9,
+                **_GENERATE_KWARGS,
+                cache_implementation="static",
                 pad_token_id=tokenizer.eos_token_id,
                 eos_token_id=tokenizer.eos_token_id
             )
         
-        # Decode response
-        response = tokenizer.decode(outputs[0], skip_special_tokens=True)
+        # Decode only the generated tokens (the prompts include padding)
+        responses = tokenizer.batch_decode(outputs[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True)
         
-        # Clean response
-        if prompt in response:
-            response = response.replace(prompt, "").strip()
-        
-        return response or "Je ne peux pas répondre à cette question."
+        return [response.strip() or "Je ne peux pas répondre à cette question." for response in responses]
         
     except Exception as e:
         logger.error(f"❌ Generation error: {e}")
-        return "Désolé, une erreur s'est produite."
+        return ["Désolé, une erreur s'est produite."] * len(user_questions)
+
+async def _batch_worker():
+    """Collect questions queued within BATCH_WAIT_MS (or during a generation) and answer them together"""
+    global _answered
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        batch = [await _QUEUE.get()]
+        deadline = loop.time() + BATCH_WAIT_MS / 1000
+        
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_QUEUE.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        
+        if len(batch) > 1:
+            logger.info(f"Generating batch of {len(batch)} questions")
+        
+        try:
+            responses = await asyncio.to_thread(generate_legal_responses, [question for question, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        
+        for (_, future), response in zip(batch, responses):
+            if not future.done():
+                future.set_result(response)
+        
+        _answered += len(batch)
+        if _answered >= GC_EVERY_REQUESTS:
+            _answered = 0
+            gc.collect()
+
+async def _ask(question):
+    """Queue a question for the batch worker and wait for its answer"""
+    future = asyncio.get_running_loop().create_future()
+    await _QUEUE.put((question, future))
+    return await future
 
 async def start_command(update, context):
     await update.message.reply_text(
@@ -129,8 +259,8 @@ async def chat_message(update, context):
         # Show typing
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
         
-        # Generate using YOUR model
-        response = generate_legal_response(user_message)
+        # Generate using YOUR model, batched with concurrent questions
+        response = await _ask(user_message)
         
         logger.info(f"🤖 Réponse de VOTRE modèle: {response[:100]}...")
         await update.message.reply_text(response)
@@ -139,7 +269,15 @@ async def chat_message(update, context):
         logger.error(f"❌ Chat error: {e}")
         await update.message.reply_text("⚠️ Erreur avec votre modèle. Veuillez réessayer.")
 
+async def _start_batch_worker(app):
+    global _QUEUE, _WORKER
+    _QUEUE = asyncio.Queue()
+    _WORKER = asyncio.create_task(_batch_worker())
+
 def main():
+    # One intra-op thread per CPU this container may actually use (os.cpu_count() reports the host)
+    torch.set_num_threads(len(os.sched_getaffinity(0)))
+    
     try:
         logger.info("🚀 Initializing YOUR fine-tuned legal AI...")
         
@@ -147,7 +285,7 @@ def main():
         load_your_lora_model()
         
         # Create bot
-        app = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
+        app = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).post_init(_start_batch_worker).build()
         
         # Add handlers
         app.add_handler(CommandHandler("start", start_command))
@@ -162,10 +300,8 @@ def main():
         
     except Exception as e:
         logger.error(f"❌ Failed to start YOUR model: {e}")
-        logger.info("🔄 Container staying alive for debugging...")
-        import time
-        while True:
-            time.sleep(60)
+        logger.error("💥 Fatal error; exiting so the supervisor can restart the container")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
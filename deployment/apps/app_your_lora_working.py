@@ -1,45 +1,177 @@
 #!/usr/bin/env python3
 """Working YOUR LoRA Model - CPU Compatible"""
 import os
+import asyncio
+import importlib.util
 import logging
+import sys
+
+# Bound oneDNN's primitive cache before torch initializes it; variable prompt shapes otherwise grow it by GBs
+os.environ.setdefault("ONEDNN_PRIMITIVE_CACHE_CAPACITY", "128")
+os.environ.setdefault("MKLDNN_PRIMITIVE_CACHE_CAPACITY", "128")
+
 import torch
+from compile_utils import PROMPT_BUCKET, compile_and_warm_up, left_pad
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
 from peft import PeftModel
 from huggingface_hub import login
 import gc
 
+try:
+    from llama_cpp import Llama
+except ImportError:
+    Llama = None
+
+try:
+    from optimum.onnxruntime import ORTModelForCausalLM
+except ImportError:
+    ORTModelForCausalLM = None
+
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 model = None
 tokenizer = None
+_PREFIX_IDS = None
+_SUFFIX_IDS = None
+
+# Micro-batching: questions arriving within the window (or while a generation runs) share one generate() call
+BATCH_SIZE = max(1, int(os.getenv('BATCH_SIZE', '8')))
+BATCH_WAIT_MS = int(os.getenv('BATCH_WAIT_MS', '50'))
+_QUEUE = None
+_WORKER = None
+# Periodic full collection so long-running workers release cyclic garbage from generation
+GC_EVERY_REQUESTS = 100
+_answered = 0
 model_loaded = False
+# Set when the background load fails; users are told instead of seeing the loading message forever
+load_error = None
+
+# Greedy decoding settings shared by serving and the compile warm-up, so both build the same static cache
+_GENERATE_KWARGS = dict(max_new_tokens=150, use_cache=True, do_sample=False, num_beams=1, repetition_penalty=1.1)
+
+# Merged + quantized GGUF export (deployment/scripts/export_gguf.sh) served by llama.cpp instead of PyTorch on CPU
+GGUF_MODEL_PATH = os.getenv('GGUF_MODEL_PATH')
+llm = None
+
+# Merged ONNX export (deployment/scripts/export_onnx.sh) run by ONNX Runtime's fused CPU graph
+ONNX_MODEL_PATH = os.getenv('ONNX_MODEL_PATH')
+
+_LOADING_MESSAGE = "⏳ Votre modèle Code du Travail est en cours de chargement... Veuillez patienter quelques minutes."
+_FAILED_MESSAGE = "❌ Le chargement de votre modèle a échoué. Le service doit être redémarré."
+
+def _prepare_prompt_ids():
+    """Tokenize the fixed Mistral instruction wrapper once, right after the tokenizer loads"""
+    global _PREFIX_IDS, _SUFFIX_IDS
+    _PREFIX_IDS = tokenizer("<s>[INST] ", add_special_tokens=False, return_tensors="pt").input_ids[0]
+    _SUFFIX_IDS = tokenizer(" [/INST]", add_special_tokens=False, return_tensors="pt").input_ids[0]
+
+def _encode_batch(user_texts):
+    """Wrapped prompt ids, left-padded to a PROMPT_BUCKET multiple; only the user texts are tokenized per request"""
+    bodies = tokenizer(user_texts, add_special_tokens=False).input_ids
+    encoded = [torch.cat([_PREFIX_IDS, torch.tensor(body, dtype=torch.long), _SUFFIX_IDS]) for body in bodies]
+    # Bucketed even when eager: oneDNN caches a primitive per prompt shape
+    input_ids, attention_mask = left_pad(encoded, tokenizer.pad_token_id, bucket=PROMPT_BUCKET)
+    return {"input_ids": input_ids.to(model.device), "attention_mask": attention_mask.to(model.device)}
+
+def _load_gguf():
+    """Load the GGUF model with llama.cpp's int4 CPU kernels"""
+    global llm
+    llm = Llama(model_path=GGUF_MODEL_PATH, n_threads=len(os.sched_getaffinity(0)), n_ctx=2048, verbose=False)
+    logger.info(f"✅ GGUF model loaded with llama.cpp: {GGUF_MODEL_PATH}")
+
+def _load_onnx():
+    """Load the ONNX export and its tokenizer on ONNX Runtime's CPU execution provider"""
+    global model, tokenizer
+    tokenizer = AutoTokenizer.from_pretrained(ONNX_MODEL_PATH)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    _prepare_prompt_ids()
+    
+    model = ORTModelForCausalLM.from_pretrained(ONNX_MODEL_PATH, provider="CPUExecutionProvider")
+    logger.info(f"✅ ONNX model loaded with ONNX Runtime: {ONNX_MODEL_PATH}")
+
+def _generate_gguf(user_question):
+    # llama.cpp adds the BOS token itself; temperature 0 decodes greedily like the PyTorch path
+    result = llm(f"[INST] {user_question} [/INST]", max_tokens=150, temperature=0, repeat_penalty=1.1)
+    return result["choices"][0]["text"].strip() or "Je ne peux pas répondre à cette question."
+
+# TF32 tensor cores for whatever fp32 matmuls remain on Ampere+ GPUs
+torch.backends.cuda.matmul.allow_tf32 = True
+
+# FlashAttention-2 when flash-attn is installed on a GPU host, fused SDPA otherwise
+ATTN_IMPLEMENTATION = (
+    "flash_attention_2"
+    if torch.cuda.is_available() and importlib.util.find_spec("flash_attn")
+    else "sdpa"
+)
+
+# One GPU: pin the whole model to it so accelerate adds no per-layer dispatch hooks; shard only across several
+DEVICE_MAP = {"": 0} if torch.cuda.device_count() == 1 else "auto"
+
+def _half_dtype():
+    """bf16 on GPUs with native support (Ampere+), fp16 elsewhere"""
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
 
 def load_your_lora_model():
-    global model, tokenizer, model_loaded
+    global model, tokenizer, model_loaded, load_error
     try:
         # Login
         hf_token = os.getenv('HF_TOKEN')
         if hf_token:
             login(token=hf_token)
         
+        if GGUF_MODEL_PATH:
+            if Llama is not None:
+                _load_gguf()
+                model_loaded = True
+                return True
+            logger.warning("⚠️ GGUF_MODEL_PATH is set but llama-cpp-python is not installed, using transformers")
+        
+        if ONNX_MODEL_PATH:
+            if ORTModelForCausalLM is not None:
+                _load_onnx()
+                model_loaded = True
+                return True
+            logger.warning("⚠️ ONNX_MODEL_PATH is set but optimum[onnxruntime] is not installed, using transformers")
+        
         logger.info("🎯 Loading YOUR LoRA model (CPU optimized)...")
         
         # Force cleanup
         gc.collect()
         
-        # Load base model with CPU optimization
+        # Load base model
         base_model_name = "mistralai/Mistral-7B-Instruct-v0.3"
-        logger.info(f"📥 Loading base model for CPU...")
-        
-        base_model = AutoModelForCausalLM.from_pretrained(
-            base_model_name,
-            torch_dtype=torch.float16,
-            device_map="cpu",
-            low_cpu_mem_usage=True,
-            trust_remote_code=True
-        )
+        logger.info(f"📥 Loading base model...")
+        
+        # Decode is bound by weight bytes per token: 4-bit NF4 on GPU, dynamic int8 on CPU (after the merge)
+        on_gpu = torch.cuda.is_available()
+        use_quantization = os.getenv('USE_QUANTIZATION', 'true').lower() == 'true'
+        load_kwargs = dict(low_cpu_mem_usage=True, trust_remote_code=True, attn_implementation=ATTN_IMPLEMENTATION)
+        if on_gpu:
+            load_kwargs.update(device_map=DEVICE_MAP, torch_dtype=_half_dtype())
+            if use_quantization:
+                load_kwargs["quantization_config"] = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_use_double_quant=True,
+                    bnb_4bit_compute_dtype=_half_dtype()
+                )
+        else:
+            # bitsandbytes needs CUDA; CPU int8 needs fp32 weights and CPU fp16 has no native kernels
+            load_kwargs.update(device_map="cpu", torch_dtype=torch.float32 if use_quantization else torch.bfloat16)
+        
+        base_model = AutoModelForCausalLM.from_pretrained(base_model_name, **load_kwargs)
         
         logger.info("✅ Base model loaded!")
         
@@ -47,6 +179,8 @@ def load_your_lora_model():
         tokenizer = AutoTokenizer.from_pretrained(base_model_name)
         if tokenizer.pad_token is None:
             tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.padding_side = "left"
+        _prepare_prompt_ids()
         
         logger.info("📝 Tokenizer loaded!")
         
@@ -60,6 +194,24 @@ def load_your_lora_model():
             token=hf_token
         )
         
+        # Fold the adapters into the base weights so decode skips the extra LoRA matmuls
+        try:
+            model = model.merge_and_unload()
+            logger.info("🔗 LoRA adapters merged into base weights")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not merge LoRA adapters, keeping them unmerged: {e}")
+        model.eval()
+        del base_model
+        gc.collect()
+        
+        if not on_gpu and use_quantization:
+            # Embeddings and norms stay fp32; only the merged Linear layers become int8
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            gc.collect()
+            logger.info("⚡ Dynamic int8 quantization applied")
+        
+        compile_and_warm_up(model, tokenizer.eos_token_id, batch_sizes=range(1, BATCH_SIZE + 1), cache_implementation="static", **_GENERATE_KWARGS)
+        
         model_loaded = True
         logger.info("✅ YOUR LoRA model loaded successfully!")
         logger.info("🏛️ Code du Travail expertise active!")
@@ -67,37 +219,86 @@ def load_your_lora_model():
         return True
         
     except Exception as e:
+        load_error = str(e)
         logger.error(f"❌ Error: {e}")
-        logger.info("🔄 Model loading failed, keeping bot alive...")
+        logger.error("💥 Model loading failed; the bot stays up and reports the failure to users")
 
-def generate_response(user_question):
+def generate_responses(user_questions):
+    """Answer several questions with one batched generate() call"""
     try:
         if not model_loaded:
-            return "⏳ Votre modèle Code du Travail est en cours de chargement... Veuillez patienter quelques minutes."
+            return [_FAILED_MESSAGE if load_error else _LOADING_MESSAGE] * len(user_questions)
         
-        prompt = f"<s>[INST] {user_question} [/INST]"
-        inputs = tokenizer(prompt, return_tensors="pt")
+        if llm is not None:
+            # llama.cpp decodes one sequence at a time
+            return [_generate_gguf(question) for question in user_questions]
         
-        with torch.no_grad():
+        inputs = _encode_batch(user_questions)
+        # ONNX Runtime manages its own past key/values; the static cache is for the PyTorch model
+        on_onnx = ORTModelForCausalLM is not None and isinstance(model, ORTModelForCausalLM)
+        
+        with torch.inference_mode():
             outputs = model.generate(
                 **inputs,
-                max_new_tokens=150,
-                temperature=0.7,
-                do_sample=True,
+                **_GENERATE_KWARGS,
+                cache_implementation=None if on_onnx else "static",
                 pad_token_id=tokenizer.eos_token_id
             )
         
-        response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        response = response.replace(prompt, "").strip()
+        responses = tokenizer.batch_decode(outputs[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True)
         
-        return response or "Je ne peux pas répondre à cette question."
+        return [response.strip() or "Je ne peux pas répondre à cette question." for response in responses]
         
     except Exception as e:
         logger.error(f"Generation error: {e}")
-        return "Erreur lors de la génération de la réponse."
+        return ["Erreur lors de la génération de la réponse."] * len(user_questions)
+
+async def _batch_worker():
+    """Collect questions queued within BATCH_WAIT_MS (or during a generation) and answer them together"""
+    global _answered
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        batch = [await _QUEUE.get()]
+        deadline = loop.time() + BATCH_WAIT_MS / 1000
+        
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_QUEUE.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        
+        if len(batch) > 1:
+            logger.info(f"Generating batch of {len(batch)} questions")
+        
+        try:
+            responses = await asyncio.to_thread(generate_responses, [question for question, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        
+        for (_, future), response in zip(batch, responses):
+            if not future.done():
+                future.set_result(response)
+        
+        _answered += len(batch)
+        if _answered >= GC_EVERY_REQUESTS:
+            _answered = 0
+            gc.collect()
+
+async def _ask(question):
+    """Queue a question for the batch worker and wait for its answer"""
+    future = asyncio.get_running_loop().create_future()
+    await _QUEUE.put((question, future))
+    return await future
 
 async def start_command(update, context):
-    status = "✅ Actif" if model_loaded else "⏳ En cours de chargement..."
+    status = "✅ Actif" if model_loaded else "❌ Échec du chargement" if load_error else "⏳ En cours de chargement..."
     await update.message.reply_text(
         f"🤖 **VOTRE Assistant Juridique Personnel**\n\n"
         f"🎯 **Modèle**: Code-du-Travail-mistral-finetune\n"
@@ -113,7 +314,7 @@ async def start_command(update, context):
     )
 
 async def info_command(update, context):
-    status = "Opérationnel" if model_loaded else "Chargement en cours"
+    status = "Opérationnel" if model_loaded else "Échec du chargement" if load_error else "Chargement en cours"
     await update.message.reply_text(
         f"🤖 **VOTRE Modèle Personnalisé**\n"
         f"• **Nom**: Code-du-Travail-mistral-finetune\n"
@@ -129,8 +330,12 @@ async def chat_message(update, context):
         user_message = update.message.text
         logger.info(f"👤 Question pour VOTRE modèle: {user_message}")
         
+        if not model_loaded:
+            await update.message.reply_text(_FAILED_MESSAGE if load_error else _LOADING_MESSAGE)
+            return
+        
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-        response = generate_response(user_message)
+        response = await _ask(user_message)
         
         logger.info(f"🤖 Réponse: {response[:50]}...")
         await update.message.reply_text(response)
@@ -139,18 +344,22 @@ async def chat_message(update, context):
         logger.error(f"Chat error: {e}")
         await update.message.reply_text("⚠️ Erreur temporaire.")
 
+async def _start_model_loading(app):
+    """Start the batch worker and load the model in the default executor; model_loaded is set once it can answer"""
+    global _QUEUE, _WORKER
+    _QUEUE = asyncio.Queue()
+    _WORKER = asyncio.create_task(_batch_worker())
+    asyncio.get_running_loop().run_in_executor(None, load_your_lora_model)
+
 def main():
+    # One intra-op thread per CPU this container may actually use (os.cpu_count() reports the host)
+    torch.set_num_threads(len(os.sched_getaffinity(0)))
+    
     try:
         logger.info("🚀 Starting YOUR specialized legal AI...")
         
-        # Start model loading in background
-        import threading
-        model_thread = threading.Thread(target=load_your_lora_model)
-        model_thread.daemon = True
-        model_thread.start()
-        
-        # Start bot immediately
-        app = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
+        # Start bot immediately, loading the model in background
+        app = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).post_init(_start_model_loading).build()
         app.add_handler(CommandHandler("start", start_command))
         app.add_handler(CommandHandler("info", info_command))
         app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, chat_message))
@@ -160,9 +369,8 @@ def main():
         
     except Exception as e:
         logger.error(f"Error: {e}")
-        import time
-        while True:
-            time.sleep(60)
+        logger.error("💥 Fatal error; exiting so the supervisor can restart the container")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,64 @@
+"""Opt-in torch.compile shared by the standalone apps, warmed up on the prompt shapes they serve"""
+import os
+import logging
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+logger = logging.getLogger(__name__)
+
+# CUDA graphs (mode="reduce-overhead") only exist on GPUs; on a CPU host inductor just burns minutes at startup
+TORCH_COMPILE = os.getenv('TORCH_COMPILE', 'false').lower() == 'true' and torch.cuda.is_available()
+
+# Compiled apps left-pad prompts to a multiple of this so the graphs and the static KV cache see few shapes
+PROMPT_BUCKET = 64
+WARMUP_WIDTHS = range(PROMPT_BUCKET, 4 * PROMPT_BUCKET + 1, PROMPT_BUCKET)
+
+def left_pad(sequences, pad_token_id, bucket=PROMPT_BUCKET if TORCH_COMPILE else 1):
+    """Left-pad 1-D id tensors into (input_ids, attention_mask), rounding the width up to a bucket multiple"""
+    longest = max(ids.shape[0] for ids in sequences)
+    width = -(-longest // bucket) * bucket
+    
+    input_ids = torch.full((len(sequences), width), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), width), dtype=torch.long)
+    for row, ids in enumerate(sequences):
+        input_ids[row, width - ids.shape[0]:] = ids
+        attention_mask[row, width - ids.shape[0]:] = 1
+    return input_ids, attention_mask
+
+class _StopAfter(StoppingCriteria):
+    """Ends a warm-up generation after a few steps; max_new_tokens, which sizes the static cache, stays as served"""
+    
+    def __init__(self, steps):
+        self.steps = steps
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        self.steps -= 1
+        return self.steps <= 0
+
+def compile_and_warm_up(model, pad_token_id, batch_sizes=(1,), widths=WARMUP_WIDTHS, **generate_kwargs):
+    """Compile the forward pass and pay the compile cost for every (batch size, prompt width) before the first request"""
+    if not TORCH_COMPILE:
+        return
+    
+    eager_forward = model.forward
+    try:
+        # CUDA graphs need fixed decode shapes: a static KV cache instead of one that grows every token
+        if getattr(model, "_supports_static_cache", False):
+            model.generation_config.cache_implementation = "static"
+        model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+        with torch.inference_mode():
+            for batch_size in batch_sizes:
+                for width in widths:
+                    input_ids = torch.full((batch_size, width), pad_token_id, dtype=torch.long, device=model.device)
+                    model.generate(
+                        input_ids=input_ids,
+                        attention_mask=torch.ones_like(input_ids),
+                        pad_token_id=pad_token_id,
+                        stopping_criteria=StoppingCriteriaList([_StopAfter(4)]),
+                        **generate_kwargs
+                    )
+        logger.info(f"⚡ Model forward compiled with torch.compile ({len(batch_sizes) * len(widths)} warm-up shapes)")
+    except Exception as e:
+        model.forward = eager_forward
+        model.generation_config.cache_implementation = None
+        logger.warning(f"⚠️ torch.compile unavailable, running eagerly: {e}")
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""Mistral generation server - loads the model once and serves bot workers over a Unix socket"""
+import os
+import asyncio
+import logging
+from app_mistral import MistralChatBot, read_frame, write_frame
+
+logger = logging.getLogger(__name__)
+
+SOCKET_PATH = os.getenv('GENERATOR_SOCKET', '/run/mistral.sock')
+
+class MistralGenerator:
+    def __init__(self):
+        # Reuse the bot's loading and micro-batching; requests from every worker share one batch queue
+        self.bot = MistralChatBot()
+        self.bot.generator_socket = None
+    
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                request = await read_frame(reader)
+                response = await self.bot.generate_response(request["prompt"])
+                write_frame(writer, {"response": response})
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception as e:
+            logger.error(f"❌ Generator client error: {e}")
+        finally:
+            writer.close()
+    
+    async def run(self):
+        await self.bot.load_model()
+        
+        if os.path.exists(SOCKET_PATH):
+            os.unlink(SOCKET_PATH)
+        server = await asyncio.start_unix_server(self.handle_client, path=SOCKET_PATH)
+        os.chmod(SOCKET_PATH, 0o660)
+        
+        logger.info(f"✅ Mistral generator listening on {SOCKET_PATH}")
+        async with server:
+            await server.serve_forever()
+
+if __name__ == "__main__":
+    asyncio.run(MistralGenerator().run())
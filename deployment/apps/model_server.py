@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Model server - loads YOUR LoRA model once and serves every bot variant over HTTP"""
+import os
+import re
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from transformers import TextIteratorStreamer
+from transformers.generation.streamers import BaseStreamer
+import app_your_lora_efficient as engine
+
+logger = logging.getLogger(__name__)
+
+PORT = int(os.getenv('MODEL_SERVER_PORT', '8080'))
+
+# Bots call /v1/completions with prompts already wrapped for Mistral Instruct
+_INST_PATTERN = re.compile(r"^\s*(?:<s>)?\s*\[INST\]\s*(.*?)\s*\[/INST\]\s*$", re.DOTALL)
+
+class _NullStreamer(BaseStreamer):
+    """The engine's batch queue expects a streamer; HTTP replies are sent whole"""
+    def put(self, value):
+        pass
+
+    def end(self):
+        pass
+
+class GenerateRequest(BaseModel):
+    prompt: str
+
+class CompletionRequest(BaseModel):
+    model: str = engine.VLLM_MODEL
+    prompt: str
+    max_tokens: int = 150
+    temperature: float = 0.7
+
+@asynccontextmanager
+async def lifespan(app):
+    # Reuse the engine's loader and micro-batcher: requests from every bot share one batch queue
+    await engine._start_model_loading(app)
+    yield
+
+app = FastAPI(title="YOUR LoRA model server", lifespan=lifespan)
+
+def _ensure_loaded():
+    if engine.model is None:
+        raise HTTPException(status_code=503, detail="Model is loading")
+
+async def _generate(question):
+    future = asyncio.get_running_loop().create_future()
+    await engine._QUEUE.put((question, _NullStreamer(), future))
+    return await future
+
+@app.get("/health")
+async def health():
+    _ensure_loaded()
+    return {"status": "ok"}
+
+@app.post("/generate")
+async def generate(request: GenerateRequest):
+    _ensure_loaded()
+    return {"text": await _generate(request.prompt)}
+
+@app.post("/generate/stream")
+async def generate_stream(request: GenerateRequest):
+    """Plain-text chunks as tokens are decoded; batched or cached answers arrive as one chunk"""
+    _ensure_loaded()
+    loop = asyncio.get_running_loop()
+    streamer = TextIteratorStreamer(engine.tokenizer, skip_prompt=True, skip_special_tokens=True)
+    future = loop.create_future()
+    await engine._QUEUE.put((request.prompt, streamer, future))
+    
+    async def chunks():
+        streamed = False
+        while True:
+            chunk = await loop.run_in_executor(None, next, streamer, None)
+            if chunk is None:
+                break
+            if chunk:
+                streamed = True
+                yield chunk
+        
+        response = await future
+        if not streamed:
+            yield response
+    
+    return StreamingResponse(chunks(), media_type="text/plain")
+
+@app.post("/v1/completions")
+async def completions(request: CompletionRequest):
+    """OpenAI-compatible subset, so bots pointed here through VLLM_URL work unchanged
+    (max_tokens and temperature are fixed by the engine)"""
+    _ensure_loaded()
+    match = _INST_PATTERN.match(request.prompt)
+    text = await _generate(match.group(1) if match else request.prompt)
+    return {
+        "object": "text_completion",
+        "model": request.model,
+        "choices": [{"index": 0, "text": text, "finish_reason": "stop"}]
+    }
+
+if __name__ == "__main__":
+    logger.info(f"🚀 Starting model server on port {PORT}...")
+    uvicorn.run(app, host="0.0.0.0", port=PORT)
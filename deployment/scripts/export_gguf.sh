@@ -0,0 +1,60 @@
+#!/bin/bash
+
+# 🧮 Export YOUR LoRA model to a quantized GGUF for llama.cpp CPU inference
+# Merges the adapters into Mistral-7B-Instruct-v0.3, converts with llama.cpp and quantizes to Q4_K_M
+# Usage: ./export_gguf.sh [output_dir] [quant_type]   (needs HF_TOKEN and a llama.cpp checkout in LLAMA_CPP_DIR)
+
+set -e
+
+OUTPUT_DIR="${1:-./models/gguf}"
+QUANT_TYPE="${2:-Q4_K_M}"
+LLAMA_CPP_DIR="${LLAMA_CPP_DIR:-./llama.cpp}"
+BASE_MODEL="mistralai/Mistral-7B-Instruct-v0.3"
+LORA_MODEL="Pyzeur/Code-du-Travail-mistral-finetune"
+
+RED='\033[0;31m'
+GREEN='\033[0;32m'
+BLUE='\033[0;34m'
+NC='\033[0m'
+
+print_status() { echo -e "${BLUE}[INFO]${NC} $1"; }
+print_success() { echo -e "${GREEN}[SUCCESS]${NC} $1"; }
+print_error() { echo -e "${RED}[ERROR]${NC} $1"; }
+
+if [ ! -f "$LLAMA_CPP_DIR/convert_hf_to_gguf.py" ]; then
+    print_error "llama.cpp not found in $LLAMA_CPP_DIR (git clone https://github.com/ggerganov/llama.cpp and build it)"
+    exit 1
+fi
+
+MERGED_DIR="$OUTPUT_DIR/merged"
+mkdir -p "$MERGED_DIR"
+
+print_status "Merging LoRA adapters into the fp16 base model..."
+python - "$BASE_MODEL" "$LORA_MODEL" "$MERGED_DIR" << 'EOF'
+import os
+import sys
+import torch
+from peft import PeftModel
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+base_model_name, lora_model_name, merged_dir = sys.argv[1:]
+token = os.getenv('HF_TOKEN')
+
+base_model = AutoModelForCausalLM.from_pretrained(base_model_name, torch_dtype=torch.float16, low_cpu_mem_usage=True, token=token)
+model = PeftModel.from_pretrained(base_model, lora_model_name, token=token).merge_and_unload()
+model.save_pretrained(merged_dir, safe_serialization=True)
+AutoTokenizer.from_pretrained(base_model_name, token=token).save_pretrained(merged_dir)
+EOF
+
+print_status "Converting to GGUF (f16)..."
+python "$LLAMA_CPP_DIR/convert_hf_to_gguf.py" "$MERGED_DIR" --outtype f16 --outfile "$OUTPUT_DIR/code-travail-f16.gguf"
+
+print_status "Quantizing to $QUANT_TYPE..."
+QUANTIZE_BIN="$LLAMA_CPP_DIR/build/bin/llama-quantize"
+[ -x "$QUANTIZE_BIN" ] || QUANTIZE_BIN="$LLAMA_CPP_DIR/llama-quantize"
+"$QUANTIZE_BIN" "$OUTPUT_DIR/code-travail-f16.gguf" "$OUTPUT_DIR/code-travail-$QUANT_TYPE.gguf" "$QUANT_TYPE"
+
+rm -rf "$MERGED_DIR" "$OUTPUT_DIR/code-travail-f16.gguf"
+
+print_success "GGUF model ready: $OUTPUT_DIR/code-travail-$QUANT_TYPE.gguf"
+echo "Set GGUF_MODEL_PATH to this file to serve it with app_your_lora_working.py"
@@ -0,0 +1,54 @@
+#!/bin/bash
+
+# 🧮 Export YOUR LoRA model to ONNX for ONNX Runtime CPU inference
+# Merges the adapters into Mistral-7B-Instruct-v0.3 and exports a text-generation-with-past graph with optimum
+# Usage: ./export_onnx.sh [output_dir]   (needs HF_TOKEN and pip install "optimum[onnxruntime]")
+
+set -e
+
+OUTPUT_DIR="${1:-./models/onnx}"
+BASE_MODEL="mistralai/Mistral-7B-Instruct-v0.3"
+LORA_MODEL="Pyzeur/Code-du-Travail-mistral-finetune"
+
+RED='\033[0;31m'
+GREEN='\033[0;32m'
+BLUE='\033[0;34m'
+NC='\033[0m'
+
+print_status() { echo -e "${BLUE}[INFO]${NC} $1"; }
+print_success() { echo -e "${GREEN}[SUCCESS]${NC} $1"; }
+print_error() { echo -e "${RED}[ERROR]${NC} $1"; }
+
+if ! command -v optimum-cli > /dev/null; then
+    print_error "optimum-cli not found (pip install \"optimum[onnxruntime]\")"
+    exit 1
+fi
+
+MERGED_DIR="$OUTPUT_DIR/merged"
+mkdir -p "$MERGED_DIR"
+
+print_status "Merging LoRA adapters into the fp32 base model..."
+python - "$BASE_MODEL" "$LORA_MODEL" "$MERGED_DIR" << 'EOF'
+import os
+import sys
+import torch
+from peft import PeftModel
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+base_model_name, lora_model_name, merged_dir = sys.argv[1:]
+token = os.getenv('HF_TOKEN')
+
+# ONNX Runtime's CPU kernels run fp32; exporting from fp16 would insert casts around every op
+base_model = AutoModelForCausalLM.from_pretrained(base_model_name, torch_dtype=torch.float32, low_cpu_mem_usage=True, token=token)
+model = PeftModel.from_pretrained(base_model, lora_model_name, token=token).merge_and_unload()
+model.save_pretrained(merged_dir, safe_serialization=True)
+AutoTokenizer.from_pretrained(base_model_name, token=token).save_pretrained(merged_dir)
+EOF
+
+print_status "Exporting to ONNX (text-generation-with-past)..."
+optimum-cli export onnx --model "$MERGED_DIR" --task text-generation-with-past "$OUTPUT_DIR/code-travail"
+
+rm -rf "$MERGED_DIR"
+
+print_success "ONNX model ready: $OUTPUT_DIR/code-travail"
+echo "Set ONNX_MODEL_PATH to this directory to serve it with app_your_lora_working.py"
@@ -1,5 +1,13 @@
 from abc import ABC, abstractmethod
-from typing import Any, Dict
+from typing import Any, Dict, Generator, List
+import os
+import torch
+
+def select_device() -> torch.device:
+    """Pick cuda when a GPU is usable; an empty CUDA_VISIBLE_DEVICES skips the CUDA driver probe"""
+    if os.environ.get("CUDA_VISIBLE_DEVICES") == "" or not torch.cuda.is_available():
+        return torch.device("cpu")
+    return torch.device("cuda")
 
 class BaseModel(ABC):
     """Base class for all models"""
@@ -14,6 +22,18 @@ class BaseModel(ABC):
         """Make a prediction"""
         pass
     
+    def predict_batch(self, input_texts: List[str]) -> List[Dict[str, Any]]:
+        """Make predictions for several inputs (override for a true batched forward pass)"""
+        return [self.predict(text) for text in input_texts]
+    
+    def supports_streaming(self) -> bool:
+        """Whether predict_stream can yield partial responses for the loaded model"""
+        return False
+    
+    def predict_stream(self, input_text: str) -> Generator[str, None, Dict[str, Any]]:
+        """Yield the partial response as it is generated and return the final prediction"""
+        raise NotImplementedError(f"{type(self).__name__} does not support streaming")
+    
     @abstractmethod
     def get_model_info(self) -> Dict[str, Any]:
         """Get information about the model"""
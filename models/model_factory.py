@@ -1,10 +1,92 @@
-from .transformer_model import TransformerModel
-from .universal_model import UniversalModel
-from config.settings import settings
+from config.settings import get_settings
+from functools import lru_cache
+import importlib
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 
+_UNIVERSAL_MODEL = 'models.universal_model:UniversalModel'
+
+@lru_cache(maxsize=None)
+def _resolve(spec: str):
+    """Import a 'module:Class' handler on first use, so listing models does not import torch/transformers"""
+    module_name, class_name = spec.split(':')
+    return getattr(importlib.import_module(module_name), class_name)
+
+# Static catalogues returned by ModelFactory, built once at import
+_POPULAR_MODELS = {
+    'chat_models': (
+        'microsoft/DialoGPT-medium',
+        'microsoft/DialoGPT-large',
+        'facebook/blenderbot-400M-distill',
+        'Pyzeur/Code-du-Travail-mistral-finetune'  # Your model
+    ),
+    'generation_models': (
+        'gpt2',
+        'gpt2-medium',
+        'mistralai/Mistral-7B-Instruct-v0.1',
+        'microsoft/phi-2',
+        'google/gemma-2b-it'
+    ),
+    'classification_models': (
+        'cardiffnlp/twitter-roberta-base-sentiment-latest',
+        'nlptown/bert-base-multilingual-uncased-sentiment',
+        'distilbert-base-uncased-finetuned-sst-2-english'
+    ),
+    'qa_models': (
+        'distilbert-base-cased-distilled-squad',
+        'deepset/roberta-base-squad2',
+        'google/tapas-base-finetuned-wtq'
+    ),
+    'multilingual_models': (
+        'Helsinki-NLP/opus-mt-en-fr',
+        'google/mt5-small',
+        'facebook/mbart-large-50-many-to-many-mmt'
+    )
+}
+
+_RECOMMENDATIONS = {
+    'chat': (
+        {
+            'name': 'Pyzeur/Code-du-Travail-mistral-finetune',
+            'description': 'Fine-tuned model for French legal/work code questions',
+            'best_for': 'French legal queries and Code du Travail questions'
+        },
+        {
+            'name': 'microsoft/DialoGPT-medium',
+            'description': 'General purpose conversational model',
+            'best_for': 'General chat and conversation'
+        },
+        {
+            'name': 'mistralai/Mistral-7B-Instruct-v0.1',
+            'description': 'Powerful instruction-following model',
+            'best_for': 'Complex reasoning and detailed responses'
+        },
+    ),
+    'classification': (
+        {
+            'name': 'cardiffnlp/twitter-roberta-base-sentiment-latest',
+            'description': 'Sentiment analysis model',
+            'best_for': 'Analyzing sentiment in text'
+        },
+    ),
+    'qa': (
+        {
+            'name': 'distilbert-base-cased-distilled-squad',
+            'description': 'Question answering model',
+            'best_for': 'Extracting answers from documents'
+        },
+    ),
+    'generation': (
+        {
+            'name': 'gpt2-medium',
+            'description': 'Text generation model',
+            'best_for': 'Creative writing and text completion'
+        },
+    )
+}
+
 class ModelFactory:
     """
     Universal Factory for creating any AI model from HuggingFace
@@ -12,11 +94,16 @@ class ModelFactory:
     """
     
     AVAILABLE_MODELS = {
-        'transformer': TransformerModel,
-        'universal': UniversalModel,
-        'auto': UniversalModel,  # Alias for universal
+        'transformer': 'models.transformer_model:TransformerModel',
+        'universal': _UNIVERSAL_MODEL,
+        'auto': _UNIVERSAL_MODEL,  # Alias for universal
     }
     
+    # One loaded model per process, shared by every handler that asks for it
+    _instance = None
+    _instance_key = None
+    _instance_lock = threading.Lock()
+    
     @classmethod
     def create_model(cls, model_type: str = None, model_name: str = None, **kwargs):
         """
@@ -30,6 +117,7 @@ class ModelFactory:
         Returns:
             Model instance ready for loading
         """
+        settings = get_settings()
         
         # Get model type from settings or use default
         if model_type is None:
@@ -39,20 +127,44 @@ class ModelFactory:
         if model_name is None:
             model_name = getattr(settings, 'MODEL_NAME', 'microsoft/DialoGPT-medium')
         
-        model_class = cls.AVAILABLE_MODELS.get(model_type)
+        spec = cls.AVAILABLE_MODELS.get(model_type)
         
-        if not model_class:
+        if not spec:
             logger.warning(f"Unknown model type: {model_type}. Using UniversalModel")
-            model_class = UniversalModel
+            spec = _UNIVERSAL_MODEL
         
         logger.info(f"Creating {model_type} model with {model_name}")
+        model_class = _resolve(spec)
         
         # Create model instance with configuration
-        if model_class == UniversalModel:
+        if spec == _UNIVERSAL_MODEL:
             return model_class(model_name=model_name, model_config=kwargs)
         else:
             return model_class(**kwargs)
     
+    @classmethod
+    def get_or_create(cls, model_type: str = None, model_name: str = None, **kwargs):
+        """
+        Return the process-wide loaded model, creating and loading it on first use
+        
+        Asking for a different model type/name replaces the shared instance,
+        so the factory keeps at most one model loaded
+        """
+        settings = get_settings()
+        model_type = model_type or getattr(settings, 'MODEL_TYPE', 'universal')
+        model_name = model_name or getattr(settings, 'MODEL_NAME', 'microsoft/DialoGPT-medium')
+        key = (model_type, model_name)
+        
+        with cls._instance_lock:
+            if cls._instance is None or cls._instance_key != key:
+                # Release the factory's reference before loading the replacement
+                cls._instance = None
+                model = cls.create_model(model_type=model_type, model_name=model_name, **kwargs)
+                model.load_model(model_name)
+                cls._instance, cls._instance_key = model, key
+            
+            return cls._instance
+    
     @classmethod
     def create_from_config(cls, config: dict):
         """
@@ -83,36 +195,7 @@ class ModelFactory:
     @classmethod
     def get_popular_models(cls):
         """Get a list of popular/recommended models by category"""
-        return {
-            'chat_models': [
-                'microsoft/DialoGPT-medium',
-                'microsoft/DialoGPT-large',
-                'facebook/blenderbot-400M-distill',
-                'Pyzeur/Code-du-Travail-mistral-finetune'  # Your model
-            ],
-            'generation_models': [
-                'gpt2',
-                'gpt2-medium',
-                'mistralai/Mistral-7B-Instruct-v0.1',
-                'microsoft/phi-2',
-                'google/gemma-2b-it'
-            ],
-            'classification_models': [
-                'cardiffnlp/twitter-roberta-base-sentiment-latest',
-                'nlptown/bert-base-multilingual-uncased-sentiment',
-                'distilbert-base-uncased-finetuned-sst-2-english'
-            ],
-            'qa_models': [
-                'distilbert-base-cased-distilled-squad',
-                'deepset/roberta-base-squad2',
-                'google/tapas-base-finetuned-wtq'
-            ],
-            'multilingual_models': [
-                'Helsinki-NLP/opus-mt-en-fr',
-                'google/mt5-small',
-                'facebook/mbart-large-50-many-to-many-mmt'
-            ]
-        }
+        return _POPULAR_MODELS
     
     @classmethod
     def get_model_recommendations(cls, use_case: str = 'chat'):
@@ -122,45 +205,4 @@ class ModelFactory:
         Args:
             use_case: 'chat', 'classification', 'qa', 'generation', 'translation'
         """
-        recommendations = {
-            'chat': [
-                {
-                    'name': 'Pyzeur/Code-du-Travail-mistral-finetune',
-                    'description': 'Fine-tuned model for French legal/work code questions',
-                    'best_for': 'French legal queries and Code du Travail questions'
-                },
-                {
-                    'name': 'microsoft/DialoGPT-medium',
-                    'description': 'General purpose conversational model',
-                    'best_for': 'General chat and conversation'
-                },
-                {
-                    'name': 'mistralai/Mistral-7B-Instruct-v0.1',
-                    'description': 'Powerful instruction-following model',
-                    'best_for': 'Complex reasoning and detailed responses'
-                }
-            ],
-            'classification': [
-                {
-                    'name': 'cardiffnlp/twitter-roberta-base-sentiment-latest',
-                    'description': 'Sentiment analysis model',
-                    'best_for': 'Analyzing sentiment in text'
-                }
-            ],
-            'qa': [
-                {
-                    'name': 'distilbert-base-cased-distilled-squad',
-                    'description': 'Question answering model',
-                    'best_for': 'Extracting answers from documents'
-                }
-            ],
-            'generation': [
-                {
-                    'name': 'gpt2-medium',
-                    'description': 'Text generation model',
-                    'best_for': 'Creative writing and text completion'
-                }
-            ]
-        }
-        
-        return recommendations.get(use_case, recommendations['chat'])
+        return _RECOMMENDATIONS.get(use_case, _RECOMMENDATIONS['chat'])
@@ -1,42 +1,54 @@
 from transformers import AutoTokenizer, AutoModelForSequenceClassification
 import torch
 from typing import Dict, Any
-from .base_model import BaseModel
+from .base_model import BaseModel, select_device
 
 class TransformerModel(BaseModel):
     def __init__(self):
         self.model = None
         self.tokenizer = None
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # Selected on load so constructing a model does not initialize CUDA
+        self.device = None
     
     def load_model(self, model_path: str):
         """Load the transformer model"""
+        if self.device is None:
+            self.device = select_device()
+        
         self.tokenizer = AutoTokenizer.from_pretrained(model_path)
         self.model = AutoModelForSequenceClassification.from_pretrained(model_path)
         self.model.to(self.device)
+        
+        # bf16 doubles tensor-core throughput on Ampere+ with fp32's range, so classification is unaffected
+        if self.device.type == 'cuda' and torch.cuda.is_bf16_supported():
+            self.model.to(torch.bfloat16)
         self.model.eval()
     
-    def predict(self, input_text: str) -> Dict[str, Any]:
-        """Make prediction using the transformer model"""
-        inputs = self.tokenizer(input_text, return_tensors="pt", truncation=True, max_length=512)
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+    def predict(self, input_text: str, return_logits: bool = False) -> Dict[str, Any]:
+        """Make prediction using the transformer model (raw logits only when return_logits is set)"""
+        # A single unpadded sequence needs no attention mask; the model defaults to attending every token
+        inputs = self.tokenizer(
+            input_text, return_tensors="pt", truncation=True, max_length=512, return_attention_mask=False
+        ).to(self.device)
         
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-            predictions = torch.nn.functional.softmax(outputs.logits, dim=-1)
-            predicted_class = torch.argmax(predictions, dim=-1).item()
-            confidence = predictions[0][predicted_class].item()
+        with torch.inference_mode():
+            logits = self.model(**inputs).logits[0]
+            confidence, predicted_class = torch.softmax(logits.float(), dim=-1).max(dim=-1)
         
-        return {
-            "predicted_class": predicted_class,
-            "confidence": confidence,
-            "raw_outputs": outputs.logits.cpu().numpy().tolist()
+        result = {
+            "predicted_class": predicted_class.item(),
+            "confidence": confidence.item()
         }
+        
+        if return_logits:
+            result["raw_outputs"] = [logits.tolist()]
+        
+        return result
     
     def get_model_info(self) -> Dict[str, Any]:
         """Get model information"""
         return {
             "type": "transformer",
-            "device": str(self.device),
+            "device": str(self.device or "not selected"),
             "loaded": self.model is not None
         }
\ No newline at end of file
@@ -3,32 +3,118 @@ Universal Model Handler for any HuggingFace model
 Supports text generation, classification, Q&A tasks, and PEFT/LoRA models
 """
 
+import os
+
+# Grow allocator segments instead of keeping fragmented blocks across generate() calls of varying lengths;
+# read on the first CUDA allocation, so setting it here (and only if unset) precedes any model load
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512")
+
 import torch
 import logging
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Generator, Optional, List
 from transformers import (
+    AutoConfig,
     AutoTokenizer, 
     AutoModelForCausalLM, 
     AutoModelForSequenceClassification,
     AutoModelForQuestionAnswering,
-    pipeline,
-    BitsAndBytesConfig
+    AutoModelForSeq2SeqLM,
+    TextIteratorStreamer
 )
-from .base_model import BaseModel
-from config.settings import settings
+from .base_model import BaseModel, select_device
+from config.settings import get_settings
+from functools import lru_cache
+import importlib.util
 import json
 import re
+import threading
+import weakref
 
 logger = logging.getLogger(__name__)
 
+# Response cleanup patterns; one alternation strips XML-like tags (incl. Gemma's <start_of_turn>/<end_of_turn>)
+# and Mistral's [INST]/[/INST] in a single pass
+_RE_STRIP = re.compile(r'<[^>]+>|\[/?INST\]')
+_RE_WS = re.compile(r'\s+')
+
+# Model name fragments -> task, in priority order ('dialogpt' matches 'gpt'; 'roberta'/'distilbert' match 'bert')
+_MODEL_TO_TASK = {
+    'gpt': 'text-generation',
+    'llama': 'text-generation',
+    'mistral': 'text-generation',
+    'gemma': 'text-generation',
+    'phi': 'text-generation',
+    't5': 'text2text-generation',
+    'bart': 'text2text-generation',
+    'pegasus': 'text2text-generation',
+    'bert': 'text-classification',
+}
+_TASK_RE = re.compile('|'.join(_MODEL_TO_TASK))
+_TASK_PRIORITY = tuple(dict.fromkeys(_MODEL_TO_TASK.values()))
+
+# Chat templates by model family, checked in order; other models get the raw text
+_PROMPT_TEMPLATES = (
+    (('mistral',), "<s>[INST] {text} [/INST]"),
+    (('mixtral',), "<s>[INST] {text} [/INST]"),
+    (('llama', 'chat'), "<s>[INST] {text} [/INST]"),
+    (('phi',), "Instruct: {text}\nOutput:"),
+    (('gemma',), "<start_of_turn>user\n{text}<end_of_turn>\n<start_of_turn>model\n"),
+)
+
+# PEFT detection results survive restarts so load_model skips the Hub file listing
+_PEFT_DETECT_PATH = os.path.expanduser("~/.cache/aidal/peft_detect.json")
+_peft_detect_lock = threading.Lock()
+
+def _read_peft_detect() -> Dict[str, bool]:
+    try:
+        with open(_PEFT_DETECT_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_peft_detect(model_name: str, is_peft: bool):
+    with _peft_detect_lock:
+        detected = _read_peft_detect()
+        detected[model_name] = is_peft
+        try:
+            os.makedirs(os.path.dirname(_PEFT_DETECT_PATH), exist_ok=True)
+            with open(_PEFT_DETECT_PATH, 'w') as f:
+                json.dump(detected, f)
+        except OSError as e:
+            logger.debug(f"Could not persist PEFT detection: {e}")
+
+def _cached_hub_file(model_name: str, filename: str) -> Optional[str]:
+    """Path of filename in the local HF cache, without any network call"""
+    from huggingface_hub import try_to_load_from_cache
+    path = try_to_load_from_cache(model_name, filename)
+    return path if isinstance(path, str) else None
+
+# bitsandbytes dequantizes on every matmul, which only pays off once fp16 weights are this large (~7B models)
+_QUANTIZE_MIN_PARAMS = 6e9
+
+# Compiled generation left-pads prompts to a multiple of this so only a few input shapes are ever traced
+_PROMPT_BUCKET = 64
+
+# Loaded instances by (model name, device, load options); a second instance for the same model adopts the
+# first one's weights instead of loading them again. Entries vanish once no instance holds the model
+_LOADED_MODELS = weakref.WeakValueDictionary()
+_SHARED_STATE = (
+    'model', 'tokenizer', 'task_type', 'is_peft_model', 'quantized', '_compiled',
+    '_eos_id', '_pad_id', '_prompt_ids', '_generate_lock'
+)
+
+# Returned without touching the model for empty / whitespace-only input
+_EMPTY_INPUT_RESULT = {'response': "Please send a message with some text.", 'confidence': 0.0}
+
 class UniversalModel(BaseModel):
     """
     Universal model handler that can work with any HuggingFace model
-    Automatically detects model type and configures appropriate pipelines
+    Automatically detects model type and runs the matching model head directly
     Supports PEFT/LoRA fine-tuned models
     """
     
     def __init__(self, model_name: str = None, model_config: Dict = None):
+        settings = get_settings()
         super().__init__()
         self.model_name = model_name or getattr(settings, 'MODEL_NAME', 'microsoft/DialoGPT-medium')
         self.model_config = model_config or {}
@@ -36,13 +122,27 @@ class UniversalModel(BaseModel):
         # Model components
         self.tokenizer = None
         self.model = None
-        self.pipeline = None
         self.is_peft_model = False
         
         # Device and optimization settings
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # Selected on load so constructing a model does not initialize CUDA
+        self.device = None
         self.use_quantization = getattr(settings, 'USE_QUANTIZATION', False)
+        self.quantization_bits = int(getattr(settings, 'QUANTIZATION_BITS', 4))
+        self.quantized = False
         self.max_length = int(getattr(settings, 'MAX_LENGTH', 512))
+        self.use_compile = getattr(settings, 'USE_COMPILE', False)
+        self.trust_remote_code = getattr(settings, 'TRUST_REMOTE_CODE', False)
+        self._compiled = False
+        # generate() keeps one KV cache on the model, so generation calls from worker threads take turns
+        self._generate_lock = threading.Lock()
+        # The model name is fixed per instance, so the prompt template is resolved once
+        self._prompt_template = self._resolve_prompt_template(self.model_name)
+        # Special token ids, resolved once the tokenizer is loaded
+        self._eos_id = None
+        self._pad_id = None
+        # Token ids around the user text in the prompt template, tokenized once
+        self._prompt_ids = None
         
         # Task detection
         self.task_type = None
@@ -53,8 +153,24 @@ class UniversalModel(BaseModel):
         
         logger.info(f"Initializing UniversalModel with {self.model_name}")
     
-    def _check_if_peft_model(self, model_name: str) -> bool:
+    @property
+    def _on_gpu(self) -> bool:
+        return self.device is not None and self.device.type == "cuda"
+    
+    def _compute_dtype(self) -> torch.dtype:
+        """bf16 on GPUs with native support (Ampere+), fp16 on older GPUs, fp32 on CPU"""
+        if not self._on_gpu:
+            return torch.float32
+        return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _check_if_peft_model(model_name: str) -> bool:
         """Check if the model is a PEFT/LoRA model by looking for adapter files"""
+        detected = _read_peft_detect().get(model_name)
+        if detected is not None:
+            return detected
+        
         try:
             from huggingface_hub import HfApi
             api = HfApi()
@@ -68,20 +184,24 @@ class UniversalModel(BaseModel):
             full_model_files = ['pytorch_model.bin', 'model.safetensors']
             has_full_model = any(f in files for f in full_model_files)
             
-            return has_peft_files and not has_full_model
+            is_peft = has_peft_files and not has_full_model
+            _write_peft_detect(model_name, is_peft)
+            return is_peft
             
         except Exception as e:
             logger.warning(f"Could not check model type: {e}")
-            return False
+            # Offline: a locally cached adapter config still identifies a PEFT model
+            return _cached_hub_file(model_name, "adapter_config.json") is not None
     
-    def _get_base_model_name(self, model_name: str) -> str:
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _get_base_model_name(model_name: str) -> str:
         """Get the base model name for a PEFT model"""
         try:
             from huggingface_hub import hf_hub_download
-            import json
             
-            # Download adapter config to find base model
-            config_path = hf_hub_download(model_name, "adapter_config.json")
+            # Read the adapter config from the local cache, downloading it only on first use
+            config_path = _cached_hub_file(model_name, "adapter_config.json") or hf_hub_download(model_name, "adapter_config.json")
             with open(config_path, 'r') as f:
                 adapter_config = json.load(f)
             
@@ -94,10 +214,30 @@ class UniversalModel(BaseModel):
             # Default to Mistral 7B Instruct for Code du Travail models
             return "mistralai/Mistral-7B-Instruct-v0.1"
     
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _has_own_tokenizer(model_name: str) -> bool:
+        """Whether a (PEFT adapter) repo ships its own tokenizer files"""
+        if _cached_hub_file(model_name, "tokenizer_config.json") is not None:
+            return True
+        
+        try:
+            from huggingface_hub import file_exists
+            return file_exists(model_name, "tokenizer_config.json")
+        except Exception as e:
+            logger.warning(f"Could not check for an adapter tokenizer: {e}")
+            return True
+    
     def load_model(self, model_path: str = None):
         """Load any HuggingFace model dynamically with improved error handling and PEFT support"""
+        if self.device is None:
+            self.device = select_device()
+        
+        model_name = model_path or self.model_name
+        if self._adopt_loaded_model(model_name):
+            return
+        
         try:
-            model_name = model_path or self.model_name
             logger.info(f"Loading model: {model_name}")
             
             # Check if this is a PEFT model
@@ -111,9 +251,12 @@ class UniversalModel(BaseModel):
                 # Load regular model
                 self._load_regular_model(model_name)
             
-            # Create pipeline
-            self._create_pipeline()
+            self._place_model()
+            self.model.eval()
+            self._configure_kv_cache()
+            self._compile_and_warm_up()
             
+            _LOADED_MODELS[self._load_key(model_name)] = self
             logger.info(f"✅ Model loaded successfully: {model_name} ({'PEFT' if self.is_peft_model else 'Regular'})")
             
         except Exception as e:
@@ -121,6 +264,26 @@ class UniversalModel(BaseModel):
             # Fallback to a simple working model
             self._load_fallback_model()
     
+    def _load_key(self, model_name: str) -> tuple:
+        """Everything that changes the loaded weights or how they are run"""
+        return (
+            model_name, str(self.device), self.use_quantization, self.quantization_bits,
+            self.use_compile, self.model_config.get('merge_adapters')
+        )
+    
+    def _adopt_loaded_model(self, model_name: str) -> bool:
+        """Share the weights of another live instance that loaded the same model with the same options"""
+        loaded = _LOADED_MODELS.get(self._load_key(model_name))
+        if loaded is None or loaded is self or not loaded._is_ready():
+            return False
+        
+        # The generate lock travels with the model: both instances drive the same KV cache
+        for name in _SHARED_STATE:
+            setattr(self, name, getattr(loaded, name))
+        _LOADED_MODELS[self._load_key(model_name)] = self
+        logger.info(f"♻️ Reusing already loaded model: {model_name}")
+        return True
+    
     def _load_peft_model(self, model_name: str):
         """Load PEFT/LoRA model"""
         try:
@@ -133,30 +296,44 @@ class UniversalModel(BaseModel):
             base_model_name = self._get_base_model_name(model_name)
             logger.info(f"Base model: {base_model_name}")
             
-            # Load tokenizer from the fine-tuned model (it might have special tokens)
-            self.tokenizer = self._load_tokenizer_safely(model_name)
+            # Adapters usually reuse the base vocabulary; only load the adapter repo's tokenizer when it ships one
+            tokenizer_source = model_name if self._has_own_tokenizer(model_name) else base_model_name
+            self.tokenizer = self._load_tokenizer_safely(tokenizer_source)
             
             # Detect task type
             self.task_type = self._detect_task_type(base_model_name)
+            self._configure_tokenizer()
             
-            # Load base model
-            logger.info("Loading base model...")
-            base_model = AutoModelForCausalLM.from_pretrained(
+            # Load base model (4-bit NF4 / 8-bit on GPU when USE_QUANTIZATION is set)
+            quantization_config = self._build_quantization_config(base_model_name)
+            logger.info(f"Loading base model{' (quantized)' if quantization_config else ''}...")
+            base_model = self._load_causal_lm(
                 base_model_name,
-                torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                device_map="auto" if torch.cuda.is_available() else None,
-                trust_remote_code=True,
+                torch_dtype=self._compute_dtype(),
+                device_map=self._device_map(),
+                quantization_config=quantization_config,
+                trust_remote_code=self.trust_remote_code,
                 low_cpu_mem_usage=True
             )
             
+            # Tokens added during fine-tuning need embedding rows before the adapter weights are attached
+            if len(self.tokenizer) > base_model.get_input_embeddings().num_embeddings:
+                base_model.resize_token_embeddings(len(self.tokenizer))
+            
             # Load PEFT adapter
             logger.info("Loading PEFT adapter...")
             self.model = PeftModel.from_pretrained(
                 base_model, 
                 model_name,
-                torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+                torch_dtype=self._compute_dtype(),
             )
             
+            # Fold W0 + BA into the base weights so each Linear is one matmul at inference;
+            # 4-bit packed weights cannot absorb the adapters, so quantized models keep them unmerged
+            if self.model_config.get('merge_adapters', quantization_config is None):
+                self.model = self.model.merge_and_unload()
+                logger.info("🔗 LoRA adapters merged into base weights")
+            
             logger.info("✅ PEFT model loaded successfully")
             
         except ImportError:
@@ -181,30 +358,106 @@ class UniversalModel(BaseModel):
         
         # Detect task type from model config
         self.task_type = self._detect_task_type(model_name)
+        self._configure_tokenizer()
         
         # Configure quantization if enabled
-        quantization_config = None
-        if self.use_quantization and torch.cuda.is_available():
-            quantization_config = BitsAndBytesConfig(
-                load_in_4bit=True,
-                bnb_4bit_compute_dtype=torch.float16,
-                bnb_4bit_use_double_quant=True,
-                bnb_4bit_quant_type="nf4"
-            )
+        quantization_config = self._build_quantization_config(model_name)
         
         # Load model based on detected task with error handling
         self.model = self._load_model_safely(model_name, quantization_config)
     
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _estimate_num_params(model_name: str, trust_remote_code: bool = False) -> Optional[float]:
+        """Approximate transformer parameter count (12 * hidden^2 * layers) from the model config"""
+        try:
+            config = AutoConfig.from_pretrained(model_name, trust_remote_code=trust_remote_code)
+        except Exception as e:
+            logger.debug(f"Could not read config for {model_name}: {e}")
+            return None
+        
+        hidden_size = getattr(config, 'hidden_size', None) or getattr(config, 'd_model', None)
+        num_layers = getattr(config, 'num_hidden_layers', None) or getattr(config, 'num_layers', None)
+        if not hidden_size or not num_layers:
+            return None
+        return 12 * hidden_size ** 2 * num_layers
+    
+    def _should_quantize(self, model_name: str) -> bool:
+        """Quantize only models large enough to amortize dequantization, or too large for half precision in VRAM"""
+        num_params = self._estimate_num_params(model_name, self.trust_remote_code)
+        if num_params is None:
+            return True
+        
+        half_bytes = num_params * 2
+        fits_in_vram = half_bytes < 0.9 * torch.cuda.get_device_properties(self.device).total_memory
+        if num_params < _QUANTIZE_MIN_PARAMS and fits_in_vram:
+            logger.info(f"📏 {model_name} has ~{num_params / 1e9:.1f}B params; loading in {self._compute_dtype()} instead of quantizing")
+            return False
+        
+        logger.info(f"📏 {model_name} has ~{num_params / 1e9:.1f}B params; quantizing to {self.quantization_bits}-bit")
+        return True
+    
+    def _build_quantization_config(self, model_name: str) -> Optional["BitsAndBytesConfig"]:
+        """Build the bitsandbytes config for USE_QUANTIZATION (4-bit NF4 or 8-bit LLM.int8)"""
+        self.quantized = False
+        if not self.use_quantization or not self._on_gpu or not self._should_quantize(model_name):
+            return None
+        
+        self.quantized = True
+        # Imported only when quantizing so CPU and unquantized loads never touch bitsandbytes
+        from transformers import BitsAndBytesConfig
+        
+        if self.quantization_bits == 8:
+            return BitsAndBytesConfig(
+                load_in_8bit=True,
+                llm_int8_threshold=6.0
+            )
+        
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=self._compute_dtype(),
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4"
+        )
+    
+    def _device_map(self):
+        """Whole model on the selected GPU when there is only one (no accelerate dispatch hooks), sharded otherwise"""
+        if not self._on_gpu:
+            return None
+        if torch.cuda.device_count() == 1:
+            return {"": self.device.index or 0}
+        return "auto"
+    
+    def _attn_implementation(self) -> str:
+        """FlashAttention-2 on GPU when flash_attn is installed, PyTorch SDPA otherwise"""
+        if self._on_gpu and importlib.util.find_spec("flash_attn") is not None:
+            return "flash_attention_2"
+        return "sdpa"
+    
+    def _load_causal_lm(self, model_name: str, **kwargs):
+        """AutoModelForCausalLM.from_pretrained with a fused attention kernel, falling back to the model's default"""
+        try:
+            return AutoModelForCausalLM.from_pretrained(
+                model_name, attn_implementation=self._attn_implementation(), **kwargs
+            )
+        except (ValueError, ImportError) as e:
+            # Architectures without SDPA/FlashAttention support reject the argument
+            logger.warning(f"⚠️ Fused attention unavailable for {model_name}, using default attention: {e}")
+            return AutoModelForCausalLM.from_pretrained(model_name, **kwargs)
+    
     def _load_tokenizer_safely(self, model_name: str):
         """Load tokenizer with multiple fallback strategies"""
         try:
-            # Try standard loading first
+            # Try the fast (Rust) tokenizer first
             tokenizer = AutoTokenizer.from_pretrained(
                 model_name,
-                trust_remote_code=True,
-                padding_side="left"
+                trust_remote_code=self.trust_remote_code,
+                use_fast=True
             )
-            logger.info(f"✅ Tokenizer loaded successfully")
+            if tokenizer.is_fast:
+                logger.info(f"✅ Tokenizer loaded successfully")
+            else:
+                logger.warning(f"⚠️ No fast tokenizer available for {model_name}, using the slower Python tokenizer")
             
         except Exception as e:
             logger.warning(f"⚠️ Standard tokenizer loading failed: {e}")
@@ -213,8 +466,7 @@ class UniversalModel(BaseModel):
                 # Try with use_fast=False (disable fast tokenizer)
                 tokenizer = AutoTokenizer.from_pretrained(
                     model_name,
-                    trust_remote_code=True,
-                    padding_side="left",
+                    trust_remote_code=self.trust_remote_code,
                     use_fast=False
                 )
                 logger.info(f"✅ Tokenizer loaded with use_fast=False")
@@ -226,8 +478,7 @@ class UniversalModel(BaseModel):
                     # Try with legacy=False
                     tokenizer = AutoTokenizer.from_pretrained(
                         model_name,
-                        trust_remote_code=True,
-                        padding_side="left",
+                        trust_remote_code=self.trust_remote_code,
                         legacy=False
                     )
                     logger.info(f"✅ Tokenizer loaded with legacy=False")
@@ -242,17 +493,54 @@ class UniversalModel(BaseModel):
         
         return tokenizer
     
+    def _resolve_token_ids(self):
+        """Look up the eos/pad ids once instead of on every generate() call"""
+        self._eos_id = self.tokenizer.eos_token_id
+        self._pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self._eos_id
+    
+    def _prepare_prompt_ids(self):
+        """Tokenize the fixed text around {text} in the prompt template once, right after the tokenizer loads"""
+        prefix, suffix = (self._prompt_template or "{text}").split("{text}")
+        prefix_ids = self.tokenizer(prefix, add_special_tokens=False).input_ids
+        suffix_ids = self.tokenizer(suffix, add_special_tokens=False).input_ids
+        
+        # Keep the BOS the tokenizer would add itself, unless the template already spells it out
+        bos_id = self.tokenizer.bos_token_id
+        if bos_id is not None and bos_id in self.tokenizer("").input_ids and prefix_ids[:1] != [bos_id]:
+            prefix_ids = [bos_id] + prefix_ids
+        self._prompt_ids = (prefix_ids, suffix_ids)
+    
+    def _configure_tokenizer(self):
+        """Set padding/truncation sides once for the task instead of per call"""
+        self._resolve_token_ids()
+        self._prepare_prompt_ids()
+        if self.task_type in ['text-generation', 'conversational']:
+            # Prompts end where generation starts, so pad and truncate on the left (keeps the latest context)
+            self.tokenizer.padding_side = "left"
+            self.tokenizer.truncation_side = "left"
+        else:
+            self.tokenizer.padding_side = "right"
+            self.tokenizer.truncation_side = "right"
+    
     def _load_model_safely(self, model_name: str, quantization_config):
         """Load model with multiple fallback strategies"""
         try:
             # Try loading based on detected task
-            if self.task_type in ['text-generation', 'text2text-generation', 'conversational']:
-                model = AutoModelForCausalLM.from_pretrained(
+            if self.task_type == 'text2text-generation':
+                model = AutoModelForSeq2SeqLM.from_pretrained(
                     model_name,
-                    torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                    device_map="auto" if torch.cuda.is_available() else None,
+                    torch_dtype=self._compute_dtype(),
+                    trust_remote_code=self.trust_remote_code
+                )
+                logger.info(f"✅ Seq2Seq model loaded successfully")
+                
+            elif self.task_type in ['text-generation', 'conversational']:
+                model = self._load_causal_lm(
+                    model_name,
+                    torch_dtype=self._compute_dtype(),
+                    device_map=self._device_map(),
                     quantization_config=quantization_config,
-                    trust_remote_code=True,
+                    trust_remote_code=self.trust_remote_code,
                     low_cpu_mem_usage=True
                 )
                 logger.info(f"✅ CausalLM model loaded successfully")
@@ -260,25 +548,25 @@ class UniversalModel(BaseModel):
             elif self.task_type == 'text-classification':
                 model = AutoModelForSequenceClassification.from_pretrained(
                     model_name,
-                    torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                    trust_remote_code=True
+                    torch_dtype=self._compute_dtype(),
+                    trust_remote_code=self.trust_remote_code
                 )
                 logger.info(f"✅ Classification model loaded successfully")
                 
             elif self.task_type == 'question-answering':
                 model = AutoModelForQuestionAnswering.from_pretrained(
                     model_name,
-                    torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                    trust_remote_code=True
+                    torch_dtype=self._compute_dtype(),
+                    trust_remote_code=self.trust_remote_code
                 )
                 logger.info(f"✅ QA model loaded successfully")
                 
             else:
                 # Default to CausalLM
-                model = AutoModelForCausalLM.from_pretrained(
+                model = self._load_causal_lm(
                     model_name,
-                    torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                    trust_remote_code=True
+                    torch_dtype=self._compute_dtype(),
+                    trust_remote_code=self.trust_remote_code
                 )
                 logger.info(f"✅ Default CausalLM model loaded successfully")
                 
@@ -288,19 +576,63 @@ class UniversalModel(BaseModel):
         
         return model
     
+    def _configure_kv_cache(self):
+        """Use a static KV cache for causal generation; generate() keeps it on the model and resets it per call"""
+        if self.task_type not in ['text-generation', 'conversational']:
+            return
+        
+        if getattr(self.model, '_supports_static_cache', False):
+            # Allocated on the first call and reused while batch size and length fit, instead of growing per token
+            self.model.generation_config.cache_implementation = "static"
+            logger.info("🧠 Static KV cache enabled")
+    
+    def _compile_and_warm_up(self):
+        """Compile the decode forward pass (USE_COMPILE) and run one short generate() so the first
+        user request does not pay for compilation, CUDA kernel autotuning and cache allocation (CUDA only)"""
+        if not self._on_gpu or self.task_type not in ['text-generation', 'conversational']:
+            return
+        
+        # Compile forward rather than the module so generate() keeps calling the compiled graph
+        eager_forward = self.model.forward
+        try:
+            if self.use_compile:
+                # Bucketed prompts x prefill/decode x a few batch sizes stay well under this many graphs
+                torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+                # The static KV cache (when supported) keeps shapes fixed so CUDA graphs are not re-captured every step
+                self.model.forward = torch.compile(self.model.forward, mode="reduce-overhead", fullgraph=True, dynamic=False)
+                self._compiled = True
+            
+            warmup = self._encode_prompts(["warmup"])
+            with torch.inference_mode():
+                self.model.generate(**warmup, **self._generation_kwargs({'max_tokens': 4}))
+            logger.info(f"🔥 Model warmed up{' (forward compiled with torch.compile)' if self._compiled else ''}")
+            
+        except Exception as e:
+            if not self.use_compile:
+                logger.warning(f"⚠️ Warm-up generation failed: {e}")
+                return
+            self.model.forward = eager_forward
+            self._compiled = False
+            logger.warning(f"⚠️ torch.compile unavailable, running eagerly: {e}")
+    
     def _load_fallback_model(self):
         """Load a simple fallback model if the main model fails"""
         try:
             logger.warning("🔄 Loading fallback model: gpt2")
             
-            self.tokenizer = AutoTokenizer.from_pretrained("gpt2")
-            self.tokenizer.pad_token = self.tokenizer.eos_token
+            # A gpt2 tokenizer may already be loaded if only the model load failed
+            if self.tokenizer is None or self.tokenizer.name_or_path != "gpt2":
+                self.tokenizer = AutoTokenizer.from_pretrained("gpt2", padding_side="left")
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+            self._resolve_token_ids()
+            self._prepare_prompt_ids()
             
-            self.model = AutoModelForCausalLM.from_pretrained("gpt2")
+            self.model = self._load_causal_lm("gpt2")
             self.task_type = "text-generation"
             self.is_peft_model = False
             
-            self._create_pipeline()
+            self._place_model()
+            self.model.eval()
             
             logger.info("✅ Fallback model (gpt2) loaded successfully")
             
@@ -308,67 +640,59 @@ class UniversalModel(BaseModel):
             logger.error(f"❌ Even fallback model failed: {e}")
             self.model = None
             self.tokenizer = None
-            self.pipeline = None
     
     def _detect_task_type(self, model_name: str) -> str:
         """Detect the task type based on model name and config"""
         model_name_lower = model_name.lower()
         
-        # Check model name patterns
-        if any(pattern in model_name_lower for pattern in ['gpt', 'llama', 'mistral', 'gemma', 'phi']):
-            return 'text-generation'
-        elif any(pattern in model_name_lower for pattern in ['t5', 'bart', 'pegasus']):
-            return 'text2text-generation'
-        elif any(pattern in model_name_lower for pattern in ['bert', 'roberta', 'distilbert']) and 'qa' in model_name_lower:
-            return 'question-answering'
-        elif any(pattern in model_name_lower for pattern in ['bert', 'roberta', 'distilbert']):
-            return 'text-classification'
-        elif 'dialogpt' in model_name_lower:
-            return 'conversational'
+        # One regex scan; when a name matches several families the earlier task in _MODEL_TO_TASK wins
+        tasks = {_MODEL_TO_TASK[fragment] for fragment in _TASK_RE.findall(model_name_lower)}
+        for task in _TASK_PRIORITY:
+            if task in tasks:
+                if task == 'text-classification' and 'qa' in model_name_lower:
+                    return 'question-answering'
+                return task
         
         # Default to text generation for chat models
         return 'text-generation'
     
-    def _create_pipeline(self):
-        """Create appropriate pipeline based on task type"""
-        try:
-            if not self.model or not self.tokenizer:
-                logger.error("❌ Cannot create pipeline: model or tokenizer not loaded")
-                return
-                
-            pipeline_kwargs = {
-                "model": self.model,
-                "tokenizer": self.tokenizer,
-                "device": 0 if torch.cuda.is_available() else -1,
-                "torch_dtype": torch.float16 if torch.cuda.is_available() else torch.float32,
-            }
-            
-            if self.task_type == 'text-generation':
-                pipeline_kwargs.update({
-                    "do_sample": True,
-                    "temperature": 0.7,
-                    "top_p": 0.9,
-                    "max_new_tokens": self.max_length,
-                    "repetition_penalty": 1.1,
-                    "pad_token_id": self.tokenizer.eos_token_id,
-                })
-                
-            self.pipeline = pipeline(self.task_type, **pipeline_kwargs)
-            logger.info(f"✅ Created {self.task_type} pipeline")
-            
-        except Exception as e:
-            logger.error(f"❌ Error creating pipeline: {e}")
-            # Set pipeline to None so bot can still work without AI responses
-            self.pipeline = None
+    def _place_model(self):
+        """Move models not placed by accelerate (device_map) onto the selected device"""
+        if self.model is not None and not getattr(self.model, 'hf_device_map', None):
+            self.model.to(self.device)
+    
+    def _is_ready(self) -> bool:
+        return self.model is not None and self.tokenizer is not None
+    
+    def _tokenize(self, *texts, truncation=True):
+        """Tokenize straight onto the model's device; shared by the non-generation task paths"""
+        return self.tokenizer(
+            *texts, return_tensors="pt", truncation=truncation, max_length=self.max_length
+        ).to(self.model.device)
+    
+    def _prepare_text(self, text: str) -> str:
+        """Strip the input and clip pathologically long inputs to the context window before any model call"""
+        text = text.strip()
+        if len(text) > 8 * self.max_length and self.tokenizer is not None:
+            # Leave room for the prompt template around the user text
+            ids = self.tokenizer(
+                text, add_special_tokens=False, truncation=True, max_length=max(self.max_length - 64, 1)
+            ).input_ids
+            text = self.tokenizer.decode(ids)
+        return text
     
     def predict(self, text: str, **kwargs) -> Dict[str, Any]:
         """Universal prediction method that adapts to any model type"""
         try:
-            if not self.pipeline:
+            text = self._prepare_text(text)
+            if not text:
+                return dict(_EMPTY_INPUT_RESULT)
+            
+            if not self._is_ready():
                 return {
                     'response': "Model not available. Please contact administrator.",
                     'confidence': 0.0,
-                    'error': "No pipeline available"
+                    'error': "No model loaded"
                 }
             
             # Route to appropriate prediction method
@@ -391,31 +715,52 @@ class UniversalModel(BaseModel):
                 'error': str(e)
             }
     
+    def _padding_kwargs(self) -> Dict[str, Any]:
+        """Pad to the longest prompt, or to a _PROMPT_BUCKET multiple once the forward is compiled"""
+        if self._compiled:
+            return dict(padding=True, pad_to_multiple_of=_PROMPT_BUCKET)
+        return dict(padding=True)
+    
+    def _generation_kwargs(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """Sampling settings shared by single and batched generation (DO_SAMPLE=false decodes greedily)"""
+        settings = get_settings()
+        gen_kwargs = dict(
+            max_new_tokens=kwargs.get('max_tokens', min(self.max_length, 256)),  # Reduced for safety
+            do_sample=kwargs.get('do_sample', getattr(settings, 'DO_SAMPLE', True)),
+            num_beams=1,
+            repetition_penalty=kwargs.get('repetition_penalty', getattr(settings, 'REPETITION_PENALTY', 1.1)),
+            pad_token_id=self._pad_id,
+            eos_token_id=self._eos_id,
+            use_cache=True
+        )
+        
+        # Greedy decoding skips the per-token temperature/top-p pass over the vocabulary logits
+        if gen_kwargs['do_sample']:
+            gen_kwargs['temperature'] = kwargs.get('temperature', getattr(settings, 'TEMPERATURE', 0.7))
+            gen_kwargs['top_p'] = kwargs.get('top_p', getattr(settings, 'TOP_P', 0.9))
+        return gen_kwargs
+    
     def _generate_text(self, prompt: str, **kwargs) -> Dict[str, Any]:
         """Generate text for chat/completion models"""
         try:
-            # Format prompt based on model type
-            formatted_prompt = self._format_prompt(prompt)
-            
-            # Generate response
-            outputs = self.pipeline(
-                formatted_prompt,
-                max_new_tokens=kwargs.get('max_tokens', min(self.max_length, 256)),  # Reduced for safety
-                do_sample=kwargs.get('do_sample', True),
-                temperature=kwargs.get('temperature', 0.7),
-                top_p=kwargs.get('top_p', 0.9),
-                repetition_penalty=kwargs.get('repetition_penalty', 1.1),
-                return_full_text=False,
-                pad_token_id=self.tokenizer.eos_token_id,
-                eos_token_id=self.tokenizer.eos_token_id,
-            )
+            # Tokenize once and call generate directly
+            inputs = self._encode_prompts([prompt])
+            input_ids = inputs['input_ids']
+            
+            with self._generate_lock, torch.inference_mode():
+                outputs = self.model.generate(
+                    **inputs,
+                    streamer=kwargs.get('streamer'),
+                    **self._generation_kwargs(kwargs)
+                )
             
-            generated_text = outputs[0]['generated_text'].strip()
+            new_tokens = outputs[0, input_ids.shape[1]:]
+            generated_text = self.tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
             cleaned_response = self._clean_response(generated_text)
             
             return {
                 'response': cleaned_response,
-                'confidence': self._calculate_confidence(cleaned_response),
+                'confidence': self._calculate_confidence(cleaned_response, self._count_tokens(new_tokens)),
                 'model_name': self.model_name,
                 'task_type': self.task_type,
                 'is_peft': self.is_peft_model
@@ -425,11 +770,93 @@ class UniversalModel(BaseModel):
             logger.error(f"❌ Text generation error: {e}")
             return {'response': "I couldn't generate a response. Please try again.", 'confidence': 0.0, 'error': str(e)}
     
+    def predict_batch(self, texts: List[str], **kwargs) -> List[Dict[str, Any]]:
+        """Generate (or classify) several prompts with one padded model call; other tasks predict one by one"""
+        prepared = [self._prepare_text(text) for text in texts]
+        pending = [i for i, text in enumerate(prepared) if text]
+        
+        if len(pending) < 2 or not self._is_ready():
+            return [self.predict(text, **kwargs) for text in texts]
+        
+        if self.task_type == 'text-classification':
+            results = [dict(_EMPTY_INPUT_RESULT) for _ in texts]
+            for i, result in zip(pending, self._classify_batch([prepared[i] for i in pending])):
+                results[i] = result
+            return results
+        
+        if self.task_type not in ['text-generation', 'conversational']:
+            return [self.predict(text, **kwargs) for text in texts]
+        
+        try:
+            inputs = self._encode_prompts([prepared[i] for i in pending])
+            
+            with self._generate_lock, torch.inference_mode():
+                outputs = self.model.generate(**inputs, **self._generation_kwargs(kwargs))
+            
+            new_tokens = outputs[:, inputs['input_ids'].shape[1]:]
+            generated = self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+            token_counts = self._count_tokens(new_tokens)
+            
+        except Exception as e:
+            logger.error(f"❌ Batch generation error: {e}")
+            return [
+                {'response': "I couldn't generate a response. Please try again.", 'confidence': 0.0, 'error': str(e)}
+                for _ in texts
+            ]
+        
+        results = [dict(_EMPTY_INPUT_RESULT) for _ in texts]
+        for i, text, num_tokens in zip(pending, generated, token_counts):
+            cleaned_response = self._clean_response(text.strip())
+            results[i] = {
+                'response': cleaned_response,
+                'confidence': self._calculate_confidence(cleaned_response, num_tokens),
+                'model_name': self.model_name,
+                'task_type': self.task_type,
+                'is_peft': self.is_peft_model
+            }
+        return results
+    
+    def supports_streaming(self) -> bool:
+        """Streaming is available for causal generation models (generate() feeds the streamer directly)"""
+        return self.model is not None and self.task_type in ['text-generation', 'conversational']
+    
+    def predict_stream(self, text: str, **kwargs) -> Generator[str, None, Dict[str, Any]]:
+        """Yield the accumulated response as tokens are decoded, then return the final result"""
+        text = self._prepare_text(text)
+        if not text or not self.supports_streaming():
+            result = self.predict(text, **kwargs)
+            yield result.get('response', '')
+            return result
+        
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        results = []
+        
+        def generate():
+            try:
+                results.append(self._generate_text(text, streamer=streamer, **kwargs))
+            finally:
+                # Unblock the consumer even if generation failed before emitting anything
+                streamer.end()
+        
+        worker = threading.Thread(target=generate, daemon=True)
+        worker.start()
+        
+        partial = ""
+        for chunk in streamer:
+            if chunk:
+                partial += chunk
+                yield partial
+        
+        worker.join()
+        return results[0]
+    
+    @torch.inference_mode()
     def _generate_text_to_text(self, text: str, **kwargs) -> Dict[str, Any]:
         """Handle text-to-text generation models (T5, BART, etc.)"""
         try:
-            outputs = self.pipeline(text, max_length=self.max_length)
-            response = outputs[0]['generated_text'] if outputs else "No response generated"
+            # Encoder-decoder outputs hold only the generated tokens
+            outputs = self.model.generate(**self._tokenize(text), max_length=self.max_length)
+            response = self.tokenizer.decode(outputs[0], skip_special_tokens=True).strip() or "No response generated"
             
             return {
                 'response': response,
@@ -441,6 +868,7 @@ class UniversalModel(BaseModel):
         except Exception as e:
             return {'response': "Error in text-to-text generation", 'confidence': 0.0, 'error': str(e)}
     
+    @torch.inference_mode()
     def _answer_question(self, text: str, context: str = None, **kwargs) -> Dict[str, Any]:
         """Handle question-answering models"""
         try:
@@ -451,11 +879,21 @@ class UniversalModel(BaseModel):
             else:
                 question = text
             
-            result = self.pipeline(question=question, context=context)
+            inputs = self._tokenize(question, context, truncation="only_second")
+            outputs = self.model(**inputs)
+            
+            # Restrict the span to context tokens, then take the best start and the best end after it
+            in_context = torch.tensor(
+                [sequence_id == 1 for sequence_id in inputs.sequence_ids(0)], device=outputs.start_logits.device
+            )
+            start_probs = torch.softmax(outputs.start_logits[0].float().masked_fill(~in_context, float('-inf')), dim=-1)
+            end_probs = torch.softmax(outputs.end_logits[0].float().masked_fill(~in_context, float('-inf')), dim=-1)
+            start = int(start_probs.argmax())
+            end = start + int(end_probs[start:].argmax())
             
             return {
-                'response': result['answer'],
-                'confidence': result['score'],
+                'response': self.tokenizer.decode(inputs['input_ids'][0, start:end + 1], skip_special_tokens=True).strip(),
+                'confidence': (start_probs[start] * end_probs[end]).item(),
                 'model_name': self.model_name,
                 'task_type': self.task_type
             }
@@ -465,85 +903,100 @@ class UniversalModel(BaseModel):
     
     def _classify_text(self, text: str, **kwargs) -> Dict[str, Any]:
         """Handle text classification models"""
+        return self._classify_batch([text])[0]
+    
+    @torch.inference_mode()
+    def _classify_batch(self, texts: List[str]) -> List[Dict[str, Any]]:
+        """Classify several texts with one padded forward pass"""
         try:
-            results = self.pipeline(text)
-            
-            if isinstance(results, list) and results:
-                best_result = max(results, key=lambda x: x['score'])
-                response = f"Classification: {best_result['label']}"
-            else:
-                response = f"Classification: {results['label']}"
-                best_result = results
+            inputs = self.tokenizer(
+                texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="pt"
+            ).to(self.model.device)
+            logits = self.model(**inputs).logits
+            confidences, predicted = torch.softmax(logits.float(), dim=-1).max(dim=-1)
             
-            return {
-                'response': response,
-                'confidence': best_result['score'],
-                'predicted_class': best_result['label'],
+        except Exception as e:
+            return [{'response': "Error in text classification", 'confidence': 0.0, 'error': str(e)} for _ in texts]
+        
+        results = []
+        for confidence, index in zip(confidences.tolist(), predicted.tolist()):
+            label = self.model.config.id2label[index]
+            results.append({
+                'response': f"Classification: {label}",
+                'confidence': confidence,
+                'predicted_class': label,
                 'model_name': self.model_name,
                 'task_type': self.task_type
-            }
-            
-        except Exception as e:
-            return {'response': "Error in text classification", 'confidence': 0.0, 'error': str(e)}
-    
-    def _format_prompt(self, text: str) -> str:
-        """Format prompt based on model type and training template"""
-        model_name_lower = self.model_name.lower()
-        
-        # Check for specific model formats
-        if 'mistral' in model_name_lower or 'mixtral' in model_name_lower:
-            return f"<s>[INST] {text} [/INST]"
-        elif 'llama' in model_name_lower and 'chat' in model_name_lower:
-            return f"<s>[INST] {text} [/INST]"
-        elif 'phi' in model_name_lower:
-            return f"Instruct: {text}\nOutput:"
-        elif 'gemma' in model_name_lower:
-            return f"<start_of_turn>user\n{text}<end_of_turn>\n<start_of_turn>model\n"
-        elif any(pattern in model_name_lower for pattern in ['gpt', 'dialogpt']):
-            return text
-        else:
-            # Generic format - just return the text
-            return text
+            })
+        return results
+    
+    @staticmethod
+    def _resolve_prompt_template(model_name: str) -> Optional[str]:
+        """Training prompt template for the model family, or None to pass text through unchanged"""
+        model_name_lower = model_name.lower()
+        for fragments, template in _PROMPT_TEMPLATES:
+            if all(fragment in model_name_lower for fragment in fragments):
+                return template
+        return None
+    
+    def _encode_prompts(self, texts: List[str]) -> Dict[str, torch.Tensor]:
+        """Padded input_ids/attention_mask for the templated prompts; only the user texts are tokenized per call"""
+        prefix_ids, suffix_ids = self._prompt_ids
+        budget = max(self.max_length - len(prefix_ids) - len(suffix_ids), 1)
+        
+        # Truncate the user text from the left, keeping the latest context next to the template suffix
+        bodies = self.tokenizer(list(texts), add_special_tokens=False).input_ids
+        encoded = {'input_ids': [prefix_ids + body[-budget:] + suffix_ids for body in bodies]}
+        
+        # Left padding (set on the tokenizer at load) keeps every prompt flush against its generated tokens
+        return self.tokenizer.pad(encoded, return_tensors="pt", **self._padding_kwargs()).to(self.model.device)
     
     def _clean_response(self, response: str) -> str:
         """Clean generated response"""
         # Remove special tokens and artifacts
-        response = re.sub(r'<[^>]+>', '', response)  # Remove XML-like tags
-        response = re.sub(r'\[INST\]|\[/INST\]', '', response)  # Remove instruction tokens
-        response = re.sub(r'<start_of_turn>|<end_of_turn>', '', response)  # Remove turn tokens
-        response = re.sub(r'\s+', ' ', response)  # Normalize whitespace
+        response = _RE_STRIP.sub('', response)  # Remove XML-like tags, turn and instruction tokens
+        response = _RE_WS.sub(' ', response)  # Normalize whitespace
+        
+        # Whitespace normalization folds newlines, so single-line responses need no de-duplication
+        if '\n' not in response:
+            return response.strip()
         
         # Remove repetitive patterns
-        lines = response.split('\n')
-        unique_lines = []
-        for line in lines:
-            if line.strip() and line.strip() not in unique_lines:
-                unique_lines.append(line.strip())
+        stripped = (line.strip() for line in response.split('\n'))
+        unique_lines = dict.fromkeys(line for line in stripped if line)
         
         return '\n'.join(unique_lines).strip()
     
-    def _calculate_confidence(self, response: str) -> float:
+    def _count_tokens(self, new_tokens: torch.Tensor):
+        """Generated token count per sequence (padding after EOS excluded), from the ids generate() returned"""
+        counts = (new_tokens != self._pad_id).sum(dim=-1)
+        return counts.tolist() if counts.dim() else counts.item()
+    
+    def _calculate_confidence(self, response: str, num_tokens: Optional[int] = None) -> float:
         """Calculate confidence score based on response characteristics"""
-        if not response or len(response.strip()) < 3:
+        response = response.strip()
+        n_chars = len(response)
+        if n_chars < 3:
             return 0.0
         
         confidence = 0.7  # Base confidence
         
-        # Adjust based on response length
-        word_count = len(response.split())
+        # Adjust based on response length (generated token count when known; cleaned responses have
+        # single-space-normalized whitespace, so counting spaces avoids building a word list)
+        word_count = num_tokens if num_tokens is not None else response.count(' ') + 1
         if word_count < 3:
             confidence -= 0.3
         elif word_count > 10:
             confidence += 0.1
         
         # Check for completeness indicators
-        if response.endswith(('.', '!', '?')):
+        if response[-1] in '.!?':
             confidence += 0.1
         
         # Penalize very short or very long responses
-        if len(response) < 10:
+        if n_chars < 10:
             confidence -= 0.2
-        elif len(response) > 1000:
+        elif n_chars > 1000:
             confidence -= 0.1
         
         return min(max(confidence, 0.0), 1.0)
@@ -558,10 +1011,12 @@ class UniversalModel(BaseModel):
         return {
             'model_name': self.model_name,
             'task_type': self.task_type,
-            'device': str(self.device),
+            'device': str(self.device or 'not selected'),
             'max_length': self.max_length,
-            'quantized': self.use_quantization,
+            'quantized': self.quantized,
+            'quantization_bits': self.quantization_bits if self.quantized else None,
             'model_loaded': self.model is not None,
-            'pipeline_ready': self.pipeline is not None,
-            'is_peft_model': self.is_peft_model
+            'ready': self._is_ready(),
+            'is_peft_model': self.is_peft_model,
+            'cuda_alloc_conf': os.environ.get('PYTORCH_CUDA_ALLOC_CONF')
         }